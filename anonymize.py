@@ -1,23 +1,71 @@
-import pandas as pd
 import regex
 import sys
-import inflect
+import time
+import bisect
 import entity_rules as er
 import regex_utils as ru
 import processor_base as pb
-from xeger import Xeger
+import regex_generator as rg
+import phrase_data as pdata
 
-inflector = inflect.engine()
+#The inflect engine used to write numbers as words.  inflect is slow to import so the engine is only built by get_inflector() when an anonymizer needs it.
+_inflector = None
 
 ## Helper functions ###
 
-def digits2words(digits):
-    num2words = {'0': 'zero', '1': 'one', '2': 'two', '3': 'three', '4': 'four', '5': 'five', '6': 'six', '7': 'seven', '8': 'eight', '9': 'nine'}
-    words = ''
-    for digit in range(0, len(digits)): 
-        words += " " + num2words[digits[digit]]
+'''Return the inflect engine, importing inflect and building the engine the first time it is needed.'''
+def get_inflector():
+    global _inflector
+    if _inflector is None:
+        import inflect
+        _inflector = inflect.engine()
+    return _inflector
+
+#The numbers already written as words by number_to_words().
+_number_words = {}
+
+'''Return a number written as words by inflect, e.g. 'one hundred and five'.  Each number is only converted once.'''
+def number_to_words(number):
+    words = _number_words.get(number)
+    if words is None:
+        words = get_inflector().number_to_words(number)
+        _number_words[number] = words
     return words
 
+#Each digit as a word with a leading space.
+DIGIT_WORDS = {'0': ' zero', '1': ' one', '2': ' two', '3': ' three', '4': ' four', '5': ' five', '6': ' six', '7': ' seven', '8': ' eight', '9': ' nine'}
+
+'''Return the digits as words, each with a leading space, e.g. ' four one'.'''
+def digits2words(digits):
+    return ''.join([DIGIT_WORDS[digit] for digit in digits])
+
+#Matches tags of the form '[ENTITY-dddd]' or 'ENTITY-dddd' and splits them into the entity category and index.
+TAG_RE=regex.compile(r'\[?(.*)-(.*?)\]?')
+
+'''Return the (category, index) of a tag of the form '[ENTITY-dddd]' or 'ENTITY-dddd', or None if the tag is not of this form.'''
+def parse_tag(tag):
+    m=TAG_RE.fullmatch(tag)
+    return (m[1], m[2]) if m else None
+
+'''Return (literal, wordbreak) for a token-map regex that is a plain (possibly escaped) literal, optionally between \\b word breaks, or None if it is not.'''
+def literal_token(token):
+    wordbreak=len(token)>4 and token.startswith('\\b') and token.endswith('\\b') and not token.endswith('\\\\b')
+    if wordbreak: token=token[2:-2]
+    literal=[]
+    i=0
+    while i<len(token):
+        c=token[i]
+        if c=='\\':
+            if i+1>=len(token) or token[i+1].isalnum(): return None
+            literal.append(token[i+1])
+            i+=2
+        elif c in '.^$*+?{}[]|()':
+            return None
+        else:
+            literal.append(c)
+            i+=1
+    return ''.join(literal), wordbreak
+
 ## Anonymizer classes ##
 
 #Base class from which all anonymizers are derived.
@@ -26,6 +74,11 @@ class AnonymizerBase(pb.ProcessorBase):
     def __init__(self,id,entity_rules):
         self._entity_map=None
         self._entity_values=None
+        self._anon_pattern=None
+        #The number of tags replaced, for --profile.
+        self._matches=0
+        #The time the tags of a text may take to find before the text is left as it is (--regextimeout).
+        self._timeout=None
         super().__init__(id, entity_rules)
 
     '''Virtual prototype for configuring an anonymizer with a specific set of parameters.'''
@@ -33,6 +86,7 @@ class AnonymizerBase(pb.ProcessorBase):
         super().configure(params)
         self._entity_map=entity_map
         self._entity_values=entity_values
+        self._timeout=self._entity_rules.args.regextimeout
 
     #Implement the generic processor rule.  
     def process(self,df):
@@ -44,18 +98,49 @@ class AnonymizerBase(pb.ProcessorBase):
     def anonymize(self, texts, conversation_ids):
         new_texts = []
             
-        #Get a regex to match any entities to be replaced (if any).
-        this_regex = self.anon_regex(self._id)
-        if this_regex!="":
-            for text,id in zip(texts,conversation_ids):
-                new_text = regex.sub(this_regex,lambda x: self.callback(x,id), text)
+        #Get a regex to match any entities to be replaced (if any). It is compiled the first time it is needed.
+        if self._anon_pattern is None:
+            this_regex = self.anon_regex(self._id)
+            self._anon_pattern = regex.compile(this_regex) if this_regex!="" else ""
+        if self._anon_pattern!="":
+            for i, (text,id) in enumerate(zip(texts,conversation_ids)):
+                #A text whose tags are not all found within the timeout is left as it is, e.g. if a token-map regex backtracks catastrophically on it.
+                try:
+                    new_text, count = self._anon_pattern.subn(lambda x: self.callback(x,id), text, timeout=self._timeout)
+                except TimeoutError:
+                    self.record_timeout(i, "skipped", len(text))
+                    new_text, count = text, 0
+                self._matches+=count
                 new_texts.append(new_text)
         return new_texts
 
+    '''Add to the number of tags replaced, e.g. by a TagScanner.'''
+    def add_matches(self, count):
+        self._matches+=count
+
+    @property
+    def matches(self):
+        return self._matches
+
     '''Virtual function for callback to support anonymize().  Override this function to return the new value for the anonymized entity.'''
     def callback(self, match, i):
-        tag = match.group()
-        return self.persist_entity_value(i,tag,"")
+        return self.persist_match_value(i,match,"")
+
+    '''Return the entity names and literal tokens replaced by this anonymizer and whether the entity labels must have an index, or None if a TagScanner cannot find them.'''
+    def scan_tags(self):
+        #An anonymizer with its own anonymize() function does not replace tags one at a time with callback().
+        if type(self).anonymize is not AnonymizerBase.anonymize: return None
+
+        names=self._entity_rules.anon_map.get(self._id,[])
+        literals=[literal_token(token) for token in self._entity_rules.token_map.get(self._id,[])]
+        if not all(isinstance(name,str) and regex.fullmatch(r'\w+',name) for name in names): return None
+        if None in literals: return None
+        return names, literals, False
+
+    '''Return True if the values of this anonymizer can contain one of the characters, e.g. the brackets of a label.  Values that cannot be known
+    before they are drawn, such as restored text, are checked by the TagScanner as they are drawn instead.'''
+    def can_emit(self, chars):
+        return False
 
     def persist_entity_value(self, id, tag, entity_value):
         #Look for tags of the form '[ENTITY-dddd]' where dddd is an integer identifier for the entity.
@@ -63,12 +148,16 @@ class AnonymizerBase(pb.ProcessorBase):
         #If this exists then we look whether we have seen something of type 'ENTITY' with this id and index previously.
         #If we have then use that value otherwise use the value we were given and remember it for later calls.
         #If the tag does not match the pattern then just return the value we were given.
+        return self.persist_parsed_value(id, parse_tag(tag), entity_value)
 
-        this_match = regex.fullmatch(r'\[?(.*)-(.*?)\]?', tag)
+    '''Persist the value of the tag found by match. Tags found by a TagScanner have already been parsed.'''
+    def persist_match_value(self, id, match, entity_value):
+        if isinstance(match, TagMatch): return self.persist_parsed_value(id, match.parsed, entity_value)
+        return self.persist_entity_value(id, match.group(), entity_value)
 
-        if (this_match and self._params.get("persist",True)):   # handling for ENTITY-dddd tags    
-            m_ix=this_match[2]
-            m_cat=this_match[1]
+    def persist_parsed_value(self, id, parsed, entity_value):
+        if (parsed is not None and self._params.get("persist",True)):   # handling for ENTITY-dddd tags    
+            m_cat, m_ix = parsed
             r=self._entity_map.update_entities(m_ix, id, entity_value, m_cat)
         else:
             r=entity_value
@@ -105,7 +194,7 @@ class AnonRegex(AnonymizerBase):
         self._pattern_set =[]
         self._flags=0
         self._limit=10
-        self._xeger=None
+        self._generators=[]
         super().__init__(id, entity_rules)
 
     def configure(self, params, entity_map, entity_values):
@@ -114,16 +203,12 @@ class AnonRegex(AnonymizerBase):
 
         #Get params.voice or params.text if they are specified.
         _model_params=params.get(self._entity_rules.args.modality,None)
-        
-        #Set up the Xeger generator. Pass it the shared random function so that the seed is deterministic.
-        self._limit=_model_params.get("limit",10)  
-        self._xeger = Xeger(limit=self._limit)
-        self._xeger.random = self.random
 
         #If the paramters do not contain a definition for the current modality then raise a NotSupported exception.
         if _model_params is None: 
             raise er.NotSupportedException("Modality: "+str(self._entity_rules.args.modality)+" not supported for anonymizer id: "+self._id)
         #print("_model_params:",_model_params)
+        self._limit=_model_params.get("limit",10)  
 
         #Build a regular expression matcher using the parameters in the relevant 'voice' or 'text' section.
         _regex_filename=_model_params.get("regex-filename",None)   
@@ -148,16 +233,49 @@ class AnonRegex(AnonymizerBase):
         except Exception as exc:
             print("WARNING: Failed to compile regex set for ':"+self._id+"' with error: "+str(exc),file=sys.stderr)
 
+        #Build a generator for each regex once. They use the shared random function so that the seed is deterministic.
+        self._generators = [self.build_generator(pattern) for pattern in self._pattern_set]
+
+    '''Return a function that generates random strings matching a compiled regex.  A regex_generator.RegexGenerator gives the same strings as Xeger without parsing
+    the regex for every string.  Xeger is only used for a regex that the generator cannot handle, so that it fails in the same way as it always has.'''
+    def build_generator(self, pattern):
+        try:
+            return rg.RegexGenerator(pattern, self._limit, self.random)
+        except ValueError:
+            #xeger is imported here so that it is only loaded if it is needed.
+            from xeger import Xeger
+            _xeger = Xeger(limit=self._limit)
+            _xeger.random = self.random
+            return lambda: _xeger.xeger(pattern)
+
+    #The characters of a regex that only Xeger can generate are not known.
+    def can_emit(self, chars):
+        return any(not isinstance(generate, rg.RegexGenerator) or not generate.characters.isdisjoint(chars) for generate in self._generators)
+
     def callback(self, match, i):
         #If there are multiple regexps in a list, then pick one at random.
-        pattern=self.random.choice(self._pattern_set)
-        anon_string= self._xeger.xeger(pattern)
-        #print ("pattern:",pattern,"string:",anon_string)
-        tag = match.group()
-        return self.persist_entity_value(i,tag,anon_string)
+        generate=self.random.choice(self._generators)
+        anon_string= generate()
+        return self.persist_match_value(i,match,anon_string)
 
 class AnonRestoreEntityText(AnonymizerBase):
     '''Class to replace an anonymization token with the original text that was redacted in order to restore the original text.'''
+    #Only labels with an index for this entity are restored.
+    def scan_tags(self):
+        if not regex.fullmatch(r'\w+',self._id): return None
+        return [self._id], [], True
+
+    #Return the original text for a label found by a TagScanner. The label is left as it is if there is nothing to restore.
+    def callback(self, match, i):
+        if (self._entity_values.is_empty()): return match.group()
+        name = match.group()[1:-1]
+        value = self._entity_values.get_value(name)
+        if value is None:
+            #Warn that there is no restoration data for this entity and continue.
+            print(f'WARNING: entity {name} has no restoration data.',file=sys.stderr)
+            return "["+name+"]"
+        return value
+
     def anonymize(self, texts, conversation_ids):
         #If there are no entity values to restore then print a simple abort message ard return.
         #This deals with the situation where anonymization of a set of IGNORE items is being attempted without the --redact option set.
@@ -170,6 +288,7 @@ class AnonRestoreEntityText(AnonymizerBase):
 
         for text in texts:
             matches = list(pattern.finditer(text))
+            self._matches+=len(matches)
             newString = text
             for e in reversed(matches):
                 name = e.group(2)
@@ -223,39 +342,45 @@ class AnonPhraseList(AnonymizerBase):
             _phrase_header=_phrase_rule.get("phrase-header",True)
             _phrase_list=_phrase_rule.get("phrase-list",None)   
 
-            #Load the phrase list depending on how it is specified.
+            #Load the phrase list depending on how it is specified.  Lists loaded from files are shared with the other rules that use the same file.
             if (_phrase_list is None) and  (_phrase_filename is not None):
-                if _phrase_header is None:  _df = pd.read_csv(self.absolute_path(_phrase_filename), Header=None)
-                else: _df = pd.read_csv(self.absolute_path(_phrase_filename),)
-                if _phrase_field is None:
-                    _phrase_list=(_df.iloc[:,_phrase_column]).to_list()
-                else:
-                    _phrase_list=_df[_phrase_field].to_list()
+                _phrase_list=pdata.load_phrase_list(self.absolute_path(_phrase_filename), _phrase_field, _phrase_column, (None if _phrase_header is None else 0),
+                                                    self._entity_rules.args.phrasecache)
             
             #If the list is ok then add it to the phrase list set.
-            if (not isinstance(_phrase_list,list)) or len(_phrase_list)==0:
+            if (not isinstance(_phrase_list,(list,pdata.PhraseList))) or len(_phrase_list)==0:
                 raise er.EntityRuleConfigException("ERROR: Invalid or empty phrase list rule for entity: "+str(self._id))
             self._phrase_list_set.append(_phrase_list)
 
+    def can_emit(self, chars):
+        for phrase_list in self._phrase_list_set:
+            if isinstance(phrase_list, pdata.PhraseList):
+                if phrase_list.contains_any(chars): return True
+            elif any(c in str(phrase) for phrase in phrase_list for c in chars): return True
+        return False
+
     #Choose a random item from each phrase list and concatenate them in order.
     def callback(self, match, i):
         phrase=""
         for phrase_list in self._phrase_list_set:
             phrase = phrase + str(self.random.choice(phrase_list))
-        tag = match.group()
-        return self.persist_entity_value(i,tag,phrase)
+        return self.persist_match_value(i,match,phrase)
 
 class AnonAddress(AnonPhraseList):
+    def configure(self, params, entity_map, entity_values):
+        super().configure(params, entity_map, entity_values)
+        #Build the inflect engine now rather than when the first address is anonymized.
+        if self._entity_rules.args.modality != 'text': get_inflector()
+
     def callback(self,match, i):
         street = str(self.random.choice(self._phrase_list_set[0]))
         if self._entity_rules.args.modality == 'text':
             number = str(self.random.randrange(100,500))
         else:
-            number = inflector.number_to_words(self.random.randrange(100,500))
+            number = number_to_words(self.random.randrange(100,500))
         address = number + " " + street + " "
 
-        tag = match.group()
-        return self.persist_entity_value(i,tag,address)
+        return self.persist_match_value(i,match,address)
 
 class AnonZipC(AnonPhraseList):
     def callback(self, match, i):
@@ -263,8 +388,7 @@ class AnonZipC(AnonPhraseList):
             zipC = str(self.random.choice(self._phrase_list_set[0]))
         else:
             zipC = digits2words(str(self.random.choice(self._phrase_list_set[0])))
-        tag = match.group()
-        return self.persist_entity_value(i,tag,zipC)
+        return self.persist_match_value(i,match,zipC)
 
 class AnonPhone(AnonymizerBase):
     def callback(self, match, i):
@@ -275,8 +399,7 @@ class AnonPhone(AnonymizerBase):
             phone = area_code + "-" + exchange + "-" + number
         else:
             phone = digits2words(str(area_code + exchange + number))
-        tag = match.group()
-        return self.persist_entity_value(i,tag,phone)
+        return self.persist_match_value(i,match,phone)
 
 class AnonSSN(AnonymizerBase):
     def callback(self, match, i):
@@ -287,5 +410,163 @@ class AnonSSN(AnonymizerBase):
             ssn = first + "-" + second + "-" + third
         else:
             ssn = digits2words(str(first + second + third))
-        tag = match.group()
-        return self.persist_entity_value(i,tag,ssn)
+        return self.persist_match_value(i,match,ssn)
+
+## TagScanner class ##
+
+# A tag found by a TagScanner with its category and index already parsed.  Supports the parts of the regex match object interface used by the anonymizers.
+class TagMatch():
+    def __init__(self, string, start, end, parsed):
+        self._string=string
+        self._start=start
+        self._end=end
+        self.parsed=parsed
+
+    def group(self, *groups):
+        return self._string[self._start:self._end]
+
+    def start(self, *groups):
+        return self._start
+
+    def end(self, *groups):
+        return self._end
+
+    def span(self, *groups):
+        return (self._start, self._end)
+
+# Finds the tags of every anonymizer in a pipeline in a single pass over each text and dispatches each tag to the anonymizer that would have replaced it.
+# The anonymizers are still called in anonymization order, and for each anonymizer in text order, so the values drawn with a fixed --seed are unchanged.
+# Once the values of an anonymizer are drawn the texts they go into are scanned again to check that the tags of the later anonymizers are still the ones
+# found at first.  If a value makes or breaks a tag (e.g. a restored text that contains a label) the remaining anonymizers are run one after another instead.
+class TagScanner():
+    '''Build the scanner from the (rule, model) pairs of the anonymizers. Use build_tag_scanner() to check that the anonymizers can be scanned first.'''
+    def __init__(self, anonymizers, labels, literals):
+        #labels: {(name, has_index): anonymizer number}, literals: {literal: (anonymizer number, parsed tag, wordbreak)}
+        self._anonymizers=anonymizers
+        self._labels=labels
+        self._literals=literals
+        #Only labels of known entities are matched so that a literal inside an unknown label can still be found.
+        names=sorted(set(name for name, has_index in labels), key=lambda name: (-len(name), name))
+        _regex=r'\[('+'|'.join(names)+r')(?:-(\d+))?\]'
+        if literals: _regex=_regex+'|('+'|'.join(r'\b'+regex.escape(literal)+r'\b' if wordbreak else regex.escape(literal) for literal, (k, parsed, wordbreak) in literals.items())+')'
+        self._pattern=regex.compile(_regex)
+
+    '''Return a list of (anonymizer number, match) for the tags in text s in the order they are found.'''
+    def scan(self, s):
+        tags=[]
+        for m in self._pattern.finditer(s):
+            if self._literals and m.group(3) is not None:
+                k, parsed, wordbreak = self._literals[m.group(3)]
+            else:
+                name, ix = m.group(1, 2)
+                k=self._labels.get((name, ix is not None), None)
+                if k is None: continue
+                parsed=(name, ix) if ix is not None else None
+            tags.append((k, TagMatch(s, m.start(), m.end(), parsed)))
+        return tags
+
+    '''Anonymize the texts with the anonymizers, scanning each text once.  Return the texts and the number of anonymizers that have been run, which is less
+    than all of them if a value changed the tags of the later anonymizers.  The caller runs the rest one after another.  With a profile the time spent by
+    each anonymizer and on the scan is recorded.'''
+    def anonymize(self, texts, conversation_ids, verbose=False, profile=None):
+        _start=time.perf_counter()
+        scanned=[self.scan(text) for text in texts]
+
+        #Collect the tags of each anonymizer in text order, then draw the values one anonymizer at a time.
+        by_anonymizer=[[] for _ in self._anonymizers]
+        for t, tags in enumerate(scanned):
+            for j, (k, match) in enumerate(tags):
+                by_anonymizer[k].append((t, j, match))
+        values=[[None]*len(tags) for tags in scanned]
+        _scan_time=time.perf_counter()-_start
+        for n, ((rule, model), found) in enumerate(zip(self._anonymizers, by_anonymizer)):
+            if (verbose): print("Anonymizing ",rule,"...")
+            _start=time.perf_counter()
+            for t, j, match in found:
+                values[t][j]=model.callback(match, conversation_ids[t])
+            model.add_matches(len(found))
+            if profile is not None: profile.add("anonymizer", rule, time.perf_counter()-_start, texts=len(texts), matches=len(found))
+            _start=time.perf_counter()
+            _unchanged=self.later_tags_unchanged(n, texts, scanned, values, found)
+            _scan_time+=time.perf_counter()-_start
+            if not _unchanged:
+                if (verbose): print("The values of",rule,"change the tags of the later anonymizers. Anonymizing the rest with one pass per anonymizer.")
+                if profile is not None: profile.add_time("tag_scan", _scan_time)
+                return [self.render(text, tags, text_values, n+1)[0] for text, tags, text_values in zip(texts, scanned, values)], n+1
+        _start=time.perf_counter()
+
+        new_texts=[self.render(text, tags, text_values, len(self._anonymizers))[0] if tags else text for text, tags, text_values in zip(texts, scanned, values)]
+        if profile is not None: profile.add_time("tag_scan", _scan_time+time.perf_counter()-_start)
+        return new_texts, len(self._anonymizers)
+
+    '''Return True if the texts with the values of the first n+1 anonymizers in them still have the tags of the later anonymizers that were found in the
+    original texts, in the same places and nothing else.  Only the texts that anonymizer n found tags in can have changed.'''
+    def later_tags_unchanged(self, n, texts, scanned, values, found):
+        if n+1==len(self._anonymizers): return True
+        for t in sorted(set(t for t, j, match in found)):
+            s, runs = self.render(texts[t], scanned[t], values[t], n+1)
+            starts=[start for start, original, length in runs]
+            later=[]
+            for k, match in self.scan(s):
+                #A tag that runs into a value was made by the value.
+                i=bisect.bisect_right(starts, match.start())-1
+                if i<0 or match.end()>runs[i][0]+runs[i][2]: return False
+                if k>n: later.append((k, runs[i][1]+match.start()-runs[i][0], match.end()-match.start()))
+            if later!=[(k, match.start(), match.end()-match.start()) for k, match in scanned[t] if k>n]: return False
+        return True
+
+    '''Return the text with the values of the tags of the first done anonymizers in place of the tags, and a list of (start, original start, length) of the
+    runs of the original text that it still contains.'''
+    def render(self, text, tags, text_values, done):
+        pieces=[]
+        runs=[]
+        last=0
+        size=0
+        for (k, match), value in zip(tags, text_values):
+            if k>=done: continue
+            if match.start()>last:
+                pieces.append(text[last:match.start()])
+                runs.append((size, last, match.start()-last))
+                size+=match.start()-last
+            pieces.append(value)
+            size+=len(value)
+            last=match.end()
+        if len(text)>last:
+            pieces.append(text[last:])
+            runs.append((size, last, len(text)-last))
+        return ''.join(pieces), runs
+
+'''Return a TagScanner for the (rule, model) pairs of the anonymizers, or None if the tags cannot all be found in a single pass with the same result as running the anonymizers one after another.'''
+def build_tag_scanner(anonymizers):
+    labels={}
+    literals={}
+    for k, (rule, model) in enumerate(anonymizers):
+        tags=model.scan_tags()
+        if tags is None: return None
+        #A value with a bracket can make a label for a later anonymizer, so it is not worth scanning for tags once.
+        if k<len(anonymizers)-1 and model.can_emit('[]'): return None
+        names, model_literals, indexed_only = tags
+        for name in names:
+            labels.setdefault((name, True), k)
+            if not indexed_only: labels.setdefault((name, False), k)
+        for literal, wordbreak in model_literals:
+            if literal=='' or '[' in literal or ']' in literal: return None
+            #A literal must not overlap a literal of another anonymizer.
+            for other, (j, parsed, other_wordbreak) in literals.items():
+                if other==literal and other_wordbreak!=wordbreak: return None
+                if j!=k and other!=literal and literals_overlap(literal, other): return None
+            literals.setdefault(literal, (k, parse_tag(literal), wordbreak))
+
+    #A literal must not be able to appear inside a label. Between word breaks it can only be a whole name or index.
+    names=set(name for name, has_index in labels)
+    if not names: return None
+    for literal, (k, parsed, wordbreak) in literals.items():
+        if not regex.fullmatch(r'[\w-]+', literal): continue
+        if not wordbreak: return None
+        if literal in names or regex.fullmatch(r'\d+', literal) or (parsed is not None and parsed[0] in names and regex.fullmatch(r'\d+', parsed[1])): return None
+    return TagScanner(anonymizers, labels, literals)
+
+'''Return True if an occurrence of string a can overlap an occurrence of string b.'''
+def literals_overlap(a, b):
+    if a in b or b in a: return True
+    return any(a.endswith(b[:n]) or b.endswith(a[:n]) for n in range(1, min(len(a), len(b))))
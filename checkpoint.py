@@ -0,0 +1,54 @@
+import os
+import pickle
+
+'''Module implementing the checkpoints used to resume a run that was interrupted.'''
+
+#The name of the checkpoint file in the checkpoint directory.
+CHECKPOINT_FILE="checkpoint.pkl"
+
+#The options that must be the same when a run is resumed for its output to be the same as an uninterrupted run.
+RESUME_OPTIONS=["inputfile", "outputfile", "inputformat", "outputformat", "modality", "level", "redact", "anonymize", "seed", "rulefile", "defaultrules",
+                "chunksize", "header", "column", "idcolumn", "columnname", "idcolumnname", "uppercase", "grouped", "entitymapcap", "entitymapspill",
+                "log", "streamlog", "chunkgather", "chunkoutstem", "workers", "regextimeout", "timeoutpolicy", "quarantinefile",
+                "large", "spacydisable"]
+
+## Checkpoint class ##
+
+# Saves and loads the state of a run in a checkpoint directory.  Each checkpoint replaces the previous one atomically
+# so that an interrupted run always leaves a complete checkpoint behind.
+class Checkpoint():
+    def __init__(self, directory):
+        self._directory=directory
+        self._filepath=os.path.join(directory, CHECKPOINT_FILE)
+
+    '''Save the state of the run.  The state is written to a temporary file which then replaces the checkpoint file.'''
+    def save(self, state):
+        os.makedirs(self._directory, exist_ok=True)
+        _tmp=self._filepath+".tmp"
+        with open(_tmp, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(_tmp, self._filepath)
+
+    '''Return the state saved in the checkpoint or None if there is no checkpoint.'''
+    def load(self):
+        if not os.path.exists(self._filepath): return None
+        with open(self._filepath, "rb") as f:
+            return pickle.load(f)
+
+    '''Remove the checkpoint once the run it belongs to has finished.'''
+    def remove(self):
+        if os.path.exists(self._filepath): os.remove(self._filepath)
+
+    @property
+    def filepath(self):
+        return self._filepath
+
+'''Return the values of the options that a resumed run must share with the run that saved the checkpoint.'''
+def resume_options(args):
+    options={name: getattr(args, name, None) for name in RESUME_OPTIONS}
+    #The entity count is kept by the pool with --workers and by the processor without, so a run can only be resumed the same way.
+    #The output does not depend on the number of workers, so that can change.
+    options["workers"]=args.workers is not None
+    return options
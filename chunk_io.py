@@ -0,0 +1,288 @@
+import os
+import io
+import shutil
+import gzip
+import bz2
+import lzma
+import queue
+import threading
+import collections
+import concurrent.futures
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+'''Module implementing the chunked reading and writing of input and output files in CSV, Parquet and Arrow IPC formats.'''
+
+#The file name extension used for each format, e.g. for chunked output files.
+FORMAT_EXTENSIONS={"csv": ".csv", "parquet": ".parquet", "arrow": ".arrow"}
+
+#The file name extensions of compressed CSV and log files.  Reading uses the same compression inferred by pandas.
+COMPRESSION_EXTENSIONS=[".gz", ".bz2", ".xz", ".zst"]
+
+'''Return the compression extension of a file name (e.g. '.gz') or '' if it is not compressed.'''
+def compression_extension(filepath):
+    _ext=os.path.splitext(filepath)[1].lower()
+    return _ext if _ext in COMPRESSION_EXTENSIONS else ''
+
+'''Return the path in directory of the output file of an input file, e.g. for --outputdir.  It has the name of the input file with the extension of the output format,
+and CSV output is compressed like the input file (e.g. calls.csv.gz gives calls.csv.gz, or calls.parquet with Parquet output).'''
+def output_filepath(directory, inputfile, fileformat="csv"):
+    name=os.path.basename(inputfile)
+    _compression=compression_extension(name)
+    name=os.path.splitext(name[:len(name)-len(_compression)])[0]
+    return os.path.join(directory, name+FORMAT_EXTENSIONS[fileformat]+(_compression if fileformat=="csv" else ""))
+
+'''Open a text file for reading ('r'), writing ('w') or appending ('a'), compressed according to its extension.
+level is the compression level, or None for the default of the compression library.  Appending to a compressed file adds a new compressed stream to it.'''
+def open_text(filepath, mode="r", level=None, encoding=None, newline=None):
+    _ext=compression_extension(filepath)
+    if _ext==".gz":
+        #Leave the time out of the gzip header so that the same output gives the same file.
+        _raw=gzip.GzipFile(filepath, mode+"b", compresslevel=(9 if level is None else level), mtime=0)
+        return io.TextIOWrapper(_raw, encoding=encoding, newline=newline)
+    elif _ext==".bz2":
+        return bz2.open(filepath, mode+"t", compresslevel=(9 if level is None else level), encoding=encoding, newline=newline)
+    elif _ext==".xz":
+        return lzma.open(filepath, mode+"t", preset=(level if mode!="r" else None), encoding=encoding, newline=newline)
+    elif _ext==".zst":
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("The zstandard package is needed to read or write "+str(filepath)+". Install it with: pip install zstandard")
+        _cctx=zstandard.ZstdCompressor(level=(3 if level is None else level)) if mode!="r" else None
+        return zstandard.open(filepath, mode+"t", cctx=_cctx, encoding=encoding, newline=newline)
+    else:
+        return open(filepath, mode, encoding=encoding, newline=newline)
+
+'''Return an iterator over the chunks of an input file as data frames of at most chunksize rows.
+The first skip rows are skipped, e.g. to resume a run from a checkpoint.'''
+def read_chunks(filepath, fileformat="csv", chunksize=100000, header=False, skip=0):
+    if fileformat=="csv":
+        if skip==0:
+            return pd.read_csv(filepath, chunksize=chunksize, header=(0 if header else None), dtype=str, keep_default_na=False)
+        #Skip the rows without parsing them.  The header is read first so that the columns keep their names.
+        names=list(pd.read_csv(filepath, nrows=0).columns) if header else None
+        return pd.read_csv(filepath, chunksize=chunksize, header=None, names=names, skiprows=skip+(1 if header else 0), dtype=str, keep_default_na=False)
+    elif fileformat=="parquet":
+        _file=pq.ParquetFile(filepath)
+        return arrow_chunks(_file.iter_batches(batch_size=chunksize), chunksize, skip, _file.schema_arrow)
+    elif fileformat=="arrow":
+        _schema, _batches = read_arrow_batches(filepath)
+        return arrow_chunks(_batches, chunksize, skip, _schema)
+    else:
+        raise ValueError("Unsupported input format: "+str(fileformat))
+
+'''Return the schema and an iterator over the record batches of an Arrow IPC file, or of an Arrow IPC stream if the file is not in the random access format.'''
+def read_arrow_batches(filepath):
+    try:
+        reader=pa.ipc.open_file(filepath)
+        return reader.schema, (reader.get_batch(i) for i in range(reader.num_record_batches))
+    except pa.ArrowInvalid:
+        reader=pa.ipc.open_stream(filepath)
+        return reader.schema, iter(reader)
+
+'''Regroup record batches into chunks of chunksize rows and yield each chunk as a data frame.
+The columns keep their Arrow types so that the columns that are not processed are written back unchanged.  The first skip rows are dropped.
+A file with no rows gives one empty chunk with the columns of schema, as pandas does for a CSV file, so that it still gives an output file.'''
+def arrow_chunks(batches, chunksize, skip=0, schema=None):
+    pending=[]
+    rows=0
+    #No empty chunk is given when resuming, as the chunks of the file have already been given.
+    empty=(skip==0)
+    for batch in batches:
+        if skip>0:
+            dropped=min(skip, batch.num_rows)
+            batch=batch.slice(dropped)
+            skip-=dropped
+        while batch.num_rows>0:
+            take=min(chunksize-rows, batch.num_rows)
+            pending.append(batch.slice(0, take))
+            rows+=take
+            batch=batch.slice(take)
+            if rows==chunksize:
+                yield pa.Table.from_batches(pending).to_pandas(types_mapper=pd.ArrowDtype)
+                pending=[]
+                rows=0
+                empty=False
+    if pending:
+        yield pa.Table.from_batches(pending).to_pandas(types_mapper=pd.ArrowDtype)
+    elif empty and schema is not None:
+        yield schema.empty_table().to_pandas(types_mapper=pd.ArrowDtype)
+
+'''Truncate a file to size bytes.'''
+def truncate(filepath, size):
+    with open(filepath, "r+b") as f:
+        f.truncate(size)
+
+## ChunkWriter class ##
+
+# Writes processed chunks to an output file one after another.  Parquet chunks are written as row groups and Arrow chunks as record batches
+# so the output is never held in memory.  The file can be rotated (closed and moved) to start a new file, e.g. for --chunkgather.
+# CSV files are compressed if their name ends in a compression extension (e.g. .csv.gz) and are kept open between chunks.
+class ChunkWriter():
+    def __init__(self, filepath, fileformat="csv", header=False, level=None):
+        if fileformat not in FORMAT_EXTENSIONS: raise ValueError("Unsupported output format: "+str(fileformat))
+        self._filepath=filepath
+        self._format=fileformat
+        self._header=header
+        self._level=level
+        self._writer=None
+        self._schema=None
+
+    '''Write a chunk.  If append is False a new file is started, otherwise the chunk is added to the current file (which is started if there is none).'''
+    def write(self, df, append=True):
+        if not append: self.close()
+        if self._format=="csv":
+            if self._writer is None:
+                self._writer=open_text(self._filepath, ("a" if append else "w"), self._level, encoding="utf-8", newline="")
+            df.to_csv(self._writer, index=False, header=(self._header and not append))
+            self._writer.flush()
+            return
+
+        table=self.to_table(df)
+        if self._writer is None:
+            if self._format=="parquet":
+                self._writer=pq.ParquetWriter(self._filepath, table.schema)
+            else:
+                self._writer=pa.ipc.new_file(self._filepath, table.schema)
+        self._writer.write_table(table)
+
+    '''Convert a chunk to an Arrow table with the same schema as the first chunk written, without the pandas metadata.'''
+    def to_table(self, df):
+        if self._schema is None:
+            #Arrow column names must be strings, e.g. the numbered columns of a CSV file without a header.
+            df=df.rename(columns=str)
+            table=pa.Table.from_pandas(df, preserve_index=False)
+            metadata={k:v for k,v in (table.schema.metadata or {}).items() if k!=b'pandas'}
+            self._schema=table.schema.with_metadata(metadata)
+        else:
+            df=df.set_axis(self._schema.names, axis=1)
+        return pa.Table.from_pandas(df, schema=self._schema, preserve_index=False).replace_schema_metadata(self._schema.metadata)
+
+    '''Finish the current file and move it to filepath.  The next chunk written starts a new file.'''
+    def rotate(self, filepath):
+        self.close()
+        shutil.move(self._filepath, filepath)
+
+    '''Finish the current CSV file so that it is complete on disk and return its size, for a checkpoint.  The next chunk is appended to it.
+Compressed files are appended to as a new compressed stream, which is read back as part of the same file.'''
+    def checkpoint(self):
+        if self._format!="csv": raise ValueError("Only CSV output can be checkpointed.")
+        self.close()
+        return os.path.getsize(self._filepath) if os.path.exists(self._filepath) else None
+
+    '''Return the file to the size saved in a checkpoint, discarding any chunks written after it.
+If the file was moved to rotated_path after the checkpoint it is moved back first.'''
+    def resume(self, size, rotated_path=None):
+        self.close()
+        if size is None: return
+        if not os.path.exists(self._filepath) and rotated_path is not None and os.path.exists(rotated_path):
+            shutil.move(rotated_path, self._filepath)
+        truncate(self._filepath, size)
+
+    '''Finish the current file.  Parquet, Arrow and compressed files are not complete until they are closed.'''
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer=None
+
+    @property
+    def extension(self):
+        return FORMAT_EXTENSIONS[self._format]+(compression_extension(self._filepath) if self._format=="csv" else "")
+
+## Prefetcher class ##
+
+# Reads the chunks of an input file in a background thread so that the next chunks are parsed while the current one is processed.
+# At most size chunks are read ahead.  An error raised while reading is raised again by the next call to next().
+class Prefetcher():
+    def __init__(self, chunks, size):
+        self._queue=queue.Queue(size)
+        self._stop=threading.Event()
+        self._done=False
+        self._thread=threading.Thread(target=self.read, args=(iter(chunks),), daemon=True)
+        self._thread.start()
+
+    '''Read the chunks into the queue until they run out or the prefetcher is closed.'''
+    def read(self, chunks):
+        try:
+            for chunk in chunks:
+                if not self.put(("chunk", chunk)): return
+        except Exception as e:
+            self.put(("error", e))
+            return
+        self.put(("end", None))
+
+    '''Add an item to the queue, waiting while it is full.  Return False if the prefetcher was closed while waiting.'''
+    def put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done: raise StopIteration
+        kind, value = self._queue.get()
+        if kind=="chunk": return value
+        self._done=True
+        if kind=="error": raise value
+        raise StopIteration
+
+    '''Stop reading, e.g. when --chunklimit stops the run before the end of the file.'''
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+## BackgroundWriter class ##
+
+# Wraps a ChunkWriter so that chunks are written in a background thread while the next chunk is processed.
+# The writes and rotations are done in order.  At most size of them wait to be done before write() blocks.
+# An error raised while writing is raised again by the next call that waits for it.
+class BackgroundWriter():
+    def __init__(self, writer, size):
+        self._writer=writer
+        self._size=size
+        self._executor=concurrent.futures.ThreadPoolExecutor(1)
+        self._pending=collections.deque()
+
+    '''Queue a call to run in the writer thread, first waiting for the oldest calls to finish if the queue is full.'''
+    def submit(self, fn, *args):
+        while len(self._pending)>=self._size:
+            self._pending.popleft().result()
+        self._pending.append(self._executor.submit(fn, *args))
+
+    '''Wait for all the queued calls to finish.'''
+    def wait(self):
+        while self._pending:
+            self._pending.popleft().result()
+
+    def write(self, df, append=True):
+        self.submit(self._writer.write, df, append)
+
+    def rotate(self, filepath):
+        self.submit(self._writer.rotate, filepath)
+
+    def checkpoint(self):
+        self.wait()
+        return self._writer.checkpoint()
+
+    def resume(self, size, rotated_path=None):
+        self.wait()
+        self._writer.resume(size, rotated_path)
+
+    def close(self):
+        try:
+            self.wait()
+            self._writer.close()
+        finally:
+            self._executor.shutdown()
+
+    @property
+    def extension(self):
+        return self._writer.extension
@@ -1,13 +1,37 @@
 import sys
+import collections
+import shelve
 
 class EntityMap():
-    def __init__(self):
-        self._emap={}
+    #cap: the maximum number of conversations to keep in memory. The least recently used conversations are evicted when there are more. None means no limit.
+    #spill_path: the path of an on-disk store to spill evicted conversations to, so that they are restored if the conversation is seen again. Only used with cap.
+    def __init__(self, cap=None, spill_path=None):
+        self._emap=collections.OrderedDict()
+        self._cap=cap
+        self._spill=None
+        if cap is not None and spill_path is not None:
+            self._spill=shelve.open(spill_path, flag='n')
+
+        #Approximate size statistics: [entries, bytes] for each conversation in memory, the totals, their peaks and the number of conversations evicted.
+        self._sizes={}
+        self._entries=0
+        self._bytes=0
+        self._peak_entries=0
+        self._peak_bytes=0
+        self._evicted=0
+
+    #Forget all the stored entities.
+    def clear(self):
+        self._emap.clear()
+        self._sizes.clear()
+        self._entries=0
+        self._bytes=0
+        if self._spill is not None: self._spill.clear()
 
     #Check and store aliases (e_val) for a key (e_ix) with for unique conversation_id(d_id) and entity category(e_cat) combinations.
     #During redaction:       e_ix=text,         d_id=conversaton_id, e_val=entity_index, e_cat=entity
     #During anonymization:   e_ix=entity_index, d_id=conversaton_id, e_val=entity_value, e_cat=entity
-    #Used to consistently replace words with index-numbers during redaction and then consistenly replace index-numers with redacted words during anonymization. 
+    #Used to consistently replace words with index-numbers during redaction and then consistenly replace index-numers with redacted words during anonymization.
     def update_entities(self, e_ix, d_id, e_val, e_cat="GLOBAL"):
         #e_ix: the key that we want to store this entity under (i.e. word or index-value)
         #d_id: conversation_id of the conversation to make the record unique to this conversation
@@ -15,11 +39,14 @@ class EntityMap():
         #e_cat: a category label to further make the entity store unique.
 
         if d_id not in self._emap:
-            self._emap[d_id]={}
+            self.add_conversation(d_id)
+        elif self._cap is not None:
+            self._emap.move_to_end(d_id)
         if e_cat not in self._emap[d_id]:
             self._emap[d_id][e_cat]={}
         if e_ix not in self._emap[d_id][e_cat]:
             self._emap[d_id][e_cat][e_ix]={}
+            self.add_size(d_id, 1, sys.getsizeof(e_ix)+sys.getsizeof(e_val))
         if bool(self._emap[d_id][e_cat][e_ix]):    # if we have an existing value in the self._emap, use it, otherwise use a new one and save it to the self._emap for context
             r = self._emap[d_id][e_cat][e_ix]
             #print("Match  ["+str(d_id)+"]["+str(e_cat)+"]["+str(e_ix)+"]=",r,file=sys.stderr)
@@ -29,3 +56,84 @@ class EntityMap():
             #print("Adding ["+str(d_id)+"]["+str(e_cat)+"]["+str(e_ix)+"]=",e_val,file=sys.stderr)
 
         return r
+
+    #Add a conversation to the map, restoring it from the spill store if it was evicted earlier, then evict the least recently used conversations if the map is over its cap.
+    def add_conversation(self, d_id):
+        conversation=None
+        if self._spill is not None:
+            conversation=self._spill.pop(str(d_id), None)
+        if conversation is None:
+            self._emap[d_id]={}
+            self._sizes[d_id]=[0,0]
+        else:
+            self._emap[d_id]=conversation
+            self._sizes[d_id]=[0,0]
+            for values in conversation.values():
+                for e_ix,e_val in values.items():
+                    self.add_size(d_id, 1, sys.getsizeof(e_ix)+sys.getsizeof(e_val))
+
+        if self._cap is not None:
+            while len(self._emap)>self._cap:
+                self.evict(next(iter(self._emap)))
+
+    #Remove a conversation from memory, spilling it to the on-disk store if there is one.
+    def evict(self, d_id):
+        conversation=self._emap.pop(d_id)
+        entries, nbytes = self._sizes.pop(d_id)
+        self._entries-=entries
+        self._bytes-=nbytes
+        self._evicted+=1
+        if self._spill is not None:
+            self._spill[str(d_id)]=conversation
+
+    #Close out every conversation except those in keep. Used when the input is grouped by conversation and the other conversations are complete.
+    def retain(self, keep):
+        for d_id in [d for d in self._emap if d not in keep]:
+            del self._emap[d_id]
+            entries, nbytes = self._sizes.pop(d_id)
+            self._entries-=entries
+            self._bytes-=nbytes
+            self._evicted+=1
+
+    #Add to the size statistics of a conversation and the totals and keep track of the peaks.
+    def add_size(self, d_id, entries, nbytes):
+        self._sizes[d_id][0]+=entries
+        self._sizes[d_id][1]+=nbytes
+        self._entries+=entries
+        self._bytes+=nbytes
+        if self._entries>self._peak_entries: self._peak_entries=self._entries
+        if self._bytes>self._peak_bytes: self._peak_bytes=self._bytes
+
+    #Return the contents of the map, including any spilled conversations, so that it can be saved in a checkpoint.
+    def get_state(self):
+        return {
+            "emap": self._emap,
+            "spilled": dict(self._spill) if self._spill is not None else {},
+            "sizes": self._sizes,
+            "totals": (self._entries, self._bytes, self._peak_entries, self._peak_bytes, self._evicted)
+        }
+
+    #Replace the contents of the map with a state returned by get_state().
+    def set_state(self, state):
+        self.clear()
+        self._emap.update(state["emap"])
+        if self._spill is not None: self._spill.update(state["spilled"])
+        self._sizes.update(state["sizes"])
+        self._entries, self._bytes, self._peak_entries, self._peak_bytes, self._evicted = state["totals"]
+
+    #Close the spill store if there is one.
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill=None
+
+    #Return a dictionary of statistics about the size of the map. The byte counts are approximate as they only include the keys and values.
+    def stats(self):
+        return {
+            "conversations": len(self._emap),
+            "entries": self._entries,
+            "bytes": self._bytes,
+            "peak_entries": self._peak_entries,
+            "peak_bytes": self._peak_bytes,
+            "evicted": self._evicted
+        }
@@ -1,27 +1,65 @@
 import os
 import csv
+import shutil
+import chunk_io as cio
 
 #A class to keep track of the replaced entity values for use in subsequent anonymization including restoring text where required.
 class EntityValues():
     def __init__(self):
         self._entity_values={}
 
+        #When streaming to a log, the keys added since the last write_new() and the index below which labels have already been logged.
+        self._unlogged=None
+        self._logged_below=0
+
+    def clear(self):
+        self._entity_values.clear()
+        if self._unlogged is not None: self._unlogged.clear()
+        self._logged_below=0
+
+    #Start keeping track of the values that have not yet been written to a streaming log.
+    def start_log(self):
+        self._unlogged=[]
+
     def get_value(self,id):
         return self._entity_values.get(id,None)
 
-    def set_value(self,id,value):
+    def set_value(self,id,value,logged=False):
         if id not in self._entity_values:
             self._entity_values[id] = value
+            if self._unlogged is not None and not logged: self._unlogged.append(id)
         
         return value
 
     def set_label_value(self,label,ix,value):
         newLabel = label+ "-"+str(ix)
-        self.set_value(newLabel,value)
+        #A label with an index below the watermark was logged before it was pruned so it is not logged again.
+        self.set_value(newLabel,value,int(ix)<self._logged_below)
         return newLabel
 
-    def write_csv(self, filepath):
-        a_file = open(filepath, "w")
+    #Write the values added since the last call to a streaming log.
+    def write_new(self, log):
+        log.write_rows([(key, self._entity_values[key]) for key in self._unlogged])
+        self._unlogged.clear()
+
+    #Forget the values once they have been logged.  Labels indexed below logged_below are not logged again if they are set again.
+    #Every label in a chunk is set again when the chunk is redacted so the restoration data is always available for the chunk being processed.
+    def forget(self, logged_below):
+        self._entity_values.clear()
+        self._logged_below=logged_below
+
+    #Return the values and the streaming log position so that they can be saved in a checkpoint.
+    def get_state(self):
+        return {"values": self._entity_values, "unlogged": self._unlogged, "logged_below": self._logged_below}
+
+    #Replace the values and the streaming log position with a state returned by get_state().
+    def set_state(self, state):
+        self._entity_values=dict(state["values"])
+        self._unlogged=None if state["unlogged"] is None else list(state["unlogged"])
+        self._logged_below=state["logged_below"]
+
+    def write_csv(self, filepath, level=None):
+        a_file = cio.open_text(filepath, "w", level)
         writer = csv.writer(a_file)
         for key, value in self._entity_values.items():
             writer.writerow([key, value])
@@ -31,4 +69,55 @@ class EntityValues():
         return self._entity_values
 
     def is_empty(self):
-        return self._entity_values=={}
\ No newline at end of file
+        return self._entity_values=={}
+
+#A log of entity values that is appended to as each chunk is processed, so that its size in memory does not grow with the input.
+#The log is compressed if the file name ends in a compression extension (e.g. .gz).  It is opened when the first rows are written.
+class EntityLog():
+    def __init__(self, filepath, level=None):
+        self._filepath=filepath
+        self._level=level
+        self._file=None
+        self._writer=None
+        #True once rows have been written to the current log, so that it is appended to if it is reopened.
+        self._started=False
+
+    def write_rows(self, rows):
+        if self._file is None:
+            self._file=cio.open_text(self._filepath, ("a" if self._started else "w"), self._level)
+            self._writer=csv.writer(self._file)
+            self._started=True
+        self._writer.writerows(rows)
+        self._file.flush()
+
+    #Close the log and move it to filepath.  The next rows written start a new log.
+    def rotate(self, filepath):
+        if self._started:
+            self.close()
+            shutil.move(self._filepath, filepath)
+            self._started=False
+
+    #Close the log so that it is complete on disk and return its size, for a checkpoint.  The log is appended to when the next rows are written.
+    def checkpoint(self):
+        self.close()
+        return os.path.getsize(self._filepath) if self._started else None
+
+    #Return the log to the size saved in a checkpoint, discarding anything written after it.
+    #If the log was moved to rotated_path after the checkpoint it is moved back first.
+    def resume(self, size, rotated_path=None):
+        self.close()
+        self._started=size is not None
+        if size is None: return
+        if not os.path.exists(self._filepath) and rotated_path is not None and os.path.exists(rotated_path):
+            shutil.move(rotated_path, self._filepath)
+        cio.truncate(self._filepath, size)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file=None
+            self._writer=None
+
+    @property
+    def compression_extension(self):
+        return cio.compression_extension(self._filepath)
@@ -0,0 +1,163 @@
+import os
+import sys
+import math
+import mmap
+import array
+import struct
+import hashlib
+import pandas as pd
+
+'''Module implementing a registry of the phrase lists loaded from CSV files (e.g. data/street-names.csv) by the phrase redactors and anonymizers.
+Each list is loaded once per process and held compactly as one string buffer and an array of offsets.  Lists can also be cached in binary files that
+are memory mapped, so that later runs do not parse the CSV files and processes using the same cache (e.g. --workers) share one copy of each list.'''
+
+#The first bytes of a phrase cache file.  The version is increased if the format changes.
+CACHE_MAGIC=b"REDPHR1\n"
+
+#The header of a phrase cache file after the magic bytes: the number of phrases, the number of missing values and the size of the buffer in bytes.
+_HEADER=struct.Struct("=qqq")
+
+#The kinds of missing value (empty CSV cells) that are kept so that the list gives back the same values as the list read by pandas.
+_MISSING_KINDS=[float('nan'), None]
+
+#The phrase lists loaded by this process, keyed by the file, header, field and column they were loaded from.
+_registry={}
+
+## PhraseList class ##
+
+# A read-only sequence of phrases stored in one buffer with the start of each phrase in an array of offsets.  Values that are not strings are stored as
+# their str() apart from missing values (NaN or None), which are kept as they are.  Supports len(), indexing and iteration so that it can be used by
+# random.choice() like a list.  The buffer is either a str or a memory mapped UTF-8 cache file.
+class PhraseList():
+    def __init__(self, buffer, offsets, missing, mapped=None):
+        self._buffer=buffer
+        self._offsets=offsets
+        self._missing=missing
+        self._mapped=mapped
+        self._count=len(offsets)-1
+
+    '''Return a PhraseList of a list of values.'''
+    @classmethod
+    def from_values(cls, values):
+        parts=[]
+        offsets=array.array('q', [0])
+        missing={}
+        size=0
+        for i, value in enumerate(values):
+            kind=missing_kind(value)
+            if kind is not None:
+                missing[i]=kind
+            else:
+                value=str(value)
+                parts.append(value)
+                size+=len(value)
+            offsets.append(size)
+        return cls(''.join(parts), offsets, missing)
+
+    '''Return a PhraseList that reads a cache file written by write() through a memory map.'''
+    @classmethod
+    def open(cls, filepath):
+        with open(filepath, "rb") as f:
+            mapped=mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mapped[:len(CACHE_MAGIC)]!=CACHE_MAGIC:
+            mapped.close()
+            raise ValueError(f"{filepath} is not a phrase cache file.")
+        view=memoryview(mapped)
+        start=len(CACHE_MAGIC)
+        count, nmissing, size = _HEADER.unpack_from(mapped, start)
+        start+=_HEADER.size
+        offsets=view[start:start+8*(count+1)].cast('q')
+        start+=8*(count+1)
+        pairs=view[start:start+16*nmissing].cast('q')
+        missing={pairs[2*k]: pairs[2*k+1] for k in range(nmissing)}
+        start+=16*nmissing
+        return cls(view[start:start+size], offsets, missing, mapped)
+
+    '''Write the list to a cache file that can be read by open().  The file is written to a temporary file first so that a cache file is always complete.'''
+    def write(self, filepath):
+        encoded=[]
+        offsets=array.array('q', [0])
+        size=0
+        for i in range(self._count):
+            if i not in self._missing:
+                value=self[i].encode('utf-8')
+                encoded.append(value)
+                size+=len(value)
+            offsets.append(size)
+        pairs=array.array('q', [n for i, kind in sorted(self._missing.items()) for n in (i, kind)])
+
+        _tmp=f"{filepath}.{os.getpid()}.tmp"
+        with open(_tmp, "wb") as f:
+            f.write(CACHE_MAGIC)
+            f.write(_HEADER.pack(self._count, len(self._missing), size))
+            f.write(offsets.tobytes())
+            f.write(pairs.tobytes())
+            f.write(b''.join(encoded))
+        os.replace(_tmp, filepath)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if not isinstance(i, int): raise TypeError("PhraseList indices must be integers")
+        if i<0: i+=self._count
+        if i<0 or i>=self._count: raise IndexError("PhraseList index out of range")
+        if i in self._missing: return _MISSING_KINDS[self._missing[i]]
+        value=self._buffer[self._offsets[i]:self._offsets[i+1]]
+        return value if self._mapped is None else str(value, 'utf-8')
+
+    def __iter__(self):
+        return (self[i] for i in range(self._count))
+
+    '''Return True if any of the phrases contains one of the characters.  Missing values are given as 'nan' or 'None' by str() so they do not.'''
+    def contains_any(self, chars):
+        if self._mapped is not None: return any(self._mapped.find(c.encode('utf-8'))>=0 for c in chars)
+        return any(c in self._buffer for c in chars)
+
+    '''Return the phrases as a list.'''
+    def to_list(self):
+        return list(self)
+
+'''Return the index in _MISSING_KINDS of a missing value, or None if the value is not missing.'''
+def missing_kind(value):
+    if value is None: return 1
+    if isinstance(value, float) and math.isnan(value): return 0
+    return None
+
+'''Read the values of a column of a CSV file as a list.  The column is chosen by its field name or, if there is no field name, by its number.
+With header=None the file has no header row.'''
+def read_column(filepath, field=None, column=0, header=0):
+    _df = pd.read_csv(filepath, header=header)
+    if field is None:
+        return (_df.iloc[:,column]).to_list()
+    return _df[field].to_list()
+
+'''Return the path of the cache file of a phrase list.  The name includes the size and modification time of the CSV file so that the list is loaded again if the file changes.'''
+def cache_filepath(cache_dir, key):
+    filepath=key[0]
+    stat=os.stat(filepath)
+    digest=hashlib.sha1(repr((key, stat.st_size, stat.st_mtime_ns, sys.byteorder)).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{os.path.splitext(os.path.basename(filepath))[0]}-{digest}.phrases")
+
+'''Return the phrase list in a column of a CSV file, loading it the first time it is asked for.  With cache_dir the list is read from a cache file in that
+directory if there is one, otherwise it is loaded from the CSV file and the cache file is written.'''
+def load_phrase_list(filepath, field=None, column=0, header=0, cache_dir=None):
+    key=(os.path.abspath(filepath), header, field, column)
+    phrases=_registry.get(key, None)
+    if phrases is not None: return phrases
+
+    cache_path=None
+    if cache_dir is not None:
+        cache_path=cache_filepath(cache_dir, key)
+        if os.path.exists(cache_path):
+            try:
+                phrases=PhraseList.open(cache_path)
+            except (ValueError, struct.error):
+                print(f"WARNING: Ignoring the invalid phrase cache file {cache_path}.", file=sys.stderr)
+    if phrases is None:
+        phrases=PhraseList.from_values(read_column(key[0], field, column, header))
+        if cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            phrases.write(cache_path)
+    _registry[key]=phrases
+    return phrases
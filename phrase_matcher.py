@@ -0,0 +1,106 @@
+import bisect
+import regex
+
+'''Module implementing a phrase matcher that finds phrases from very large phrase lists without building a regular expression alternation.'''
+
+#A character that sorts after any character that can appear in a phrase. Used to find the end of the range of phrases that share a prefix.
+_MAX_CHAR='\U0010ffff'
+
+'''Case-fold a string one character at a time so that the folded string has the same length and offsets as the original.'''
+def fold(s):
+    f=s.casefold()
+    if len(f)==len(s): return f
+    return ''.join([c.casefold() if len(c.casefold())==1 else c for c in s])
+
+## PhraseMatch class ##
+
+# A phrase found by a PhraseMatcher.  Supports the parts of the regex match object interface used by the redactors.
+class PhraseMatch():
+    def __init__(self, string, start, end):
+        self._string=string
+        self._start=start
+        self._end=end
+
+    def group(self, *groups):
+        return self._string[self._start:self._end]
+
+    def captures(self, *groups):
+        return [self.group()]
+
+    def start(self, *groups):
+        return self._start
+
+    def end(self, *groups):
+        return self._end
+
+    def span(self, *groups):
+        return (self._start, self._end)
+
+    def __repr__(self):
+        return f'<PhraseMatch span=({self._start}, {self._end}), match={self.group()!r}>'
+
+## PhraseMatcher class ##
+
+# Matches a list of literal phrases against text.  The phrases are case-folded (if IGNORECASE is set) and held in a sorted list that is searched as an implicit trie,
+# so the cost of matching depends on the length of the text and not on the number of phrases.  The matches found are the same as a regular expression made from
+# the alternation of the escaped phrases with an optional word break before and after, i.e. \b((phrase1)|(phrase2)|...)\b.
+class PhraseMatcher():
+    '''Build the matcher from a list of phrases.  wordbreak=True requires a word break before and after each phrase. Only the IGNORECASE, ASCII and LOCALE flags are used.'''
+    def __init__(self, phrases, wordbreak=True, flags=regex.IGNORECASE):
+        self._wordbreak=wordbreak
+        self._ignorecase=bool(flags & regex.IGNORECASE)
+        self._boundary=regex.compile(r'\b', flags & (regex.ASCII | regex.LOCALE))
+
+        #Keep the position of the first occurrence of each phrase as a regular expression alternation prefers the earliest alternative that matches.
+        _first={}
+        for i,p in enumerate(phrases):
+            if not isinstance(p,str) or p=='': continue
+            k=self.fold(p)
+            if k not in _first: _first[k]=i
+        self._phrases=sorted(_first)
+        self._order=[_first[p] for p in self._phrases]
+        self._max_len=max((len(p) for p in self._phrases), default=0)
+        self._first_chars=frozenset(p[0] for p in self._phrases)
+
+    def fold(self, s):
+        return fold(s) if self._ignorecase else s
+
+    '''Return an iterator over the non-overlapping leftmost matches of the phrases in string s.  timeout is accepted for compatibility with regex patterns and is not
+    needed as the time taken only grows with the length of the string.'''
+    def finditer(self, s, timeout=None):
+        t=self.fold(s)
+        phrases=self._phrases
+        n=len(t)
+        if self._wordbreak:
+            ends=set(m.start() for m in self._boundary.finditer(s))
+            starts=sorted(ends)
+        else:
+            ends=None
+            starts=range(n)
+
+        last=0
+        for p in starts:
+            if p<last or p>=n or t[p] not in self._first_chars: continue
+
+            #Narrow the range of phrases that start with the text at p one character at a time, and keep the earliest phrase that ends at a valid position.
+            best=None
+            lo=0
+            hi=len(phrases)
+            for e in range(p+1, min(n, p+self._max_len)+1):
+                prefix=t[p:e]
+                lo=bisect.bisect_left(phrases, prefix, lo, hi)
+                hi=bisect.bisect_left(phrases, prefix+_MAX_CHAR, lo, hi)
+                if lo>=hi: break
+                if phrases[lo]==prefix and (ends is None or e in ends):
+                    if best is None or self._order[lo]<best[0]: best=(self._order[lo], e)
+
+            if best is not None:
+                yield PhraseMatch(s, p, best[1])
+                last=best[1]
+
+    '''Return the first match in string s or None.'''
+    def search(self, s):
+        return next(self.finditer(s), None)
+
+    def __len__(self):
+        return len(self._phrases)
@@ -0,0 +1,411 @@
+import os
+import csv
+import time
+import json
+import collections
+import regex
+import entity_rules as er
+import anonymize as anon
+
+#Redaction labels of the form [LABEL-n].  Used to find the labels given provisional indexes while texts are redacted for the memo cache.
+REDACT_LABEL_RE=regex.compile(r'\[([^\[\]]+)-(\d+)\]')
+
+#The first provisional index given to the labels of texts redacted for the memo cache.  It is far above any index a run reaches so that they cannot be confused.
+PROVISIONAL_BASE=10**12
+
+## Pipeline class ##
+
+# An ordered set of configured redactor and anonymizer models that is built once per run and reused for every chunk.
+class Pipeline():
+    '''Construct an empty pipeline. The models are not created until build() is called.  With a Profile the work done by each model is recorded in it.'''
+    def __init__(self, entity_rules, profile=None):
+        self._entity_rules=entity_rules
+        self._profile=profile
+        self._redactors=[]
+        self._anonymizers=[]
+        self._scanner=None
+        self._build_time=0.0
+
+        #With --memocache the redaction of each distinct text is recorded so that repeated texts skip the redactors.
+        _size=entity_rules.args.memocache
+        self._memo=MemoCache(_size) if _size else None
+
+        #The texts that the models gave up on because their regular expressions timed out (--regextimeout).
+        self._quarantine=Quarantine(entity_rules.args.quarantinefile, entity_rules.args.resume)
+
+    '''Instantiate and configure a model for each rule in the redaction and anonymization orders, binding them to the shared entity maps and values.'''
+    # redaction_order: the ordered list of entity ids to redact.
+    # anonymization_order: the ordered list of entity ids to anonymize.
+    # redact_entity_map, anon_entity_map: the entity maps shared by all redactors and all anonymizers respectively.
+    # entity_values: the store of redacted values shared by the redactors and anonymizers.
+    def build(self, redaction_order, anonymization_order, redact_entity_map, anon_entity_map, entity_values):
+        _start=time.perf_counter()
+        self._redactors=self.build_models(redaction_order, "redactor", redact_entity_map, entity_values)
+        self._anonymizers=self.build_models(anonymization_order, "anonymizer", anon_entity_map, entity_values)
+
+        #Find the tags of all the anonymizers in a single pass over each text if they can be told apart.
+        self._scanner=anon.build_tag_scanner(self._anonymizers)
+        if (self._entity_rules.args.verbose) and self._anonymizers and self._scanner is None: print("Anonymizing with one pass per anonymizer.")
+        self._build_time=time.perf_counter()-_start
+        return self
+
+    '''Return a list of (rule, model) pairs for the rules in order. Rules that are not supported for this modality are skipped.'''
+    def build_models(self, order, model_type, entity_map, entity_values):
+        _models=[]
+        for rule in order:
+            try:
+                _start=time.perf_counter()
+                _model=self._entity_rules.get_model(rule, model_type, entity_map, entity_values)
+                _models.append((rule, _model))
+                if self._profile is not None: self._profile.add_model(model_type, rule, _model, time.perf_counter()-_start)
+            except(er.NotSupportedException) as e:
+                if (self._entity_rules.args.verbose): print("Skipping ",rule,"...")
+        return _models
+
+    '''Run the redactors in order over the texts.'''
+    def redact(self, texts, eCount, ids):
+        if self._memo is not None: return self.redact_memo(texts, eCount, ids)
+        for rule, model in self._redactors:
+            if (self._entity_rules.args.verbose): print("Redacting ",rule,"...")
+            if self._profile is None:
+                texts, eCount, ids = model.redact(texts, eCount, ids)
+            else:
+                _start, _count, _rejected = time.perf_counter(), eCount, model.rejected
+                texts, eCount, ids = model.redact(texts, eCount, ids)
+                self._profile.add("redactor", rule, time.perf_counter()-_start, texts=len(texts), labels=eCount-_count, rejected=model.rejected-_rejected)
+            self.quarantine_timeouts(rule, "redactor", model, ids)
+        return texts, eCount, ids
+
+    '''Redact the texts using the memo cache.  Each distinct text that is not in the cache is redacted once by record() to find its redaction recipe.
+    Then the labels of every text are allocated from the recipes in the order the redactors would allocate them, i.e. for each redactor in turn for each
+    text in turn, so that the labels are numbered and the entity maps are updated exactly as they would be without the cache.'''
+    def redact_memo(self, texts, eCount, ids):
+        recipes=[self._memo.get(text) for text in texts]
+        missing=collections.OrderedDict()
+        for i, recipe in enumerate(recipes):
+            if recipe is None: missing.setdefault(texts[i], []).append(i)
+        hits=len(texts)-sum(len(ix) for ix in missing.values())
+
+        if missing:
+            for text, recipe in zip(missing, self.record(list(missing))):
+                self._memo.put(text, recipe)
+                for i in missing[text]: recipes[i]=recipe
+
+        #Texts that timed out when they were recorded are quarantined every time they are seen, as they would be without the cache.
+        for recipe, d_id in zip(recipes, ids):
+            for rule, action, length in recipe.timeouts:
+                self._quarantine.add(d_id, "redactor", rule, action, length)
+
+        labels=[[] for _ in texts]
+        for r, (rule, model) in enumerate(self._redactors):
+            _start, _count = time.perf_counter(), eCount
+            for recipe, d_id, text_labels in zip(recipes, ids, labels):
+                for label, value in recipe.allocations[r]:
+                    newLabel, eCount = model.allocate_redactlabel(label, value, d_id, eCount)
+                    text_labels.append(newLabel)
+            if self._profile is not None: self._profile.add("redactor", rule, time.perf_counter()-_start, labels=eCount-_count)
+
+        self._memo.add_counts(len(texts), hits)
+        if (self._entity_rules.args.verbose): print(f"Memo cache: {hits} of {len(texts)} texts found, {len(missing)} distinct texts redacted.")
+        return [recipe.fill(text_labels) for recipe, text_labels in zip(recipes, labels)], eCount, ids
+
+    '''Run the redactors over distinct texts and return the RedactRecipe of each one.  The labels are given provisional indexes instead of being allocated from the
+    entity maps, and the position of each text in the list is passed as its conversation id so that the labels can be attributed to the texts they were found in.'''
+    def record(self, texts):
+        recorder=LabelRecorder(len(texts))
+        positions=list(range(len(texts)))
+        timeouts=[[] for _ in texts]
+        eCount=PROVISIONAL_BASE
+        for rule, model in self._redactors:
+            if (self._entity_rules.args.verbose): print("Redacting ",rule,"...")
+            _start, _rejected = time.perf_counter(), model.rejected
+            previous=model.bind_entities(recorder, recorder)
+            try:
+                texts, eCount, positions = model.redact(texts, eCount, positions)
+            finally:
+                model.bind_entities(*previous)
+            recorder.next_redactor()
+            for j, action, length in model.take_timeouts(): timeouts[j].append((rule, action, length))
+            if self._profile is not None: self._profile.add("redactor", rule, time.perf_counter()-_start, texts=len(texts), rejected=model.rejected-_rejected)
+        return [recorder.recipe(j, text, timeouts[j]) for j, text in enumerate(texts)]
+
+    '''Run the anonymizers in order over the texts.'''
+    def anonymize(self, texts, ids):
+        #The scanner runs the anonymizers it can and leaves the rest to be run one after another.
+        _done=0
+        if self._scanner is not None:
+            texts, _done = self._scanner.anonymize(texts, ids, self._entity_rules.args.verbose, self._profile)
+
+        for rule, model in self._anonymizers[_done:]:
+            if (self._entity_rules.args.verbose): print("Anonymizing ",rule,"...")
+            if self._profile is None:
+                texts=model.anonymize(texts, ids)
+            else:
+                _start, _matches = time.perf_counter(), model.matches
+                texts=model.anonymize(texts, ids)
+                self._profile.add("anonymizer", rule, time.perf_counter()-_start, texts=len(texts), matches=model.matches-_matches)
+            self.quarantine_timeouts(rule, "anonymizer", model, ids)
+        return texts
+
+    '''Quarantine the texts that a model could not match within the regex timeout.'''
+    def quarantine_timeouts(self, rule, model_type, model, ids):
+        for i, action, length in model.take_timeouts():
+            self._quarantine.add(ids[i], model_type, rule, action, length)
+
+    '''Close every model in the pipeline so that any resources they hold (e.g. worker processes) are released.'''
+    def close(self):
+        for rule, model in self._redactors+self._anonymizers:
+            model.close()
+
+    @property
+    def redactors(self):
+        return self._redactors
+
+    @property
+    def anonymizers(self):
+        return self._anonymizers
+
+    @property
+    def build_time(self):
+        '''Return the time in seconds taken to build the models.'''
+        return self._build_time
+
+    @property
+    def memo(self):
+        return self._memo
+
+    @property
+    def quarantine(self):
+        return self._quarantine
+
+## Memo cache classes ##
+
+# The redaction of a text found by the redactors, without the label indexes.  This is what the memo cache keeps so that a repeated text can be redacted
+# without running the redactors again, while its labels are still allocated from the entity maps of its own conversation.
+class RedactRecipe():
+    #allocations: a list for each redactor of the (label, value) pairs it allocated labels for, in the order it allocated them.
+    #parts, slots: the redacted text split around its labels.  slots[k] is the position, in the order of allocation, of the label between parts[k] and parts[k+1].
+    #timeouts: the (rule, action, length) of each redactor that timed out on the text.
+    def __init__(self, allocations, parts, slots, timeouts=()):
+        self.allocations=allocations
+        self.parts=parts
+        self.slots=slots
+        self.timeouts=timeouts
+
+    '''Return the redacted text with the labels allocated for this occurrence of the text, in the order of allocation.'''
+    def fill(self, labels):
+        if not self.slots: return self.parts[0]
+        _text=[self.parts[0]]
+        for slot, part in zip(self.slots, self.parts[1:]):
+            _text.append(labels[slot])
+            _text.append(part)
+        return ''.join(_text)
+
+# Stands in for the entity map and entity values of the redactors while texts are redacted for the memo cache.  It records the labels allocated for each text
+# and gives them provisional indexes, which are unique so that each label in the redacted text can be matched to the allocation it came from.
+class LabelRecorder():
+    def __init__(self, count):
+        self._redactor=0
+        self._allocations=[[[]] for _ in range(count)]
+        self._counts=[0]*count
+        #The text and position in the order of allocation of each provisional index.
+        self._provisional={}
+
+    '''Record a label allocated by a redactor and return its provisional index.  d_id is the position of the text being redacted.'''
+    def update_entities(self, e_ix, d_id, e_val, e_cat="GLOBAL"):
+        self._allocations[d_id][self._redactor].append((e_cat, e_ix))
+        self._provisional[e_val]=(d_id, self._counts[d_id])
+        self._counts[d_id]+=1
+        return e_val
+
+    def set_label_value(self, label, ix, value):
+        return label+"-"+str(ix)
+
+    '''Start recording the labels of the next redactor.'''
+    def next_redactor(self):
+        self._redactor+=1
+        for allocations in self._allocations: allocations.append([])
+
+    '''Return the RedactRecipe of the text at position j from its redacted text and the timeouts of the redactors on it.'''
+    def recipe(self, j, text, timeouts=()):
+        parts=[]
+        slots=[]
+        last=0
+        for m in REDACT_LABEL_RE.finditer(text):
+            position=self._provisional.get(int(m.group(2)), None)
+            if position is None or position[0]!=j: continue
+            parts.append(text[last:m.start()])
+            slots.append(position[1])
+            last=m.end()
+        parts.append(text[last:])
+        return RedactRecipe(self._allocations[j][:self._redactor], parts, slots, timeouts)
+
+# A least recently used cache of the RedactRecipe of each text, holding at most size texts.  The cache belongs to a pipeline, which is built for one
+# modality and redaction level, so a text on its own is the key.
+class MemoCache():
+    def __init__(self, size):
+        self._size=size
+        self._recipes=collections.OrderedDict()
+        self._texts=0
+        self._hits=0
+
+    def get(self, text):
+        recipe=self._recipes.get(text, None)
+        if recipe is not None: self._recipes.move_to_end(text)
+        return recipe
+
+    def put(self, text, recipe):
+        self._recipes[text]=recipe
+        if len(self._recipes)>self._size: self._recipes.popitem(last=False)
+
+    '''Add to the number of texts redacted and the number of them found in the cache.'''
+    def add_counts(self, texts, hits):
+        self._texts+=texts
+        self._hits+=hits
+
+    '''Return a dictionary of statistics about the use of the cache.'''
+    def stats(self):
+        return {
+            "texts": self._texts,
+            "hits": self._hits,
+            "hit_rate": self._hits/self._texts if self._texts else 0.0,
+            "size": len(self._recipes)
+        }
+
+## Quarantine class ##
+
+# The texts that a redactor or anonymizer gave up on because a regular expression did not finish within the timeout (--regextimeout), and what was done
+# with them.  The records are written to the --quarantinefile by flush(), which is called once each chunk is written so that the file keeps up with the run.
+class Quarantine():
+    COLUMNS=["conversation_id", "model_type", "rule", "action", "length"]
+
+    '''Construct an empty quarantine.  With append the records are added to an existing file, e.g. when a run is resumed.'''
+    def __init__(self, filepath=None, append=False):
+        self._filepath=filepath
+        self._append=append
+        self._pending=[]
+        self._count=0
+
+    '''Quarantine a text of a conversation.  action is what the model did with the text: skipped, truncated or redacted.'''
+    def add(self, conversation_id, model_type, rule, action, length):
+        self._pending.append((conversation_id, model_type, rule, action, length))
+        self._count+=1
+
+    '''Add records returned by flush() in another process, e.g. a --workers worker.'''
+    def extend(self, records):
+        self._pending.extend(records)
+        self._count+=len(records)
+
+    '''Write the records added since the last flush to the file, if there is one, and return them.  The file is created by the first flush, even if it is empty,
+    so that a file left by an earlier run is not mistaken for the quarantine of this one.'''
+    def flush(self):
+        records=self._pending
+        self._pending=[]
+        if self._filepath is None: return records
+        _new=not (self._append and os.path.exists(self._filepath))
+        if not records and not _new: return records
+        with open(self._filepath, "w" if _new else "a", newline="") as f:
+            writer=csv.writer(f)
+            if _new: writer.writerow(self.COLUMNS)
+            writer.writerows(records)
+        self._append=True
+        return records
+
+    '''Return the size of the file, which is what resume() truncates it back to.'''
+    def checkpoint(self):
+        if self._filepath is None or not os.path.exists(self._filepath): return 0
+        return os.path.getsize(self._filepath)
+
+    '''Truncate the file back to a size returned by checkpoint(), removing the records written after the checkpoint of a resumed run.'''
+    def resume(self, size):
+        if self._filepath is None or not os.path.exists(self._filepath): return
+        if size==0:
+            os.remove(self._filepath)
+            return
+        with open(self._filepath, "r+") as f:
+            f.truncate(size)
+
+    @property
+    def count(self):
+        return self._count
+
+## Profile class ##
+
+# Records the work done by each redactor and anonymizer (build time, processing time, texts scanned, matches found, labels inserted and
+# matches rejected because they overlap a redaction label) and the time spent in the other stages of a run, e.g. reading, cleaning and writing.
+class Profile():
+    #The counts recorded for each model.  Matches found by a redactor are the labels it inserted plus the matches it rejected.
+    COUNTS=["seconds", "texts", "matches", "labels", "rejected"]
+
+    '''Construct an empty profile.  With per_chunk the counts for each chunk are kept as well as the totals.'''
+    def __init__(self, per_chunk=False):
+        self._models=collections.OrderedDict()
+        self._stages=collections.OrderedDict()
+        self._chunks=[] if per_chunk else None
+        self._chunk_models=collections.defaultdict(lambda: dict.fromkeys(self.COUNTS, 0))
+        self._chunk_stages=collections.defaultdict(float)
+        self._rows=0
+
+    '''Add a model to the profile with the time it took to build.'''
+    def add_model(self, model_type, rule, model, build_seconds):
+        entry={"rule": rule, "model": type(model).__module__+"."+type(model).__name__, "build_seconds": build_seconds}
+        entry.update(dict.fromkeys(self.COUNTS, 0))
+        self._models[(model_type, rule)]=entry
+
+    '''Add to the counts of a model.'''
+    def add(self, model_type, rule, seconds, texts=0, matches=0, labels=0, rejected=0):
+        counts={"seconds": seconds, "texts": texts, "matches": matches+labels+rejected, "labels": labels, "rejected": rejected}
+        entry=self._models[(model_type, rule)]
+        for name, value in counts.items(): entry[name]+=value
+        if self._chunks is not None:
+            entry=self._chunk_models[(model_type, rule)]
+            for name, value in counts.items(): entry[name]+=value
+
+    '''Add to the time spent in a stage that is not a model, e.g. "read", "clean" or "write".'''
+    def add_time(self, stage, seconds):
+        self._stages[stage]=self._stages.get(stage, 0.0)+seconds
+        if self._chunks is not None: self._chunk_stages[stage]+=seconds
+
+    '''Return an iterator over items that adds the time taken to get each item to a stage.'''
+    def timed(self, stage, items):
+        items=iter(items)
+        while True:
+            _start=time.perf_counter()
+            item=next(items, None)
+            self.add_time(stage, time.perf_counter()-_start)
+            if item is None: return
+            yield item
+
+    '''Record the end of a chunk of rows rows.'''
+    def end_chunk(self, chunk, rows):
+        self._rows+=rows
+        if self._chunks is None: return
+        self._chunks.append({
+            "chunk": chunk,
+            "rows": rows,
+            "stage_seconds": dict(self._chunk_stages),
+            "redactors": {rule: counts for (model_type, rule), counts in self._chunk_models.items() if model_type=="redactor"},
+            "anonymizers": {rule: self.anonymizer_counts(counts) for (model_type, rule), counts in self._chunk_models.items() if model_type=="anonymizer"}
+        })
+        self._chunk_models.clear()
+        self._chunk_stages.clear()
+
+    '''Return the profile as a dictionary.  Labels and rejected matches only apply to redactors.'''
+    def report(self):
+        _report={
+            "rows": self._rows,
+            "stage_seconds": dict(self._stages),
+            "redactors": [entry for (model_type, rule), entry in self._models.items() if model_type=="redactor"],
+            "anonymizers": [self.anonymizer_counts(entry) for (model_type, rule), entry in self._models.items() if model_type=="anonymizer"]
+        }
+        if self._chunks is not None: _report["chunks"]=self._chunks
+        return _report
+
+    '''Return the counts of an anonymizer without the counts that only apply to redactors.'''
+    def anonymizer_counts(self, counts):
+        return {k: v for k, v in counts.items() if k not in ("labels", "rejected")}
+
+    '''Write the profile to a JSON file.'''
+    def write(self, filepath):
+        with open(filepath, "w") as f:
+            json.dump(self.report(), f, indent=2)
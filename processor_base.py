@@ -1,5 +1,6 @@
 import regex
 import os
+import concurrent.futures
 
 ## ProcessorBase class and helper functions ##
 
@@ -10,6 +11,8 @@ class ProcessorBase():
         self._entity_rules=entity_rules
         self._params={}
         self._id=id
+        #The texts that could not be matched within the regex timeout since take_timeouts() was last called.
+        self._timeouts=[]
      
     '''Virtual function defining what a configuration call should look like.'''
     # params: a dictionary of specific parameters that are relevant to this processor.
@@ -21,6 +24,20 @@ class ProcessorBase():
         #A processor takes a set of conversation records as a pandas data frame, manipulates them and returns them.
         return df
 
+    '''Record that the text at index i of the texts being processed could not be matched within the regex timeout, the action taken and the length of the text.'''
+    def record_timeout(self, i, action, length):
+        self._timeouts.append((i, action, length))
+
+    '''Return the (index, action, length) of the texts that timed out since the last call and forget them.'''
+    def take_timeouts(self):
+        timeouts=self._timeouts
+        self._timeouts=[]
+        return timeouts
+
+    '''Virtual function to release any resources held by the processor once processing is finished.'''
+    def close(self):
+        pass
+
     '''takes a path and returns the absolute path. If the path is relative then use the current working directory as the anchor unless the string starts with $REDACT_HOME in which case use the location of the redactomatic file which can be overriden by the environment variable REDACT_HOME.'''
     def absolute_path(self,path):
         if os.path.isabs(path):
@@ -35,30 +52,77 @@ class ProcessorBase():
             else:
                 return os.path.join(os.getcwd(),path)
 
+## CleanProcessor class ##
+
+# Processor that tidies up the text after redaction and anonymization and optionally converts it to uppercase.
+# The texts can be cleaned in a pool of threads as the regex module releases the GIL while it matches with concurrent=True.
+class CleanProcessor(ProcessorBase):
+    def __init__(self,id,entity_rules):
+        self._threads=1
+        self._uppercase=False
+        self._executor=None
+        super().__init__(id, entity_rules)
+
+    '''Configure the processor.  params may contain "threads" (the number of threads to clean with) and "uppercase" (convert the texts to uppercase).'''
+    def configure(self, params):
+        super().configure(params)
+        self._threads=params.get("threads",1) or 1
+        self._uppercase=params.get("uppercase",False)
+        if self._threads>1:
+            self._executor=concurrent.futures.ThreadPoolExecutor(self._threads)
+
+    '''Clean the text column of a data frame.'''
+    def process(self,df):
+        column=self._entity_rules.args.column-1
+        df.iloc[:, column]=self.clean_texts(df.iloc[:, column].tolist())
+        return df
+
+    '''Clean a list of texts and return the new list.'''
+    def clean_texts(self,texts):
+        if self._executor is None or len(texts)<2*self._threads:
+            texts=clean(texts)
+            if self._uppercase: texts=convert_to_uppercase(texts)
+            return texts
+
+        #Clean contiguous slices of the texts in parallel and put them back together in order.
+        size=-(-len(texts)//self._threads)
+        slices=[texts[i:i+size] for i in range(0, len(texts), size)]
+        new_texts=[]
+        for cleaned in self._executor.map(self.clean_slice, slices):
+            new_texts.extend(cleaned)
+        return new_texts
+
+    def clean_slice(self,texts):
+        texts=clean(texts)
+        if self._uppercase: texts=convert_to_uppercase(texts)
+        return texts
+
+    '''Shut down the thread pool if there is one.'''
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor=None
+
 # Helper functions - These can be refactored as processors operating on the text field at a later date. 
 
+# Cleanup patterns, compiled once when the module is loaded.
+CLEAN_DOTDOT = regex.compile(r'\.\.\.')
+CLEAN_SPACES = regex.compile(r'\s+')
+CLEAN_UNKNOWN = regex.compile(r'\<UNK\>')
+# Put a space between adjacent labels (][), a word and a following label (word[) and a label and a following word (]word).
+# The three cases insert a space at different positions and cannot create one another so they are handled in a single pass.
+CLEAN_LABEL_SPACE = regex.compile(r'(?<=\]|\w)(?=\[)|(?<=\])(?=\w)')
+
+def clean_text(text):
+    #Only run the patterns that can match.
+    if '...' in text: text = CLEAN_DOTDOT.sub('', text, concurrent=True)
+    text = CLEAN_SPACES.sub(' ', text, concurrent=True)
+    if '<UNK>' in text: text = CLEAN_UNKNOWN.sub('', text, concurrent=True)
+    if '[' in text or ']' in text: text = CLEAN_LABEL_SPACE.sub(' ', text, concurrent=True)
+    return text.strip()
+
 def clean(texts):
-    spaces = regex.compile('\s+')
-    dotdot = regex.compile(r'\.\.\.')
-    unknown = regex.compile(r'\<UNK\>')
-    add_space = regex.compile(r'(\]\[)')
-    add_space2 = regex.compile(r'((\w+)\[)')
-    add_space3 = regex.compile(r'(\](\w+))')
-    new_texts = []
-    for text in texts:
-        new_text = dotdot.sub('', text, concurrent=True)
-        new_text = spaces.sub(' ', new_text, concurrent=True)
-        new_text = unknown.sub('', new_text, concurrent=True)
-        new_text = add_space.sub('] [', new_text, concurrent=True)
-        new_text = add_space2.sub(r'\2 [', new_text, concurrent=True)
-        new_text = add_space3.sub(r'] \2', new_text, concurrent=True)
-        new_text = new_text.strip()
-        new_texts.append(new_text)
-    return new_texts
+    return [clean_text(text) for text in texts]
 
 def convert_to_uppercase(texts):
-    new_texts=[]
-    for text in texts:
-        new_text = text.upper()
-        new_texts.append(new_text)
-    return new_texts
\ No newline at end of file
+    return [text.upper() for text in texts]
@@ -1,12 +1,94 @@
 import os
-import spacy
-import pandas as pd
 import entity_rules as er
 import processor_base as pb
 import sys
 import regex_utils as ru
+import phrase_matcher as pm
+import phrase_data as pdata
 import json
 import yaml
+import multiprocessing
+import bisect
+
+## Helper functions ##
+
+'''Return the first value that is not None.'''
+def first_defined(*values):
+    for v in values:
+        if v is not None: return v
+    return None
+
+#spaCy models that have already been loaded by this process, keyed by model name and disabled pipes.
+_spacy_models={}
+
+#The spaCy pipeline components that are not needed for named entity recognition and are disabled by default.
+SPACY_DEFAULT_DISABLE=["tagger", "parser", "lemmatizer"]
+
+#What a regex redactor does with a text that one of its patterns cannot match within the timeout:
+#  skip     - the pattern is not matched on the text.
+#  truncate - the text is cut to truncate-length characters and matched again.  If that also times out the text is redacted.
+#  redact   - the whole text is replaced with a single label of the rule.
+TIMEOUT_POLICIES=["skip","truncate","redact"]
+
+#The number of characters the truncate policy keeps, unless the rule sets truncate-length.
+TRUNCATE_LENGTH=10000
+
+'''Load a spaCy model once per process and keep it warm with the listed pipeline components disabled.'''
+def load_spacy_model(name, disable):
+    key=(name, tuple(disable))
+    nlp=_spacy_models.get(key,None)
+    if nlp is None:
+        #spaCy is slow to import so it is only imported when a spaCy redactor is built, not by runs that do not use one.
+        import spacy
+        nlp=spacy.load(name)
+        nlp.select_pipes(disable=[p for p in disable if p in nlp.pipe_names])
+        _spacy_models[key]=nlp
+    return nlp
+
+'''Run the model over the texts and return a list of (label, start_char, text) entity tuples for each text.'''
+def get_spacy_entities(nlp, texts, batch_size):
+    return [[(e.label_, e.start_char, e.text) for e in doc.ents] for doc in nlp.pipe(texts, batch_size=batch_size)]
+
+#The model used by a spaCy worker process.  This is set once by init_spacy_worker() when the worker starts.
+_spacy_worker_nlp=None
+
+'''Initialise a spaCy worker process by loading the model once.'''
+def init_spacy_worker(name, disable):
+    global _spacy_worker_nlp
+    _spacy_worker_nlp=load_spacy_model(name, disable)
+
+'''Return the entities for a batch of texts using the model loaded in this worker process.'''
+def spacy_worker_entities(texts):
+    return get_spacy_entities(_spacy_worker_nlp, texts, len(texts))
+
+## Protected zone index ##
+
+#A sorted index of the redaction labels (e.g. [PHONE-12]) already in a string so that matches can be checked against them in logarithmic rather than linear time.
+class RedactLabelZones():
+    '''Build the index from the redaction label matches in string s.'''
+    def __init__(self, s, label_ru):
+        self._starts=[]
+        self._ends=[]
+        self._labels=[]
+        for e in label_ru.finditer(s):
+            self._starts.append(e.start())
+            self._ends.append(e.end())
+            self._labels.append(e.group())
+
+    '''Return the index of the zone containing position p or -1 if there is none.'''
+    def find(self, p):
+        i=bisect.bisect_right(self._starts, p)-1
+        if i>=0 and p<self._ends[i]: return i
+        return -1
+
+    '''Check whether the first or last character between indexes start and end is in a protected zone, and return the text of the overlapped label if there is one.  This gives the same result as RedactorBase.overlaps_redactlabel_span().'''
+    def overlaps(self, start, end):
+        i=max(self.find(start), self.find(end-1))
+        if i<0: return False,''
+        return True,self._labels[i]
+
+    def __len__(self):
+        return len(self._starts)
 
 ## Redactor classes ##
 
@@ -19,6 +101,8 @@ class RedactorBase(pb.ProcessorBase):
     def __init__(self,id,entity_rules):
         self._entity_map=None
         self._entity_values=None
+        #The number of matches that were not redacted because they overlap a redaction label, for --profile.
+        self._rejected=0
         super().__init__(id, entity_rules)
      
     '''Virtual function defining what a configuration call should look like.'''
@@ -71,14 +155,52 @@ class RedactorBase(pb.ProcessorBase):
                 overlapped_label=z[2]
         return is_overlapping,overlapped_label
     
+    '''Replace the entity map and entity values that labels are allocated from and return the previous ones.  Used by the memo cache to record the labels of a text.'''
+    def bind_entities(self, entity_map, entity_values):
+        previous=(self._entity_map, self._entity_values)
+        self._entity_map=entity_map
+        self._entity_values=entity_values
+        return previous
+
+    @property
+    def rejected(self):
+        return self._rejected
+
+    '''Return an index of the protected zones in the string that contain redaction labels.'''
+    def get_redactlabel_zones(self,s):
+        return RedactLabelZones(s, self.REDACT_LABEL_RU)
+
     '''Insert the supplied label with a unique index into string s to replace the the string index between start and end.  Also update the entity store with the value and increment the unique index.'''
     def insert_redactlabel_and_update_entities(self, s, start, end, label, value, conversation_id, eCount):                         
+        newLabel, eCount = self.allocate_redactlabel(label, value, conversation_id, eCount)
+        s = s[:start] + newLabel + s[end:]
+        
+        return s,eCount
+
+    '''Return the bracketed redaction label with a unique index for value (e.g. [PHONE-12]).  Also update the entity store with the value and increment the unique index.'''
+    def allocate_redactlabel(self, label, value, conversation_id, eCount):
         ix = self._entity_map.update_entities(value,conversation_id,eCount,label)
         newLabel=self._entity_values.set_label_value(label,ix,value)
-        s = s[:start] + "[" + newLabel + "]" + s[end:]
         eCount += 1
-        
-        return s,eCount
+
+        return "[" + newLabel + "]", eCount
+
+    '''Replace the spans in string s with their labels in a single join.  spans is a list of (start, end, label) tuples in the order they were found, from the end of the string to the start.'''
+    def apply_redactlabel_spans(self, s, spans):
+        parts=[]
+        last=len(s)
+        for start, end, label in spans:
+            #If the spans overlap then replace them one at a time, which is what inserting each label in turn would do.
+            if end>last:
+                for start, end, label in spans:
+                    s = s[:start] + label + s[end:]
+                return s
+            parts.append(s[end:last])
+            parts.append(label)
+            last=start
+        parts.append(s[:last])
+        parts.reverse()
+        return ''.join(parts)
     
 class RedactorRegex(RedactorBase):
     def __init__(self,id, entity_rules):
@@ -86,6 +208,9 @@ class RedactorRegex(RedactorBase):
         self._group = 1      
         self._pattern_set =[]
         self._flags= 0
+        self._timeout=None
+        self._timeout_policy="redact"
+        self._truncate_length=TRUNCATE_LENGTH
         super().__init__(id, entity_rules)
 
     '''Helper function returning a regex from parameter group looking for either regex:, regex-id, or regex-filename.'''
@@ -108,6 +233,38 @@ class RedactorRegex(RedactorBase):
                 raise er.EntityRuleConfigException("ERROR: No regex, regex-id or regex-filename defined in: "+str(self._id))
         return default
 
+    '''Set the time each pattern may take to match a text, and what to do with a text that takes longer, from the timeout, timeout-policy and truncate-length
+    parameters, defaulting to the --regextimeout and --timeoutpolicy options.'''
+    def configure_timeout(self, model_params):
+        args=self._entity_rules.args
+        self._timeout=first_defined(model_params.get("timeout",None), args.regextimeout)
+        self._timeout_policy=first_defined(model_params.get("timeout-policy",None), args.timeoutpolicy)
+        self._truncate_length=model_params.get("truncate-length",TRUNCATE_LENGTH)
+        if self._timeout is not None and (not isinstance(self._timeout,(int,float)) or self._timeout<=0):
+            raise er.EntityRuleConfigException("ERROR: The timeout must be a number of seconds more than 0 in: "+str(self._id))
+        if self._timeout_policy not in TIMEOUT_POLICIES:
+            raise er.EntityRuleConfigException("ERROR: Unknown timeout-policy '"+str(self._timeout_policy)+"' in: "+str(self._id)+". Use one of "+", ".join(TIMEOUT_POLICIES)+".")
+        if not isinstance(self._truncate_length,int) or self._truncate_length<1:
+            raise er.EntityRuleConfigException("ERROR: truncate-length must be a positive integer in: "+str(self._id))
+
+    '''Helper function compiling a list of phrases for the phrase redactors using the engine chosen by the 'engine' parameter.  The 'regex' engine (the default) combines the phrases into regular expressions with the prematch and postmatch regexes.  The 'trie' engine matches the phrases literally using a phrase_matcher.PhraseMatcher, whose cost does not grow with the number of phrases.'''
+    def compile_phrase_set(self, model_params, phrase_list, pre_regex, post_regex):
+        _flags=ru.flags_from_array(model_params.get("flags",["IGNORECASE"]),ru.EngineType.REGEX)
+        _engine=model_params.get("engine","regex")
+        if _engine=="trie":
+            if model_params.get("prematch",None) is not None or model_params.get("postmatch",None) is not None:
+                raise er.EntityRuleConfigException("ERROR: prematch and postmatch are not supported by the trie engine in: "+str(self._id))
+            self._pattern_set=[pm.PhraseMatcher(phrase_list, model_params.get("add-wordbreak",True), _flags)]
+        elif _engine=="regex":
+            _single_regex=model_params.get("combine-sets",True)
+            try:
+                self._pattern_set=ru.compile_set(phrase_list,pre_regex,post_regex,_single_regex,_flags,ru.EngineType.REGEX)
+            except Exception as exc:
+                print(f'WARNING: Failed to compile regex set for {self._id} with error: {str(exc)}')
+                print(f'ABANDONING: {self._id}')
+        else:
+            raise er.EntityRuleConfigException("ERROR: Unknown phrase engine '"+str(_engine)+"' in: "+str(self._id)+". Use 'regex' or 'trie'.")
+
     def configure(self, params, entity_map, entity_values):
         #Call the base class configurator.
         super().configure(params, entity_map, entity_values)
@@ -125,11 +282,16 @@ class RedactorRegex(RedactorBase):
         _regex_set=self.get_regex_set_from_params(_model_params)
         self._group=_model_params.get("group",1)     
 
+        self.configure_timeout(_model_params)
+
         #Now compile the regex_set ready for redaction.
         _flags=ru.flags_from_array(_model_params.get("flags",["IGNORECASE"]),ru.EngineType.REGEX)
         _single_regex=_model_params.get("single-regex",True)
+
+        #Expand subroutine calls in place unless the group to redact is numbered, as the numbering of the expanded groups can't be checked.
+        _inline=_model_params.get("inline-subroutines",True) and (isinstance(self._group,str) or self._group==1)
         try:
-            self._pattern_set=ru.compile_set(_regex_set,single_regex=_single_regex, flags=_flags, etype=ru.EngineType.REGEX)
+            self._pattern_set=ru.compile_set(_regex_set,single_regex=_single_regex, flags=_flags, etype=ru.EngineType.REGEX, inline=_inline, keep=[self._group])
         except Exception as exc:
             print(f'WARNING: Failed to compile regex set for {self._id} with error: {str(exc)}')
             print(f'ABANDONING: {self._id}')
@@ -137,15 +299,34 @@ class RedactorRegex(RedactorBase):
     #Supports more than one regular expressions and runs each one, even if a prevoius one found a match.
     def redact(self, texts, eCount, ids):
         new_texts = []
-        for text, d_id in zip(texts,ids):
+        for i, (text, d_id) in enumerate(zip(texts,ids)):
             newString = text
             for pattern in self._pattern_set:
+                #Find the entities matching in the string
+                matches = self.find_matches(pattern, newString)
+                if matches is None:
+                    #The pattern did not finish within the timeout so apply the timeout policy of the rule.
+                    if self._timeout_policy=="skip":
+                        self.record_timeout(i, "skipped", len(text))
+                        continue
+                    if self._timeout_policy=="truncate":
+                        truncated=self.truncate_text(newString)
+                        if len(truncated)<len(newString):
+                            matches=self.find_matches(pattern, truncated)
+                            newString=truncated
+                    if matches is None:
+                        #Redact the text as it is now so that the labels already added by this rule stay in the value logged for the new label.
+                        self.record_timeout(i, "redacted", len(text))
+                        newString, eCount = self.allocate_redactlabel(self._id, newString, d_id, eCount)
+                        break
+                    self.record_timeout(i, "truncated", len(text))
+                if not matches: continue
+
                 #Find all the existing entity labels in the string.
-                protect_zones=self.get_redactlabel_spans(newString)
+                protect_zones=self.get_redactlabel_zones(newString)
 
-                #Find the entities matching in the string
-                matches = list(pattern.finditer(newString))
-                for e in reversed(matches): #reversed to not modify the offsets of other entities when substituting
+                spans=[]
+                for e in reversed(matches): #reversed so that the labels are numbered in the same order as they always have been
                     #name=entity-text found by pattern
                     if self._group != 1 and e.captures(self._group):
                             name = e.captures(self._group)[0]
@@ -156,13 +337,37 @@ class RedactorRegex(RedactorBase):
                     end = start + len(name)
                     
                     #Check if we have matched part of an entity label, and add the redaction label if we are not.
-                    is_overlapping,overlapped_label=self.overlaps_redactlabel_span(start,end,protect_zones)
+                    is_overlapping,overlapped_label=protect_zones.overlaps(start,end)
                     if not is_overlapping:
-                        newString, eCount=self.insert_redactlabel_and_update_entities(newString, start, end, self._id, name, d_id, eCount)   
+                        newLabel, eCount=self.allocate_redactlabel(self._id, name, d_id, eCount)
+                        spans.append((start, end, newLabel))
+                    else:
+                        self._rejected+=1
+
+                #Now build the redacted string in one go.
+                if spans: newString=self.apply_redactlabel_spans(newString, spans)
 
             new_texts.append(newString)
         return new_texts, eCount, ids
 
+    '''Return a list of the matches of a pattern in string s, or None if the pattern did not finish within the timeout.'''
+    def find_matches(self, pattern, s):
+        if self._timeout is None: return list(pattern.finditer(s))
+        try:
+            return list(pattern.finditer(s, timeout=self._timeout))
+        except TimeoutError:
+            return None
+
+    '''Return string s cut to at most truncate-length characters, at the last space before the cut if there is one and never inside a redaction label.'''
+    def truncate_text(self, s):
+        if len(s)<=self._truncate_length: return s
+        cut=self._truncate_length
+        space=s.rfind(' ',0,cut)
+        if space>0: cut=space
+        bracket=s.rfind('[',0,cut)
+        if bracket>s.rfind(']',0,cut): cut=bracket
+        return s[:cut]
+
 class RedactorPhraseList(RedactorRegex):
     def __init__(self, id, entity_rules):
         self._phrase_list=None
@@ -201,14 +406,10 @@ class RedactorPhraseList(RedactorRegex):
         #print(f'preregex: {str(_pre_regex)}')
         #print(f'postregex: {str(_post_regex)}')
 
-        #Load the phrase list depending on how it is specified.
+        #Load the phrase list depending on how it is specified.  Lists loaded from files are shared with the other rules that use the same file.
         if (_phrase_list is None) and  (_phrase_filename is not None):
-            if _phrase_header is None:  _df = pd.read_csv(self.absolute_path(_phrase_filename), Header=None)
-            else: _df = pd.read_csv(self.absolute_path(_phrase_filename))
-            if _phrase_field is None:
-                _phrase_list=(_df.iloc[:,_phrase_column]).to_list()
-            else:
-                _phrase_list=_df[_phrase_field].to_list()
+            _phrase_list=pdata.load_phrase_list(self.absolute_path(_phrase_filename), _phrase_field, _phrase_column, (None if _phrase_header is None else 0),
+                                                self._entity_rules.args.phrasecache).to_list()
         
         #If the list is ok then add it to the phrase list set.
         if (not isinstance(_phrase_list,list)) or len(_phrase_list)==0:
@@ -217,14 +418,9 @@ class RedactorPhraseList(RedactorRegex):
         #Debug
         #print("RedactorPhraseList.configure()._phrase_list:",self._phrase_list,file=sys.stderr)
 
-        #Now compile the regex_set, default to add-wordbreaks=True and a combine-sets=True for efficiency.
-        _flags=ru.flags_from_array(_model_params.get("flags",["IGNORECASE"]),ru.EngineType.REGEX)
-        _single_regex=_model_params.get("combine-sets",True)
-        try:
-            self._pattern_set=ru.compile_set(_phrase_list,_pre_regex,_post_regex,_single_regex,_flags,ru.EngineType.REGEX)
-        except Exception as exc:
-            print(f'WARNING: Failed to compile regex set for {self._id} with error: {str(exc)}')
-            print(f'ABANDONING: {self._id}')
+        #Now compile the phrase list, default to add-wordbreaks=True and a combine-sets=True for efficiency.
+        self.configure_timeout(_model_params)
+        self.compile_phrase_set(_model_params, _phrase_list, _pre_regex, _post_regex)
 
 
 class RedactorPhraseDict(RedactorRegex):
@@ -327,60 +523,95 @@ class RedactorPhraseDict(RedactorRegex):
         #Debug
         #print("RedactorPhraseList.configure()._phrase_list:",_phrase_list,file=sys.stderr)
 
-        #Now compile the regex_set, default to add-wordbreaks=True and a combine-sets=True for efficiency.
-        _flags=ru.flags_from_array(_model_params.get("flags",["IGNORECASE"]),ru.EngineType.REGEX)
-        _single_regex=_model_params.get("combine-sets",True)
-        try:
-            self._pattern_set=ru.compile_set(_phrase_list,_pre_regex,_post_regex,_single_regex,_flags,ru.EngineType.REGEX)
-        except Exception as exc:
-            print(f'WARNING: Failed to compile regex set for {self._id} with error: {str(exc)}')
-            print(f'ABANDONING: {self._id}')
+        #Now compile the phrase list, default to add-wordbreaks=True and a combine-sets=True for efficiency.
+        self.configure_timeout(_model_params)
+        self.compile_phrase_set(_model_params, _phrase_list, _pre_regex, _post_regex)
 
 class RedactorSpacy(RedactorBase):
     def __init__(self,id, entity_rules):
+        self._model_name="en_core_web_sm"
+        self._n_process=4
+        self._batch_size=1000
+        self._disable=SPACY_DEFAULT_DISABLE
+        self._nlp=None
+        self._pool=None
         super().__init__(id, entity_rules)
-        
+
+    def configure(self, params, entity_map, entity_values):
+        #Call the base class configurator.
+        super().configure(params, entity_map, entity_values)
+        args=self._entity_rules.args
+
+        #Command line options take precedence over the parameters in the rules, which take precedence over the defaults.
+        self._model_name="en_core_web_lg" if args.large else "en_core_web_sm"
+        self._n_process=first_defined(args.spacyprocesses, params.get("n-process",None), self._n_process)
+        self._batch_size=first_defined(args.spacybatchsize, params.get("batch-size",None), self._batch_size)
+        self._disable=first_defined(args.spacydisable, params.get("disable",None), self._disable)
+
+        #Load the model once so that it stays warm for every chunk.  If more than one process is requested then start a persistent pool of workers that each load the model once.
+        if self._n_process>1:
+            self._pool=multiprocessing.Pool(self._n_process, initializer=init_spacy_worker, initargs=(self._model_name, self._disable))
+        else:
+            self._nlp=load_spacy_model(self._model_name, self._disable)
+
+    '''Shut down the worker pool if one was started.'''
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool=None
+
+    '''Return a list of (label, start_char, text) entity tuples for each text using the warm model or the worker pool.'''
+    def get_entities(self, texts):
+        if self._pool is None:
+            return get_spacy_entities(self._nlp, texts, self._batch_size)
+        batches=[texts[i:i+self._batch_size] for i in range(0, len(texts), self._batch_size)]
+        return [ents for batch in self._pool.imap(spacy_worker_entities, batches) for ents in batch]
+
     #was ner_ml()
     def redact(self, texts, eCount, ids):
-        from spacy.lang.en import English
         spacy_multiword_labels = ["PERSON"]
-        if self._entity_rules.args.large:
-            nlp = spacy.load("en_core_web_lg")
-        else:
-            nlp = spacy.load("en_core_web_sm")
         new_texts = []
 
         #Spacy version of the_redactor function...
-        for doc, d_id in zip(nlp.pipe(texts, disable=["tagger", "parser", "lemmatizer"], n_process=4, batch_size=1000),ids):
-            newString = doc.text
-            protect_zones=self.get_redactlabel_spans(newString)
- 
-            for e in reversed(doc.ents): #reversed to not modify the offsets of other entities when substituting
-                # redact if the recognized entity is in the list of entities from the config.json file            
-                if e.label_ in self._entity_rules.entities:
-                    name = e.text
+        for newString, ents, d_id in zip(texts, self.get_entities(texts), ids):
+            protect_zones=self.get_redactlabel_zones(newString)
+            spans=[]
+
+            for label, start_char, name in reversed(ents): #reversed so that the labels are numbered in the same order as they always have been
+                # redact if the recognized entity is in the list of entities from the config.json file
+                if label in self._entity_rules.entities:
                     value = name
                     # split name if we have a first and last name ( [PERSON] )
-                    if e.label_ in spacy_multiword_labels and " " in name:
+                    if label in spacy_multiword_labels and " " in name:
                         broken = name.split()
                         for i,n, in enumerate(reversed(broken)):
                             i = len(broken)-1 -i
                             name = n
-                            start = e.start_char + sum([len(w)+1 for w in broken[:i]])
+                            start = start_char + sum([len(w)+1 for w in broken[:i]])
                             end = start + len(name)
 
                             #If the matched item is not in a protected zone (i.e a redaction label) then redact it.
-                            is_overlapping,overlapped_label=self.overlaps_redactlabel_span(start,end,protect_zones)
+                            is_overlapping,overlapped_label=protect_zones.overlaps(start,end)
                             if not is_overlapping:
-                                newString, eCount=self.insert_redactlabel_and_update_entities(newString, start, end, e.label_, name, d_id, eCount)   
+                                newLabel, eCount=self.allocate_redactlabel(label, name, d_id, eCount)
+                                spans.append((start, end, newLabel))
+                            else:
+                                self._rejected+=1
                     else:
-                        start = e.start_char
+                        start = start_char
                         end = start + len(name)
 
                         #If the matched item is not in a protected zone (i.e a redaction label) then redact it.
-                        is_overlapping,overlapped_label=self.overlaps_redactlabel_span(start,end,protect_zones)
+                        is_overlapping,overlapped_label=protect_zones.overlaps(start,end)
                         if not is_overlapping:
-                            newString, eCount=self.insert_redactlabel_and_update_entities(newString, start, end, e.label_, name, d_id, eCount)   
+                            newLabel, eCount=self.allocate_redactlabel(label, name, d_id, eCount)
+                            spans.append((start, end, newLabel))
+                        else:
+                            self._rejected+=1
+
+            #Now build the redacted string in one go.
+            if spans: newString=self.apply_redactlabel_spans(newString, spans)
             newString = newString.replace('$','')
             new_texts.append(newString)
         return new_texts, eCount, ids
@@ -441,21 +672,30 @@ class RedactorTokenMap(RedactorBase):
                         #We won't bother adding an index or incrementing the eCount becuase this is a generic match not a specific match.
                         if pattern is not None:
                             #print(f'RedactorTokenMap.redact(). TOKEN_PATTERN={pattern}',file=sys.stderr)
-                            #Find all the existing entity labels in the string.
-                            protect_zones=self.get_redactlabel_spans(new_text)
-
                             #Find the entities matching in the string
                             matches = list(pattern.finditer(new_text))
-                            for e in reversed(matches): #reversed to not modify the offsets of other entities when substituting
+                            if not matches: continue
+
+                            #Find all the existing entity labels in the string.
+                            protect_zones=self.get_redactlabel_zones(new_text)
+
+                            spans=[]
+                            for e in reversed(matches): #reversed so that the labels are numbered in the same order as they always have been
                                 matched_text = e.group()
                                 start = e.span()[0]
                                 end = start + len(matched_text)
 
                                 #Check if we have matched part of an entity label, and add the redaction label if we are not.
-                                is_overlapping,overlapped_label=self.overlaps_redactlabel_span(start,end,protect_zones)
+                                is_overlapping,overlapped_label=protect_zones.overlaps(start,end)
                                 if not is_overlapping:
-                                    #Parameters: s, start, end, label, value, conversation_id, eCount):       
-                                    new_text, eCount=self.insert_redactlabel_and_update_entities(new_text, start, end, type, matched_text, d_id, eCount)
+                                    #Parameters: label, value, conversation_id, eCount):       
+                                    newLabel, eCount=self.allocate_redactlabel(type, matched_text, d_id, eCount)
+                                    spans.append((start, end, newLabel))
+                                else:
+                                    self._rejected+=1
+
+                            #Now build the redacted string in one go.
+                            if spans: new_text=self.apply_redactlabel_spans(new_text, spans)
 
                     #if new_text != text: print(f'CHANGED: \'{text}\' => \'{new_text}\'')
             except Exception as e:
@@ -5,12 +5,21 @@ import processor_base as pb
 import entity_map as em
 import entity_rules as er
 import entity_values as ev
+import pipeline as pl
 import regex_test as rt
 import sys
 import os
 import traceback
 import redact
-import shutil
+import time
+import copy
+import collections
+import itertools
+import multiprocessing
+import regex
+import chunk_io as cio
+import checkpoint as cpt
+import server as srv
 
 def __version__():
     return "1.23"
@@ -26,12 +35,17 @@ def str_to_bool(value):
         return True
     raise ValueError(f'{value} is not a valid boolean value')
 
-def config_args(): # add --anonymize
+'''Return the parser of the command line options.'''
+def create_parser():
     parser = argparse.ArgumentParser(description='Redact call transcriptions or chat logs.')
     parser.add_argument('--column', type=int, required=False, help='the CSV column number containing the text to redact.')
     parser.add_argument('--idcolumn', type=int, required=False, help='the CSV column number containing the conversation ids.')
     parser.add_argument('--inputfile', nargs='+', required=False, help='CSV input files(s) to redact')
     parser.add_argument('--outputfile', required=False, help='CSV output files')
+    parser.add_argument('--outputdir', required=False, default=None, help='Write the output of each input file to its own file in this directory, named after the input file. With --workers the chunks of several files are processed at once. Any --outputfile gets all the output as well, in input order. (default=None i.e. all the output goes to --outputfile)')
+    parser.add_argument('--inputformat', required=False, default='csv', choices=['csv', 'parquet', 'arrow'], help='the format of the input file(s): csv, parquet or arrow (Arrow IPC). (default=csv)')
+    parser.add_argument('--outputformat', required=False, default=None, choices=['csv', 'parquet', 'arrow'], help='the format of the output file(s): csv, parquet or arrow (Arrow IPC). (default=the input format)')
+    parser.add_argument('--compresslevel', type=int, required=False, default=None, help='The compression level of compressed output and log files, whose compression is chosen by their extension (.gz, .bz2, .xz or .zst). (default=the default of the compression library)')
     parser.add_argument('--modality', required=False, choices=['text', 'voice'], help='the modality of the input file(s), either text or voice')
     parser.add_argument('--redact', action='store_true', default=True, help='turn on redaction (default=true)')
     parser.add_argument('--no-redact',   dest='redact', action='store_false', help='turn off redaction')
@@ -41,14 +55,33 @@ def config_args(): # add --anonymize
     parser.add_argument('--defaultrules', action='store_true', default=True, help='Load the default rules. Use --rules to specify additional rules. (default=true)')
     parser.add_argument('--no-defaultrules', dest='defaultrules',  action='store_false', help='Do not load the default rules.  Use --rules to specify all rules.')
     parser.add_argument('--large', action='store_true', help='use the spacy model trained on a larger dataset')
+    parser.add_argument('--spacyprocesses', type=int, required=False, default=None, help='The number of worker processes used by the spacy NER stage. Use 1 to run in-process. Overrides n-process in the rules. (default=4)')
+    parser.add_argument('--spacybatchsize', type=int, required=False, default=None, help='The number of texts in each batch passed to the spacy NER stage. Overrides batch-size in the rules. (default=1000)')
+    parser.add_argument('--spacydisable', nargs='*', required=False, default=None, help='The spacy pipeline components to disable. Overrides disable in the rules. (default=tagger parser lemmatizer)')
     parser.add_argument('--log', required=False, help='logs entities that have been redacted to separate file')
+    parser.add_argument('--streamlog', action='store_true', default=False, help='Append the redacted entities to the --log file after each chunk instead of holding them all in memory until the end. Compressed with gzip if the log file name ends in .gz. (default=False)')
+    parser.add_argument('--profile', type=str, required=False, default=None, help='Write a JSON profile of the run to this file: the build time, processing time, texts scanned, matches found, labels inserted and matches rejected for each redactor and anonymizer, and the time spent reading, cleaning and writing. (default=None)')
+    parser.add_argument('--profilechunks', action='store_true', default=False, help='Include the profile of each chunk in the --profile file as well as the totals. (default=False)')
+    parser.add_argument('--memocache', type=int, required=False, default=None, help='Remember how up to this many distinct texts were redacted so that repeated texts (e.g. "okay", "thank you for calling") are not run through the redactors again. Their labels are still numbered from the entity maps. (default=None i.e. no cache)')
+    parser.add_argument('--phrasecache', type=str, required=False, default=None, help='A directory to cache the phrase lists loaded from CSV files in. The cached lists are memory mapped so later runs do not parse the CSV files and --workers share one copy of each list. (default=None i.e. no cache)')
+    parser.add_argument('--regextimeout', type=float, required=False, default=None, help='The time in seconds that each regular expression of a redactor may take to match a text, and that an anonymizer may take to find the tags in a text. Rules can set their own with the timeout parameter. (default=None i.e. no timeout)')
+    parser.add_argument('--timeoutpolicy', required=False, default='redact', choices=['skip','truncate','redact'], help='What a regex redactor does with a text that times out: skip the regular expression, truncate the text and try again, or redact the whole text. Rules can set their own with the timeout-policy parameter. (default=redact)')
+    parser.add_argument('--quarantinefile', required=False, default=None, help='Write the conversation id, rule and action of each text that timed out to this CSV file. (default=None)')
+    parser.add_argument('--cleanthreads', type=int, required=False, default=1, help='The number of threads used to clean up the text after redaction and anonymization. (default=1)')
     parser.add_argument('--uppercase', required=False, action='store_true', help='converts all letters to uppercase')
     parser.add_argument('--level', default=2, required=False, help='The redaction level. Choose 1,2, or 3 or a any custom level. Default is 2')
     parser.add_argument('--seed', type=int, required=False, default=None, help='a seed value for anonymization random selection; default is None i.e. truly random.')
     parser.add_argument('--rulefile', nargs="*", required=False, default=[], help='A list of filenames defining custom rules in YML or JSON. Add to or override default rules (see --defaultrules). These are globbable.')
     parser.add_argument('--regextest', required=False, default=False, action='store_true', help='Test the regular rexpressions defeind in the regex-test rules prior to any other processing.')
     parser.add_argument('--testoutputfile', required=False, help='The file to save test results in.')
+    parser.add_argument('--testworkers', required=False, default=None, type=int, help='Run the --regextest tests of different regex-ids in a pool of this many worker processes. (default=None i.e. a single process)')
+    parser.add_argument('--testcostfile', required=False, default=None, help='With --regextest, also time each tested regular expression against adversarial texts and save a ranking of their cost in this file, warning about any that may backtrack catastrophically. (default=None)')
     parser.add_argument('--chunksize', required=False, default=100000, type=int, help='The number of lines to read before processing a chunk.(default = 100000)' )
+    parser.add_argument('--prefetch', required=False, default=None, type=int, help='Read up to this many chunks ahead in a background thread and write the processed chunks in another background thread, so that reading, processing and writing overlap. (default=None i.e. read, process and write each chunk in turn)' )
+    parser.add_argument('--workers', required=False, default=None, type=int, help='Process chunks in a pool of this many worker processes. Each chunk is re-cut so that no conversation spans two chunks. (default=None i.e. a single process)' )
+    parser.add_argument('--grouped', action='store_true', default=False, help='The input rows are grouped by conversation id so each conversation is forgotten once its last row has been processed. Bounds the memory used by the entity maps. (default=False)')
+    parser.add_argument('--entitymapcap', required=False, default=None, type=int, help='The maximum number of conversations to hold in each entity map. The least recently used conversations are forgotten or spilled to --entitymapspill. (default=None i.e. no limit)' )
+    parser.add_argument('--entitymapspill', type=str, required=False, default=None, help='Base name of the on-disk stores that conversations evicted by --entitymapcap are spilled to so that they can be restored. (default=None i.e. evicted conversations are forgotten)')
     parser.add_argument('--chunklimit', required=False, default=None, type=int, help='The number of chunks to run before stopping (used primarily for benchmarking).' )
     parser.add_argument('--header', default=False, action='store_true', help='Expect headers in the input files and print a header on the output. (default=False)')
     parser.add_argument('--columnname', type=str, default="text", help='The header name for the text; used if --header=True; overridden by --column; default is text')
@@ -62,16 +95,43 @@ def config_args(): # add --anonymize
     parser.add_argument('-is','--instem', type=str, default=None, help='Base name for input files when using date-based processing (default=None)')
     parser.add_argument('-os','--outstem', type=str, default=None, help='Base name for output files when using date-based processing (default=None)')
     parser.add_argument('--chunkgather', type=int, default=None, help='Number of chunks to process before moving to final destination. If not specified, no chunking is performed.')
+    parser.add_argument('--checkpoint', type=str, required=False, default=None, help='A directory to save checkpoints of the run in so that it can be continued with --resume if it is interrupted. (default=None i.e. no checkpoints)')
+    parser.add_argument('--checkpointevery', type=int, required=False, default=1, help='The number of chunks to process between checkpoints. (default=1)')
+    parser.add_argument('--resume', action='store_true', default=False, help='Continue an interrupted run from the checkpoint in the --checkpoint directory.  The run starts from the beginning if there is no checkpoint. (default=False)')
+    parser.add_argument('--serve', type=str, required=False, default=None, help='Instead of processing files, keep the rules and models loaded and serve redaction requests on this address: host:port for HTTP over TCP (e.g. 127.0.0.1:8000) or the path of a Unix domain socket. (default=None)')
+    parser.add_argument('--batchsize', type=int, required=False, default=1000, help='With --serve, the maximum number of texts from concurrent requests that are redacted together. (default=1000)')
+    parser.add_argument('--batchwait', type=float, required=False, default=10.0, help='With --serve, the number of milliseconds to wait for more requests to redact with the first one. (default=10)')
+    parser.add_argument('--conversationttl', type=float, required=False, default=3600.0, help='With --serve, the number of seconds after which the entities of a conversation that has not been seen again are forgotten. (default=3600)')
 
     #version
     parser.add_argument('--version', action='version', help='Print the version', version=f'redactomatic {__version__()}')
+    return parser
+
+'''Return a list of the errors in the options that configure the redaction and anonymization pipeline.  These are checked both for the command line and for the Redactomatic class.'''
+def check_options(args):
+    _err_list=[]
+    if (not args.modality): _err_list.append("ERROR: The --modality option is required.")
+    if (args.timeoutpolicy not in redact.TIMEOUT_POLICIES): _err_list.append(f"ERROR: The --timeoutpolicy option must be one of {', '.join(redact.TIMEOUT_POLICIES)}.")
+    if (args.cleanthreads<1): _err_list.append("ERROR: The --cleanthreads option must be at least 1.")
+    if (args.memocache is not None and args.memocache<1): _err_list.append("ERROR: The --memocache option must be at least 1.")
+    if (args.regextimeout is not None and args.regextimeout<=0): _err_list.append("ERROR: The --regextimeout option must be more than 0.")
+    if (args.profilechunks and not args.profile): _err_list.append("ERROR: The --profilechunks option requires the --profile option.")
+    if (args.entitymapcap is not None and args.entitymapcap<1): _err_list.append("ERROR: The --entitymapcap option must be at least 1.")
+    if (args.entitymapspill is not None and args.entitymapcap is None): _err_list.append("ERROR: The --entitymapspill option requires the --entitymapcap option.")
+    return _err_list
+
+def config_args(argv=None): # add --anonymize
+    parser = create_parser()
 
     #Check conditional required options.  
     _err_list=[]
-    _args=parser.parse_args()
+    _args=parser.parse_args(argv)
+    if (_args.outputformat is None): _args.outputformat=_args.inputformat
 
     #Check special regex test mode.
     if ((_args.regextest) and (not _args.testoutputfile)) : _err_list.append("ERROR: The --regextest option requires the --testoutputfile option.")
+    if ((_args.testworkers is not None) and (_args.testworkers<1)) : _err_list.append("ERROR: The --testworkers option must be at least 1.")
+    if ((_args.testcostfile) and (not _args.regextest)) : _err_list.append("ERROR: The --testcostfile option requires the --regextest option.")
     
     #warn with deprecated --noredaction option
     if (_args.noredaction):
@@ -81,7 +141,8 @@ def config_args(): # add --anonymize
     #If we are going to run any redactors or anonymizers then enforce other command line switches.
     if (_args.redact or _args.anonymize):
         #Check that the required flags are there
-        if (not _args.header):
+        #Parquet and Arrow files always have column names so the columns can be found by name.  The server is sent the conversation ids and texts by name.
+        if (not _args.header) and _args.inputformat=='csv' and _args.serve is None:
             if (not _args.column): _err_list.append("ERROR: The --column option is required when --header is False.")
             if (not _args.idcolumn): _err_list.append("ERROR: The --idcolumn option is required when --header is False.")
         
@@ -94,14 +155,33 @@ def config_args(): # add --anonymize
             if _args.outstem is None: _err_list.append("ERROR: The --outstem option is required when using date-based processing.")
             
             # Construct date-based filenames
-            _args.inputfile = [f"{_args.instem}_{_args.startdate}_{_args.enddate}.csv"]
-            _args.outputfile = f"{_args.outstem}_{_args.startdate}_{_args.enddate}.csv"
+            _args.inputfile = [f"{_args.instem}_{_args.startdate}_{_args.enddate}{cio.FORMAT_EXTENSIONS[_args.inputformat]}"]
+            _args.outputfile = f"{_args.outstem}_{_args.startdate}_{_args.enddate}{cio.FORMAT_EXTENSIONS[_args.outputformat]}"
             _args.chunkoutstem = f"{_args.chunkoutstem}_{_args.startdate}_{_args.enddate}"
-        else:
+        elif _args.serve is None:
             if (not _args.inputfile): _err_list.append("ERROR: The --inputfile option is required when not using date-based processing.")
-            if (not _args.outputfile): _err_list.append("ERROR: The --outputfile option is required when not using date-based processing.")
+            if (not _args.outputfile and not _args.outputdir): _err_list.append("ERROR: The --outputfile or --outputdir option is required when not using date-based processing.")
         
-        if (not _args.modality): _err_list.append("ERROR: The --modality option is required.")
+        _err_list.extend(check_options(_args))
+        if (_args.profile and _args.workers is not None): _err_list.append("ERROR: The --profile option cannot be used with --workers as the models run in the worker processes.")
+        if (_args.prefetch is not None and _args.prefetch<1): _err_list.append("ERROR: The --prefetch option must be at least 1.")
+        if (_args.workers is not None and _args.workers<1): _err_list.append("ERROR: The --workers option must be at least 1.")
+        if (_args.streamlog and not _args.log): _err_list.append("ERROR: The --streamlog option requires the --log option.")
+        if (_args.resume and not _args.checkpoint): _err_list.append("ERROR: The --resume option requires the --checkpoint option.")
+        if (_args.checkpoint and _args.outputformat!='csv'): _err_list.append("ERROR: The --checkpoint option requires CSV output as Parquet and Arrow files cannot be appended to.")
+        if (_args.checkpointevery<1): _err_list.append("ERROR: The --checkpointevery option must be at least 1.")
+        if (_args.serve is not None and (_args.inputfile or _args.startdate is not None or _args.workers is not None or _args.checkpoint or _args.log or _args.prefetch is not None)):
+            _err_list.append("ERROR: The --serve option cannot be used with --inputfile, --startdate, --workers, --checkpoint, --log or --prefetch.")
+        if (_args.outputdir is not None):
+            if (_args.startdate is not None or _args.chunkgather is not None or _args.checkpoint or _args.serve is not None):
+                _err_list.append("ERROR: The --outputdir option cannot be used with --startdate, --chunkgather, --checkpoint or --serve.")
+            _shards=[cio.output_filepath(_args.outputdir, file, _args.outputformat) for file in (_args.inputfile or [])]
+            _inputs=set(os.path.abspath(file) for file in (_args.inputfile or []))
+            if len(set(_shards))<len(_shards): _err_list.append("ERROR: The --outputdir option requires input files with different names, as each is written to a file named after it.")
+            if any(os.path.abspath(shard) in _inputs for shard in _shards): _err_list.append("ERROR: The --outputdir option would overwrite an input file. Use another directory or --outputformat.")
+        if (_args.batchsize<1): _err_list.append("ERROR: The --batchsize option must be at least 1.")
+        if (_args.batchwait<0): _err_list.append("ERROR: The --batchwait option cannot be negative.")
+        if (_args.conversationttl<=0): _err_list.append("ERROR: The --conversationttl option must be more than 0.")
     if _err_list:
         parser.error("\n".join(_err_list))
 
@@ -109,36 +189,34 @@ def config_args(): # add --anonymize
 
 class RedactomaticProcessor(pb.ProcessorBase):
     def __init__(self,id,entity_rules):
+        args=entity_rules.args
         self._curr_id = 0
-        self._redact_entity_map = em.EntityMap()
-        self._anon_entity_map=em.EntityMap()
+        self._redact_entity_map = em.EntityMap(args.entitymapcap, None if args.entitymapspill is None else args.entitymapspill+".redact")
+        self._anon_entity_map=em.EntityMap(args.entitymapcap, None if args.entitymapspill is None else args.entitymapspill+".anon")
         self._entity_values = ev.EntityValues()
+        self._profile = pl.Profile(args.profilechunks) if args.profile else None
+        self._pipeline = pl.Pipeline(entity_rules, self._profile)
+        self._cleaner = pb.CleanProcessor("clean", entity_rules)
         super().__init__(id, entity_rules)    
 
+    def configure(self,params):
+        super().configure(params)
 
-    def process(self,df):
-        #Check if we need to set column and idcolumn.
-        #Note that we currently don't police that that files have the same headers and columns.
-        #Behaviour is not guaranteed if they do not.
-        if (args.header):
-            try: 
-                if (args.column is None): args.column=df.columns.get_loc(args.columnname)+1
-            except: raise KeyError("The essential text field '"+args.columnname+"' was not found in the input file.")
-            try: 
-                if (args.idcolumn is None): args.idcolumn=df.columns.get_loc(args.idcolumnname)+1
-            except: raise KeyError("The essential ID field '"+args.idcolumnname+"' was not found in the input file.")
+        #Build the redactor and anonymizer models once so that they can be reused for every chunk.
+        redaction_order, anonymization_order = self.get_orders()
+        self._pipeline.build(redaction_order, anonymization_order, self._redact_entity_map, self._anon_entity_map, self._entity_values)
+        args=self._entity_rules.args
+        self._cleaner.configure({"threads": args.cleanthreads, "uppercase": args.uppercase})
 
-        #df.iloc[:, args.column-1].replace(np.nan,'', inplace=True)
-        
-        df.fillna({args.column-1:''}, inplace=True)
-        texts = df.iloc[:, args.column-1].tolist()
-        ids = df.iloc[:, args.idcolumn-1].tolist()
+    '''Return the ordered lists of entities to redact and anonymize.  Raises an exception if the rules are inconsistent.'''
+    def get_orders(self):
+        args=self._entity_rules.args
 
         #get the entities to be redacted and anonymized. Make sure the token map default rule is added if there is a token map and its not in the list.
         entities=self._entity_rules.entities
         if (TOKENMAP_RULENAME not in entities): entities[:0]=[TOKENMAP_RULENAME] 
 
-        #Now run redaction on the ordered list of redactors that are needed to meet the current redaction level.
+        #Now build the ordered list of redactors that are needed to meet the current redaction level.
         redaction_order=self._entity_rules.redaction_order
         redaction_order[:0] = [i for i in self._entity_rules.always_redact if i not in redaction_order]
         if args.verbose: print(f'redaction_order = {redaction_order}',file=sys.stderr)
@@ -154,17 +232,6 @@ class RedactomaticProcessor(pb.ProcessorBase):
         if len(missing_entities)>0:
             raise Exception(f'ERROR: The following entities are not defined in the redaction_order: {missing_entities}')
 
-        if (args.verbose): print("Starting redaction at anonymization level:",self._entity_rules.level)
-
-        for rule in redaction_order:
-            #Get the custom redactor model for this rule_label. (The redactor model will get the modality from the args if it is modality specific.)
-            try:
-                _model=self._entity_rules.get_redactor_model(rule, self._redact_entity_map, self._entity_values)
-                if (args.verbose): print("Redacting ",rule,"...")
-                texts, self._curr_id, ids = _model.redact(texts, self._curr_id, ids)
-            except(er.NotSupportedException) as e:
-                if (args.verbose): print("Skipping ",rule,"...")
-
         #Set up for running the anonymizers.  
         if (args.anonymize): 
             anonymization_order=[x for x in self._entity_rules.anonymization_order if x in entities]
@@ -172,32 +239,158 @@ class RedactomaticProcessor(pb.ProcessorBase):
             anonymization_order=[x for x in self._entity_rules.anonymization_order if x in self._entity_rules.always_anonymize]
         
         if args.verbose: print(f'anonymization_order = {anonymization_order}',file=sys.stderr)
+        return redaction_order, anonymization_order
+
+    def process(self,df):
+        args=self._entity_rules.args
+        texts, ids = self.get_texts(df)
+
+        #Now run redaction on the ordered list of redactors that are needed to meet the current redaction level.
+        if (args.verbose): print("Starting redaction at anonymization level:",self._entity_rules.level)
+        texts = self.redact_texts(texts, ids)
+
+        #Now anonymize, clean and write the redacted data back to the Dataframe
+        df.iloc[:, args.column-1] = self.finish_texts(texts, ids)
+
+        #If the input is grouped by conversation then every conversation but the last one in this chunk is complete and can be forgotten.
+        if args.grouped and ids: self.close_conversations([ids[-1]])
+        return df
+
+    '''Return the lists of texts and conversation ids in a chunk of the input file.'''
+    def get_texts(self,df):
+        args=self._entity_rules.args
+        self.find_columns(df)
+
+        #df.iloc[:, args.column-1].replace(np.nan,'', inplace=True)
+        
+        df.fillna({args.column-1:''}, inplace=True)
+        texts = df.iloc[:, args.column-1].tolist()
+        ids = df.iloc[:, args.idcolumn-1].tolist()
+
+        #Missing texts in Parquet and Arrow files are treated as empty.
+        if args.inputformat!='csv': texts = [text if isinstance(text,str) else '' for text in texts]
+        return texts, ids
+
+    '''Return the list of conversation ids in a chunk of the input file.'''
+    def get_ids(self,df):
+        self.find_columns(df)
+        return df.iloc[:, self._entity_rules.args.idcolumn-1].tolist()
+
+    '''Set the text and id column numbers from the header if they have not been given.'''
+    def find_columns(self,df):
+        args=self._entity_rules.args
+
+        #Check if we need to set column and idcolumn.
+        #Note that we currently don't police that that files have the same headers and columns.
+        #Behaviour is not guaranteed if they do not.
+        if (args.header or args.inputformat!='csv'):
+            try: 
+                if (args.column is None): args.column=df.columns.get_loc(args.columnname)+1
+            except: raise KeyError("The essential text field '"+args.columnname+"' was not found in the input file.")
+            try: 
+                if (args.idcolumn is None): args.idcolumn=df.columns.get_loc(args.idcolumnname)+1
+            except: raise KeyError("The essential ID field '"+args.idcolumnname+"' was not found in the input file.")
+
+    '''Run the redactors over the texts, numbering the redaction labels from the current entity count.'''
+    def redact_texts(self,texts,ids):
+        texts, self._curr_id, ids = self._pipeline.redact(texts, self._curr_id, ids)
+        return texts
+
+    '''Run the anonymizers over the redacted texts then clean them up.'''
+    def finish_texts(self,texts,ids):
+        args=self._entity_rules.args
 
         #Now re-precess all the text and execute the associated anonumizers.
-        for rule in anonymization_order:
-            #Get the custom anonymizer model for this rule_label. 
-            try:
-                _model=self._entity_rules.get_anonomizer_model(rule, self._anon_entity_map, self._entity_values)
-                if (args.verbose): print("Anonymizing ",rule,"...")
-                texts=_model.anonymize(texts, ids)
-            except(er.NotSupportedException) as e:
-                if (args.verbose): print("Skipping ",rule,"...")
+        texts = self._pipeline.anonymize(texts, ids)
 
         # data cleanup
         if (args.verbose): print("Cleaning text (Regex)...")
-        texts = pb.clean(texts) # chats-yes, voice-yes
+        if (args.verbose) and args.uppercase: print("Converting letters to uppercase...")
+        _start=time.perf_counter()
+        texts = self._cleaner.clean_texts(texts) # chats-yes, voice-yes
+        if self._profile is not None: self._profile.add_time("clean", time.perf_counter()-_start)
+
+        return texts
+
+    '''Forget all the entities seen so far and start numbering redaction labels from eCount.  Used to process each chunk independently in --workers mode.'''
+    def reset(self,eCount=0):
+        self._curr_id=eCount
+        self._redact_entity_map.clear()
+        self._anon_entity_map.clear()
+        self._entity_values.clear()
+
+    '''Forget the entities of every conversation except those in keep.'''
+    def close_conversations(self,keep):
+        self._redact_entity_map.retain(keep)
+        self._anon_entity_map.retain(keep)
+
+    '''Return the size statistics of the redaction and anonymization entity maps.'''
+    def entity_map_stats(self):
+        return {"redaction": self._redact_entity_map.stats(), "anonymization": self._anon_entity_map.stats()}
+
+    '''Release any resources held by the pipeline such as worker processes, the cleanup threads and the entity map spill stores.'''
+    def close(self):
+        self._pipeline.close()
+        self._cleaner.close()
+        self._redact_entity_map.close()
+        self._anon_entity_map.close()
+
+    '''Return the state of the run that is carried from chunk to chunk: the entity count, entity maps, entity values and random generator.'''
+    def get_state(self):
+        return {
+            "curr_id": self._curr_id,
+            "redact_entity_map": self._redact_entity_map.get_state(),
+            "anon_entity_map": self._anon_entity_map.get_state(),
+            "entity_values": self._entity_values.get_state(),
+            "random": self._entity_rules.random.getstate()
+        }
+
+    '''Restore a state returned by get_state().'''
+    def set_state(self,state):
+        self._curr_id=state["curr_id"]
+        self._redact_entity_map.set_state(state["redact_entity_map"])
+        self._anon_entity_map.set_state(state["anon_entity_map"])
+        self._entity_values.set_state(state["entity_values"])
+        self._entity_rules.random.setstate(state["random"])
+
+    @property
+    def pipeline(self):
+        return self._pipeline
+
+    @property
+    def cleaner(self):
+        return self._cleaner
+
+    @property
+    def profile(self):
+        return self._profile
 
-        if args.uppercase:
-            texts = pb.convert_to_uppercase(texts)
-            if (args.verbose): print("Converting letters to uppercase...")
+    @property
+    def entity_rules(self):
+        return self._entity_rules
 
-        # write the redacted data back to the Dataframe
-        df.iloc[:, args.column-1] = texts
+    @property
+    def curr_id(self):
+        return self._curr_id
+
+    @property
+    def entity_values(self):
+        return self._entity_values
 
     def write_log(self,file):
-        self._entity_values.write_csv(file)
+        self._entity_values.write_csv(file, self._entity_rules.args.compresslevel)
 
-def main(args):
+    '''Start keeping track of the entity values that have not been written to a streaming log.'''
+    def start_log(self):
+        self._entity_values.start_log()
+
+    '''Append the entity values added since the last call to a streaming log and forget them.'''
+    def flush_log(self,log):
+        self._entity_values.write_new(log)
+        self._entity_values.forget(self._curr_id)
+
+'''Load the rules for a run and return the entity_rules.'''
+def load_entity_rules(args):
     #Initialize an empty rules base and pass the args namespace to it.
     #Load the config rules files (use all files in the rules directory if no globs are given.)
     entity_rules = er.EntityRules(args)
@@ -233,59 +426,532 @@ def main(args):
     #Now merge the rules into the configuration. Note that if there is a _TOKEN_MAP already defined then it will simply be merged with this one.  This is ok.
     entity_rules.merge_rules(token_map_config)
     #print(f'Created _TOKEN_MAP_: {entity_rules.get_entityid_rule(TOKENMAP_RULENAME)}',file=sys.stderr)
+    return entity_rules
+
+## Library API ##
+
+# Redacts texts in the calling process so that redactomatic can be used from other Python code without reading and writing files.
+# The options are the command line options without the leading dashes, e.g. Redactomatic(modality="text", level=3, anonymize=True, seed=1).
+# Options that are about files (e.g. inputfile, outputfile, chunksize, workers) are not used.  verbose is False unless it is given.
+# The entities are replaced consistently across calls, as they are across the chunks of a file, until reset() or close_conversations() is called.
+class Redactomatic():
+    def __init__(self, **options):
+        args=create_parser().parse_args([])
+        args.verbose=False
+        for name, value in options.items():
+            if not hasattr(args, name): raise TypeError(f"Redactomatic() got an unknown option '{name}'")
+            setattr(args, name, value)
+        if args.modality not in ('text', 'voice'): raise ValueError("Redactomatic() requires the modality option to be 'text' or 'voice'")
+        _err_list=check_options(args)
+        if _err_list: raise ValueError("\n".join(_err_list))
+        if isinstance(args.rulefile, str): args.rulefile=[args.rulefile]
+
+        self._args=args
+        self._processor=RedactomaticProcessor("redactomatic", load_entity_rules(args))
+        self._processor.configure(None)
+
+    '''Return the list of texts redacted (and anonymized with the anonymize option) and cleaned.  ids is the list of the conversation id of each text.'''
+    def redact_texts(self, texts, ids):
+        texts=list(texts)
+        ids=list(ids)
+        if len(texts)!=len(ids): raise ValueError(f"redact_texts() was given {len(texts)} texts but {len(ids)} conversation ids")
+        texts=self._processor.redact_texts(texts, ids)
+        texts=self._processor.finish_texts(texts, ids)
+        self._processor.pipeline.quarantine.flush()
+
+        #With the grouped option every conversation but the last one is complete and can be forgotten.
+        if self._args.grouped and ids: self._processor.close_conversations([ids[-1]])
+        return texts
+
+    '''Redact an iterable of (conversation_id, text) pairs, yielding (conversation_id, redacted_text) pairs in the same order.
+    The pairs are redacted in batches of batchsize so that results are yielded before the end of the input.'''
+    def redact_stream(self, pairs, batchsize=1000):
+        if batchsize<1: raise ValueError("redact_stream() requires a batchsize of at least 1")
+        pairs=iter(pairs)
+        while True:
+            batch=list(itertools.islice(pairs, batchsize))
+            if not batch: return
+            ids=[d_id for d_id, text in batch]
+            yield from zip(ids, self.redact_texts([text for d_id, text in batch], ids))
+
+    '''Forget all the entities seen so far so that the next texts are redacted as if they were the first.'''
+    def reset(self):
+        self._processor.reset()
+
+    '''Forget the entities of every conversation except those in keep.'''
+    def close_conversations(self, keep):
+        self._processor.close_conversations(keep)
+
+    '''Return a dictionary of the redaction labels and the text they replaced, i.e. the contents of the --log file.'''
+    def entity_values(self):
+        return dict(self._processor.entity_values.get_entity_values())
+
+    '''Write the redaction labels and the text they replaced to a CSV file, like the --log option.'''
+    def write_log(self, filepath):
+        self._processor.write_log(filepath)
+
+    '''Release the resources held by the pipeline such as spaCy worker processes and the cleanup threads.'''
+    def close(self):
+        self._processor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    @property
+    def args(self):
+        return self._args
+
+    @property
+    def profile(self):
+        return self._processor.profile
+
+## Multi-process chunk processing (--workers) ##
+
+#Redaction labels of the form [LABEL-n]. Used to find the labels to renumber once a chunk has been redacted by a worker.
+REDACT_LABEL_RE=regex.compile(r'\[([^\[\]]+)-(\d+)\]')
+
+#The redactomatic processor in a worker process.  Built once when the worker starts so the models stay warm for every chunk.
+_worker=None
+_worker_error=None
+
+'''Build the rules and pipeline in a worker process.  Any error is kept and raised by the first task so that the pool does not keep restarting the worker.'''
+def init_worker(args):
+    global _worker, _worker_error
+    try:
+        _worker=RedactomaticProcessor("redactomatic",load_entity_rules(args))
+        _worker.configure(None)
+    except Exception as e:
+        _worker_error=e
+
+'''Redact a chunk in a worker.  Labels are numbered from one more than the highest label index already in the texts, so that the new labels can be told apart and renumbered by the parent.'''
+def worker_redact(texts, ids):
+    if _worker_error is not None: raise _worker_error
+    base=max([int(m.group(2)) for t in texts for m in REDACT_LABEL_RE.finditer(t)], default=-1)+1
+    _worker.reset(base)
+    texts=_worker.redact_texts(texts, ids)
+    return texts, dict(_worker.entity_values.get_entity_values()), _worker.curr_id-base, base, _worker.pipeline.quarantine.flush()
+
+'''Anonymize and clean a chunk in a worker, using the renumbered entity values of the chunk.  The random generator is seeded from the seed and chunk number so that the output does not depend on the number of workers.
+Returns the texts and the texts quarantined by the anonymizers.'''
+def worker_finish(chunk, texts, ids, entity_values):
+    if _worker_error is not None: raise _worker_error
+    _worker.reset()
+    for key, value in entity_values.items():
+        _worker.entity_values.set_value(key, value)
+    if _worker.entity_rules.args.seed is not None:
+        _worker.entity_rules.random.seed(f'{_worker.entity_rules.args.seed}:{chunk}')
+    texts=_worker.finish_texts(texts, ids)
+    return texts, _worker.pipeline.quarantine.flush()
+
+'''Re-cut chunks of the input so that no conversation is split across two chunks.  Rows of the last conversation in a chunk are carried over to the next one.
+The rows of each conversation must be next to each other in the input, and an error is raised if a conversation appears again after it was cut.
+An empty chunk is passed on if no rows are being carried, so that an empty input still gives an output file.'''
+def conversation_chunks(df_iter, get_ids):
+    #The pieces of the rows carried over, which are joined once the conversation ends so that a long conversation is not copied for every chunk.
+    carry=[]
+    carry_id=None
+    closed=set()
+    for df in df_iter:
+        ids=get_ids(df)
+        if len(ids)==0:
+            if not carry: yield df.copy()
+            continue
+        reopened=closed.intersection(ids)
+        if reopened: raise_reopened(next(iter(reopened)))
+        i=len(ids)
+        while i>0 and ids[i-1]==ids[-1]: i-=1
+        if i==0 and (not carry or carry_id==ids[-1]):
+            carry.append(df)
+            carry_id=ids[-1]
+            continue
+        chunk=pd.concat(carry+[df.iloc[:i]], ignore_index=True) if carry else df.iloc[:i].copy()
+        if carry: closed.add(carry_id)
+        closed.update(ids[:i])
+        if ids[-1] in closed: raise_reopened(ids[-1])
+        carry=[df.iloc[i:]]
+        carry_id=ids[-1]
+        yield chunk
+    if carry:
+        yield pd.concat(carry, ignore_index=True)
+
+'''Raise the error for a conversation whose rows are not next to each other in the input, which would be split across chunks by conversation_chunks().'''
+def raise_reopened(d_id):
+    raise Exception(f"ERROR: Conversation {d_id} appears again after its rows were processed. With --workers the rows of each conversation must be next to each other in the input.")
+
+'''Re-cut the chunks of several input files, given as (tag, chunk) pairs with the chunks of each file one after another, so that no conversation is split across two chunks of a file.'''
+def tagged_conversation_chunks(chunks, get_ids):
+    for tag, group in itertools.groupby(chunks, key=lambda pair: pair[0]):
+        for df in conversation_chunks((df for _, df in group), get_ids):
+            yield tag, df
+
+# Processes chunks in a pool of worker processes that each build the pipeline once.  Each chunk is redacted with fresh entity maps and its labels are renumbered
+# in input order by the parent so that they are numbered as a single process would number the same chunks, whatever the number of workers.  As the chunks are
+# re-cut they are not the chunks read without --workers, so the label numbers differ from a run without --workers.  Then the chunk is anonymized and cleaned in the pool.
+class ChunkPool():
+    def __init__(self, redactomatic, workers):
+        self._redactomatic=redactomatic
+        self._curr_id=0
+        self._chunk=0
+        self._window=2*workers
+        #The chunk count and entity count after the last chunk returned, which is where a resumed run continues from.
+        self._returned=(0,0)
+
+        #Workers are daemonic and cannot start their own processes so spacy runs in-process in each worker.
+        args=copy.copy(redactomatic.entity_rules.args)
+        args.verbose=False
+        args.spacyprocesses=1
+        #The worker entity maps are cleared for every chunk so they need no cap or spill store.
+        args.entitymapcap=None
+        args.entitymapspill=None
+        #The texts quarantined by the workers are sent back with each chunk and written by the parent.
+        args.quarantinefile=None
+        self._pool=multiprocessing.Pool(workers, initializer=init_worker, initargs=(args,))
+
+    '''Process the chunks from df_iter and yield them in input order once they are ready to write.'''
+    def process(self, df_iter):
+        for tag, df in self.process_tagged((None, df) for df in conversation_chunks(df_iter, self._redactomatic.get_ids)):
+            yield df
+
+    '''Process (tag, chunk) pairs, e.g. chunks tagged with the input file they were read from, and yield the pairs in input order once they are ready to write.
+The chunks must already be cut so that no conversation spans two chunks.'''
+    def process_tagged(self, chunks):
+        redactomatic=self._redactomatic
+        redacting=collections.deque()
+        finishing=collections.deque()
+
+        #Either move the oldest redacted chunk on to be finished, or return the oldest finished chunk.
+        def advance():
+            if finishing and (finishing[0][3].ready() or not redacting):
+                tag, df, entity_values, result, returned = finishing.popleft()
+                texts, quarantined = result.get()
+                df.iloc[:, redactomatic.entity_rules.args.column-1] = texts
+                redactomatic.pipeline.quarantine.extend(quarantined)
+                self._returned=returned
+                #Add the entity values to the run as the chunk is returned so that a streaming log stays in step with the output.
+                for key, value in entity_values.items():
+                    redactomatic.entity_values.set_value(key, value)
+                return tag, df
+            chunk, tag, df, ids, result = redacting.popleft()
+            texts, entity_values, count, base, quarantined = result.get()
+            redactomatic.pipeline.quarantine.extend(quarantined)
+            texts, entity_values = self.renumber(texts, entity_values, count, base)
+            finishing.append((tag, df, entity_values, self._pool.apply_async(worker_finish, (chunk, texts, ids, entity_values)), (chunk+1, self._curr_id)))
+            return None
+
+        for tag, df in chunks:
+            texts, ids = redactomatic.get_texts(df)
+            redacting.append((self._chunk, tag, df, ids, self._pool.apply_async(worker_redact, (texts, ids))))
+            self._chunk+=1
+            while len(redacting)+len(finishing)>=self._window:
+                ready=advance()
+                if ready is not None: yield ready
+        while redacting or finishing:
+            ready=advance()
+            if ready is not None: yield ready
+
+    '''Renumber the labels of a redacted chunk and its entity values to follow on from the previous chunk.'''
+    def renumber(self, texts, entity_values, count, base):
+        offset=self._curr_id-base
+        def new_label(m):
+            if int(m.group(2))<base or m.group(1)+"-"+m.group(2) not in entity_values: return m.group()
+            return "["+m.group(1)+"-"+str(int(m.group(2))+offset)+"]"
+        texts=[REDACT_LABEL_RE.sub(new_label, t) for t in texts]
+
+        new_values={}
+        for key, value in entity_values.items():
+            label, ix = key.rsplit("-",1)
+            new_key=label+"-"+str(int(ix)+offset)
+            new_values[new_key]=value
+        self._curr_id+=count
+        return texts, new_values
+
+    '''Return the chunk count and entity count of the chunks returned so far.'''
+    def get_state(self):
+        return {"chunk": self._returned[0], "curr_id": self._returned[1]}
+
+    '''Continue numbering chunks and entities from a state returned by get_state().'''
+    def set_state(self, state):
+        self._chunk=state["chunk"]
+        self._curr_id=state["curr_id"]
+        self._returned=(self._chunk, self._curr_id)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+'''Move a streaming log to the destination that goes with the chunked output file of the same chunks.'''
+def rotate_log(args, log, chunk):
+    final_file = f"{args.chunkoutstem}_{chunk-1}_log.csv" + log.compression_extension
+    log.rotate(final_file)
+    if (args.verbose): print(f"{args.log} moved to {final_file}")
+
+'''Return an iterator over the chunks of an input file that starts after the first rows rows.
+Reading starts at the chunk that contains the first row to process, so that the chunks are cut in the same places as an uninterrupted run.'''
+def resume_chunks(args, file, rows):
+    skip=rows-rows%args.chunksize
+    df_iter=cio.read_chunks(file, args.inputformat, args.chunksize, args.header, skip)
+    for df in df_iter:
+        if rows>skip:
+            df=df.iloc[rows-skip:]
+            skip=rows
+            if len(df)==0: continue
+        yield df
+
+'''Save a checkpoint of the run.  The output file and streaming log are finished first so that they can be truncated back to this point on resume.'''
+# file_ix, rows: the index of the input file being read and the number of its rows that have been written.
+# chunk: the number of the next chunk to write.
+def save_checkpoint(checkpoint, options, file_ix, rows, chunk, redactomatic, pool, writer, log):
+    checkpoint.save({
+        "options": options,
+        "file": file_ix,
+        "rows": rows,
+        "chunk": chunk,
+        "output": writer.checkpoint(),
+        "log": None if log is None else log.checkpoint(),
+        "quarantine": redactomatic.pipeline.quarantine.checkpoint(),
+        "redactomatic": redactomatic.get_state(),
+        "pool": None if pool is None else pool.get_state()
+    })
+
+'''Process the input files into an output file each in --outputdir, and into --outputfile as well if writer is given.  The chunks of all the files are read as one
+stream so that with --workers the chunks of several files are processed at once, and the labels are numbered across the files as they are for one output file.
+Returns the time spent processing the chunks.'''
+def process_shards(args, redactomatic, pool, writer, log):
+    os.makedirs(args.outputdir, exist_ok=True)
+    def read_files():
+        for file_ix, file in enumerate(args.inputfile):
+            if (args.verbose): print("Loading datafile " + file + "...")
+            for df in cio.read_chunks(file, args.inputformat, args.chunksize, args.header):
+                yield file_ix, df
+
+    chunks=read_files()
+    prefetcher=None
+    if args.prefetch is not None: chunks=prefetcher=cio.Prefetcher(chunks, args.prefetch)
+    if redactomatic.profile is not None: chunks=redactomatic.profile.timed("read", chunks)
+    if args.workers is None:
+        processed=((file_ix, redactomatic.process(df)) for file_ix, df in chunks)
+    else:
+        processed=pool.process_tagged(tagged_conversation_chunks(chunks, redactomatic.get_ids))
+
+    chunk=0
+    process_time=0.0
+    shard=None
+    shard_ix=None
+    while True:
+        _start=time.perf_counter()
+        item=next(processed, None)
+        process_time+=time.perf_counter()-_start
+        if item is None: break
+        file_ix, df = item
+        _write_start=time.perf_counter()
+
+        #The files come out in input order so each output file is finished when the first chunk of the next file arrives.
+        #Every file gives at least one chunk, which is empty if the file has no rows, so every file gets an output file.
+        if file_ix!=shard_ix:
+            if shard is not None: shard.close()
+            shard_ix=file_ix
+            shard_file=cio.output_filepath(args.outputdir, args.inputfile[file_ix], args.outputformat)
+            shard=cio.ChunkWriter(shard_file, args.outputformat, args.header, args.compresslevel)
+            if args.prefetch is not None: shard=cio.BackgroundWriter(shard, args.prefetch)
+            shard.write(df, append=False)
+        else:
+            shard.write(df)
+        if (args.verbose): print("Writing outfile ", shard_file, "chunk ", chunk)
+        if writer is not None: writer.write(df, append=chunk>0)
+
+        finish_chunk(args, redactomatic, log, chunk, df, _write_start)
+        if (args.chunklimit is not None) and (chunk+1>=args.chunklimit):
+            if (args.verbose): print(f"QUIT. chunklimit reached:{args.chunklimit}\n")
+            break
+        chunk=chunk+1
+
+    if prefetcher is not None: prefetcher.close()
+    if shard is not None: shard.close()
+    return process_time
+
+'''Flush the streaming log and quarantine file and profile a chunk once it has been written.'''
+def finish_chunk(args, redactomatic, log, chunk, df, write_start):
+    if log is not None: redactomatic.flush_log(log)
+    _quarantined=redactomatic.pipeline.quarantine.flush()
+    if (args.verbose) and _quarantined: print(f"Quarantined {len(_quarantined)} texts that timed out in chunk {chunk}")
+    if redactomatic.profile is not None:
+        redactomatic.profile.add_time("write", time.perf_counter()-write_start)
+        redactomatic.profile.end_chunk(chunk, len(df))
+
+def main(args):
+    entity_rules=load_entity_rules(args)
 
     #Now run the regex tests if required
     if args.regextest:
         test= rt.RegexTest(entity_rules)
-        test.test_regex(args.testoutputfile)
+        test.test_regex(args.testoutputfile, args.testcostfile, args.testworkers)
+
+    #With --serve the pipeline is built once and kept warm to redact the texts sent to the server until it is stopped.
+    if args.serve is not None and ( args.redact or args.anonymize ):
+        redactomatic=RedactomaticProcessor("redactomatic",entity_rules)
+        redactomatic.configure(None)
+        if (args.verbose): print(f"Built pipeline in {redactomatic.pipeline.build_time:.3f}s")
+        srv.serve(args, redactomatic)
+        if redactomatic.profile is not None: redactomatic.profile.write(args.profile)
+        redactomatic.close()
 
     #Continue if redaction or anonymization is needed.
-    if ( args.redact or args.anonymize ):
+    elif ( args.redact or args.anonymize ):
         #Initialize some looping counts and an empty data frame.
         chunk=0
         df=None
 
-        ##initialise and configure the redactomatic processor
+        ##initialise and configure the redactomatic processor. This builds the redaction and anonymization pipeline once for all chunks and files.
+        #With --workers the pipeline is built in each worker instead and the rules are only checked here.
         redactomatic=RedactomaticProcessor("redactomatic",entity_rules)
-        redactomatic.configure(None)
-
-        for file in args.inputfile:
-            if (args.verbose): print("Loading datafile " + file + "...")
-            df_iter = pd.read_csv(file, chunksize=args.chunksize, header=(0 if args.header else None), dtype=str, keep_default_na=False)
-            
-            for df in df_iter:
-                redactomatic.process(df)
-                if (args.verbose): print("Writing outfile ", args.outputfile, "chunk ", chunk)
+        pool=None
+        if args.workers is None:
+            redactomatic.configure(None)
+            if (args.verbose): print(f"Built pipeline in {redactomatic.pipeline.build_time:.3f}s")
+        else:
+            redactomatic.get_orders()
+            pool=ChunkPool(redactomatic, args.workers)
+            if (args.verbose): print(f"Started {args.workers} workers")
+        process_time=0.0
+
+        #With --streamlog the entities are appended to the log after each chunk and rotated with the chunked output.
+        log=None
+        if args.log and args.streamlog:
+            log=ev.EntityLog(args.log, args.compresslevel)
+            redactomatic.start_log()
+
+        #With --outputdir there is only an --outputfile if all the output is wanted in one file as well.
+        writer=None
+        if args.outputfile:
+            writer=cio.ChunkWriter(args.outputfile, args.outputformat, args.header, args.compresslevel)
+            #With --prefetch the chunks are written in a background thread while the next chunk is processed.
+            if args.prefetch is not None: writer=cio.BackgroundWriter(writer, args.prefetch)
+
+        #With --checkpoint the state of the run is saved every --checkpointevery chunks.  With --resume the run continues from the last checkpoint.
+        checkpoint=None
+        start_file=0
+        start_rows=0
+        if args.checkpoint:
+            checkpoint=cpt.Checkpoint(args.checkpoint)
+            options=cpt.resume_options(args)
+            state=checkpoint.load() if args.resume else None
+            if state is not None:
+                changed=[name for name in options if options[name]!=state["options"].get(name)]
+                if changed: raise Exception(f"ERROR: The checkpoint in {args.checkpoint} cannot be resumed as these options have changed: {changed}")
+                chunk=state["chunk"]
+                start_file=state["file"]
+                start_rows=state["rows"]
+                redactomatic.set_state(state["redactomatic"])
+                if pool is not None: pool.set_state(state["pool"])
+
+                #Undo anything written after the checkpoint, including moving the output of an unfinished --chunkgather back.
+                rotated=None if args.chunkgather is None else f"{args.chunkoutstem}_{chunk-1}"
+                writer.resume(state["output"], None if rotated is None else rotated+writer.extension)
+                if log is not None: log.resume(state["log"], None if rotated is None else rotated+"_log.csv"+log.compression_extension)
+                redactomatic.pipeline.quarantine.resume(state.get("quarantine", 0))
+                if (args.verbose): print(f"Resuming from chunk {chunk}: row {start_rows} of {args.inputfile[start_file] if start_file<len(args.inputfile) else 'the end of the input'}.")
+            elif args.resume and (args.verbose): print(f"No checkpoint found in {args.checkpoint}. Starting from the beginning.")
+
+        #Set if --chunklimit stops the run before the end of the input.
+        stopped=False
+        if args.outputdir is not None:
+            process_time=process_shards(args, redactomatic, pool, writer, log)
+        else:
+            for file_ix, file in enumerate(args.inputfile):
+                if file_ix<start_file: continue
+                if stopped: break
+                rows=start_rows if file_ix==start_file else 0
+                if (args.verbose): print("Loading datafile " + file + "...")
+                df_iter = resume_chunks(args, file, rows) if rows>0 else cio.read_chunks(file, args.inputformat, args.chunksize, args.header)
+                if args.prefetch is not None: df_iter=cio.Prefetcher(df_iter, args.prefetch)
+                if redactomatic.profile is not None: df_iter=redactomatic.profile.timed("read", df_iter)
+
+                if args.workers is None:
+                    processed=(redactomatic.process(df) for df in df_iter)
+                else:
+                    processed=pool.process(df_iter)
+
+                while True:
+                    _start=time.perf_counter()
+                    df=next(processed, None)
+                    process_time+=time.perf_counter()-_start
+                    if df is None: break
+                    if (args.verbose): print("Writing outfile ", args.outputfile, "chunk ", chunk)
+                    _write_start=time.perf_counter()
                 
-                if chunk == 0: 
-                    df.to_csv(args.outputfile, index=False, header=args.header)
-                elif args.chunkgather is not None and chunk % args.chunkgather == 0:
-                    # Move current output to chunked destination and start new output file
-                    final_file = f"{args.chunkoutstem}_{chunk-1}.csv"
-                    shutil.move(args.outputfile, final_file)
-                    if (args.verbose): print(f"{args.outputfile} moved to {final_file}")
-                    df.to_csv(args.outputfile, index=False, header=args.header)
-                else: 
-                    df.to_csv(args.outputfile, mode='a', header=False, index=False)
+                    if chunk == 0: 
+                        writer.write(df, append=False)
+                    elif args.chunkgather is not None and chunk % args.chunkgather == 0:
+                        # Move current output to chunked destination and start new output file
+                        final_file = f"{args.chunkoutstem}_{chunk-1}{writer.extension}"
+                        writer.rotate(final_file)
+                        if (args.verbose): print(f"{args.outputfile} moved to {final_file}")
+                        if log is not None: rotate_log(args, log, chunk)
+                        writer.write(df, append=False)
+                    else: 
+                        writer.write(df)
+
+                    finish_chunk(args, redactomatic, log, chunk, df, _write_start)
+                    rows+=len(df)
+                    if checkpoint is not None and (chunk+1)%args.checkpointevery==0:
+                        save_checkpoint(checkpoint, options, file_ix, rows, chunk+1, redactomatic, pool, writer, log)
                 
-                #Quit if the chunklimit has been reached.
-                if (args.chunklimit is not None) and (chunk+1>=args.chunklimit):
-                    if (args.verbose): print(f"QUIT. chunklimit reached:{args.chunklimit}\n")
-                    break
+                    #Quit if the chunklimit has been reached.  The checkpoint is saved here so that the run can be continued with --resume.
+                    if (args.chunklimit is not None) and (chunk+1>=args.chunklimit):
+                        if (args.verbose): print(f"QUIT. chunklimit reached:{args.chunklimit}\n")
+                        if checkpoint is not None and (chunk+1)%args.checkpointevery!=0:
+                            save_checkpoint(checkpoint, options, file_ix, rows, chunk+1, redactomatic, pool, writer, log)
+                        stopped=True
+                        chunk=chunk+1
+                        break
+
+                    chunk=chunk+1
+
+                if args.prefetch is not None: df_iter.close()
+
+                # Move final chunk to destination if using chunked output
+                if args.chunkgather is not None:
+                    final_file = f"{args.chunkoutstem}_{chunk-1}{writer.extension}"
+                    writer.rotate(final_file)
+                    if (args.verbose): print(f"{args.outputfile} moved to {final_file}")
+                    if log is not None: rotate_log(args, log, chunk)
 
-                chunk=chunk+1
+                if checkpoint is not None and not stopped: save_checkpoint(checkpoint, options, file_ix+1, 0, chunk, redactomatic, pool, writer, log)
 
-            # Move final chunk to destination if using chunked output
-            if args.chunkgather is not None:
-                final_file = f"{args.chunkoutstem}_{chunk-1}.csv"
-                shutil.move(args.outputfile, final_file)
-                if (args.verbose): print(f"{args.outputfile} moved to {final_file}")
+        if writer is not None: writer.close()
 
         # write audit log
-        if args.log:
+        if log is not None:
+            log.close()
+        elif args.log:
             if (args.verbose): print("Writing logfile", args.log)
             redactomatic.write_log(args.log)
 
+        #Report the peak size of the entity maps. With --workers they are held in the workers and only span a chunk.
+        if (args.verbose) and args.workers is None:
+            for name, stats in redactomatic.entity_map_stats().items():
+                print(f"Peak {name} entity map size: {stats['peak_entries']} entries, ~{stats['peak_bytes']} bytes. Conversations evicted: {stats['evicted']}.")
+
+        if (args.verbose) and args.workers is None and redactomatic.pipeline.memo is not None:
+            stats=redactomatic.pipeline.memo.stats()
+            print(f"Memo cache hit rate: {100*stats['hit_rate']:.1f}% ({stats['hits']} of {stats['texts']} texts).")
+
+        #Texts that timed out are reported whether or not --verbose is given, so that they are not missed in a scheduled run.
+        _count=redactomatic.pipeline.quarantine.count
+        if _count: print(f"WARNING: {_count} texts timed out and were quarantined"+(f" in {args.quarantinefile}." if args.quarantinefile else ". Use --quarantinefile to list them."), file=sys.stderr)
+
+        if redactomatic.profile is not None:
+            redactomatic.profile.write(args.profile)
+            if (args.verbose): print("Profile written to", args.profile)
+
+        redactomatic.close()
+        if args.workers is not None: pool.close()
+        #A run stopped by --chunklimit keeps its checkpoint so that it can be continued with --resume.
+        if checkpoint is not None and not stopped: checkpoint.remove()
+        if (args.verbose): print(f"Pipeline build time: {redactomatic.pipeline.build_time:.3f}s. Processing time: {process_time:.3f}s.")
         if (args.verbose): print("Done.")
 
 if __name__ == "__main__":
@@ -0,0 +1,127 @@
+import string
+
+#The regular expression parser used by xeger.  sre_parse is deprecated in favour of re._parser from Python 3.11.
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+'''Module implementing a generator of random strings matching a regular expression.  It draws the same random numbers as xeger.Xeger and returns the same strings,
+but the regular expression is parsed and turned into a tree of functions once, instead of being parsed and interpreted again for every string.'''
+
+#The characters drawn by '.' and by negated character classes, as in xeger.
+_PRINTABLE=string.printable
+_ANY=string.printable.replace('\n', '')
+
+#The characters of each category (e.g. \d), as in xeger.
+_CATEGORIES={
+    "category_digit": string.digits,
+    "category_not_digit": string.ascii_letters + string.punctuation,
+    "category_space": string.whitespace,
+    "category_not_space": string.printable.strip(),
+    "category_word": string.ascii_letters + string.digits + '_',
+    "category_not_word": ''.join(set(string.printable).difference(string.ascii_letters + string.digits + '_')),
+}
+
+## RegexGenerator class ##
+
+# Generates random strings matching a regular expression with a random.Random instance, e.g. the shared random generator of the entity rules so that --seed
+# is deterministic.  Repeats are limited to limit times.  Raises ValueError when it is constructed if the expression uses a construct that xeger does not support.
+class RegexGenerator():
+    def __init__(self, pattern, limit=10, random=None):
+        self._limit=limit
+        self._random=random
+        #The text of each numbered group generated so far by the current call, for back references.
+        self._groups={}
+        #The characters that the generated strings can contain, collected as the regex is compiled.
+        self._characters=set()
+        try:
+            parsed=sre_parse.parse(getattr(pattern, "pattern", pattern))
+            self._generate=self.compile_sequence(parsed)
+        except KeyError as e:
+            raise ValueError(f"Cannot generate strings from the regular expression {pattern}: {e} is not supported.")
+
+    '''Return a random string matching the regular expression.'''
+    def __call__(self):
+        result=self._generate()
+        self._groups.clear()
+        return result
+
+    @property
+    def characters(self):
+        '''Return the set of characters that the generated strings can contain.'''
+        return self._characters
+
+    '''Return a function that generates the concatenation of a sequence of parsed states.'''
+    def compile_sequence(self, states):
+        functions=[self.compile_state(state) for state in states]
+        if all(isinstance(f, str) for f in functions):
+            text=''.join(functions)
+            return lambda: text
+        functions=[(lambda f=f: f) if isinstance(f, str) else f for f in functions]
+        if len(functions)==1: return functions[0]
+        return lambda: ''.join([f() for f in functions])
+
+    '''Return the string of a state that does not draw a random number, or a function that generates it.'''
+    def compile_state(self, state):
+        opcode, value = state
+        name=str(opcode).lower()
+        if name=="literal":
+            self._characters.add(chr(value))
+            return chr(value)
+        if name=="at" or name=="assert_not": return ''
+        if name=="not_literal":
+            candidates=_PRINTABLE.replace(chr(value), '')
+            self._characters.update(candidates)
+            return lambda: self._random.choice(candidates)
+        if name=="any":
+            self._characters.update(_ANY)
+            return lambda: self._random.choice(_ANY)
+        if name=="in": return self.compile_in(value)
+        if name=="category":
+            self._characters.update(_CATEGORIES[name_of(value)])
+            return _CATEGORIES[name_of(value)]
+        if name=="branch":
+            branches=[self.compile_sequence(branch) for branch in value[1]]
+            return lambda: self._random.choice(branches)()
+        if name=="subpattern": return self.compile_group(value)
+        if name=="assert": return self.compile_sequence(value[1])
+        if name=="groupref": return lambda: self._groups[value]
+        if name=="min_repeat" or name=="max_repeat": return self.compile_repeat(*value)
+        raise KeyError(name)
+
+    '''Return a function that draws a character from a character class.  The candidates do not depend on the random numbers so they are only listed once.'''
+    def compile_in(self, items):
+        candidates=[]
+        for opcode, value in items:
+            name=str(opcode).lower()
+            if name=="literal": candidates.append(chr(value))
+            elif name=="range": candidates.extend(chr(i) for i in range(value[0], value[1]+1))
+            elif name=="category": candidates.extend(_CATEGORIES[name_of(value)])
+            elif name=="negate": candidates.append(False)
+            else: raise KeyError(name)
+        if candidates and candidates[0] is False:
+            candidates=list(set(_PRINTABLE).difference(candidates[1:]))
+        self._characters.update(candidates)
+        return lambda: self._random.choice(candidates)
+
+    '''Return a function that generates a group and remembers it if it is numbered.'''
+    def compile_group(self, value):
+        group=value[0]
+        generate=self.compile_sequence(value[3])
+        if not group: return generate
+        def generate_group():
+            result=generate()
+            self._groups[group]=result
+            return result
+        return generate_group
+
+    '''Return a function that generates a repeat, drawing the number of times between start and end, which is limited to the limit of the generator.'''
+    def compile_repeat(self, start, end, items):
+        end=max(start, min(end, self._limit))
+        generate=self.compile_sequence(items)
+        return lambda: ''.join([generate() for _ in range(self._random.randint(start, end))])
+
+'''Return the lower case name of a parser constant such as a category, e.g. 'category_digit'.'''
+def name_of(constant):
+    return str(constant).lower()
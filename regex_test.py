@@ -5,6 +5,9 @@ import regex_utils as ru
 import entity_rules as er
 from enum import Enum
 import sys
+import math
+import time
+import multiprocessing
 
 class MatchType(Enum):
     ONE_OR_MORE_MATCH               =0
@@ -16,154 +19,255 @@ class MatchType(Enum):
     NO_EXACT_MATCHES                =6
     NO_PARTIAL_MATCHES              =7    
 
+#The columns of the test report, in the order they have always been written.
+REPORT_COLUMNS=['regex_id','test_type','pass','group','ix','match','left','matched_text','right','test_text','pattern_ix']
+
+#The columns of the regex cost report.
+COST_COLUMNS=['rank','regex_id','pattern_ix','risk','seconds','length','growth','timed_out','pump']
+
+#The lengths of the adversarial texts each pattern is timed against.  Each length is double the previous one so that the growth in time can be measured.
+COST_LENGTHS=[64,128,256,512,1024,2048]
+
+#The time in seconds that a single search may take before it is stopped and the pattern is flagged.
+COST_TIMEOUT=0.25
+
+#Strings that are repeated to make the adversarial texts, as well as the words of the test phrases of each regex-id.
+GENERIC_PUMPS=["a","1","a ","1 ","a1","a-","1-"," ","."]
+
+#The character that ends each adversarial text so that patterns that could match the whole text have to fail and backtrack.
+COST_SUFFIX="!"
+
+#The most strings that are repeated to make adversarial texts for each regex-id.
+MAX_PUMPS=24
+
 class RegexTest():
     def __init__(self, entity_rules):
         self._entity_rules=entity_rules
 
-    def test_regex(self, report_filename):
+    '''Run the tests in the regex-test section and save a row for each match in report_filename.  With workers the regex-ids are tested in that many processes.
+    With cost_filename each pattern of the tested regex-ids is also timed against adversarial texts and ranked by cost, to find patterns that may backtrack catastrophically.'''
+    def test_regex(self, report_filename, cost_filename=None, workers=None):
         if self._entity_rules.args.verbose:   print ("Testing regular expressions...")
         _phrase_fail_count=0
         _test_fail_count=0
-                
-        #Prepare an empty data frame for the results.        
-        df=pd.DataFrame(columns = ['regex_id', 'test_type','pass','group', 'ix', 'match','left','matched_text','right'])
-
-        #Step through each regex-id in the regex-test section
-        for _regex_id, _test_rule_set in self._entity_rules.regex_test_set.items():
-            if self._entity_rules.args.verbose:   print("Testing ",_regex_id)
-            #Step through each test rule for this regex-id
-            for _test_rule in _test_rule_set:            
-                _group=_test_rule.get("group",0)  
-                _engine_type=ru.to_engine_type(_test_rule.get("engine","REGEX").upper())
-                _match_type=MatchType[_test_rule.get("match-type","ONE_OR_MORE_MATCH").upper()]
-                _flags=ru.flags_from_array(_test_rule.get("flags",["IGNORECASE"]),_engine_type)
-
-                #Get the regex rules and make them a list
-                _regex_set=self._entity_rules.get_regex_set(_regex_id)
- 
-                #compile the patterns with the designated regular expression engine..
-                try:
-                    _pattern_set = [ru.compile(r, _flags, _engine_type) for r in _regex_set]
-                except Exception as exc:
-                    raise Exception("ERROR: Failed to compile regex set for ':"+_regex_id+"' with error: "+str(exc))
-
-                #now get the test sentences
-                _test_phrases=_test_rule["phrases"]
-
-                #Get the regex test module
-                #_modulename=_test_rule["module"]
-
-                #If the rule fails any sentences then the test for the whole rule fails.
-                _test_pass=True   
-                
-                #Step through each test phrase in this test rule.
-                for test_text in _test_phrases:
-                    df_utt_result=pd.DataFrame()
-                    #loop through the regex patterns and try to match at least one of them.
-                    _exact_match_count=0
-                    _partial_match_count=0
-                    _match_count=0
-                    _pattern_ix=0
-                    for pattern in _pattern_set:
-                        _pattern_ix+=1
-                        matches = list(pattern.finditer(test_text))
-
-                        for e in matches:  
-                            #name=entity-text found by pattern
-                            try:
-                                _matched_text = e.group(_group)
-                                _match_count +=1
-                                
-                                _start = e.start(_group)
-                                _end= e.end(_group)
-                                _matched_all=(_matched_text==test_text)
-                                _left_text=test_text[:_start]
-                                _right_text=test_text[_end:]
-                                if (_matched_all): _exact_match_count+=1
-                                else: _partial_match_count+=1
-
-                                result={
-                                    'regex_id':_regex_id,
-                                    'group': _group,
-                                    'ix' : _match_count,
-                                    'match': "exact" if _matched_all else "partial",
-                                    'test_text': test_text,
-                                    'pattern_ix': _pattern_ix,
-                                    'left' : _left_text,
-                                    'matched_text' : _matched_text,
-                                    'right' : _right_text
-                                }
-                            except:
-                                result={
-                                    'regex_id':_regex_id,
-                                    'group': _group,
-                                    'ix' : 0,
-                                    'match': "group-not-matched",
-                                    'test_text': test_text,
-                                    'pattern_ix': _pattern_ix,
-                                    'left' : "",
-                                    'matched_text' : "",
-                                    'right' : ""
-                                }                                
-                            #Add this match result to the data frame
-                            df_utt_result=pd.concat([df_utt_result,pd.DataFrame(result,index=[0])])
-                        if len(matches)==0:
-                            result={
-                                'regex_id':_regex_id,
-                                'group': _group,
-                                'ix' : 0,
-                                'match': "none",
-                                'test_text': test_text,
-                                'pattern_ix': _pattern_ix,
-                                'left' : "",
-                                'matched_text' : "",
-                                'right' : ""
-                            }
-                            df_utt_result=pd.concat([df_utt_result,pd.DataFrame(result,index=[0])])
-                    
-                    #Now work out if this utterance passed or failed the test, and add the result to all results for this utterance.
-                    #print (_match_type,_exact_match_count,_partial_match_count,len(_pattern_set))
-                    _phrase_test_pass=self.get_pass_fail(_match_type,_exact_match_count,_partial_match_count,len(_pattern_set))
-                    df_utt_result["test_type"]=str(_match_type)                    
-                    df_utt_result["pass"]=_phrase_test_pass
-                    df=pd.concat([df,df_utt_result])
-
-                    if (not _phrase_test_pass): 
-                        print ("FAIL: regex-id: "+_regex_id +" => '"+str(test_text)+"' "+str(_match_type)+" "+str(_flags),file=sys.sderr)
-                        _test_pass=False
-                        _phrase_fail_count +=1
-                if not _test_pass:
-                    _test_fail_count += 1
-
-        #save the test results
+        _records=[]
+        _costs=[]
+
+        #Each regex-id is tested independently of the others by test_regex_id(), which is given the regular expressions and test rules of the regex-id.
+        _tasks=[(_regex_id, _test_rule_set, self._entity_rules.get_regex_set(_regex_id), cost_filename is not None) for _regex_id, _test_rule_set in self._entity_rules.regex_test_set.items()]
+        _pool=None
+        if workers is not None and workers>1:
+            _pool=multiprocessing.Pool(workers)
+            _results=_pool.imap(test_regex_id, _tasks)
+        else:
+            _results=map(test_regex_id, _tasks)
+
+        #The results are taken in the order of the regex-ids so the report is the same whatever the number of workers.
+        for _task, (_regex_records, _failures, _failed_rules, _regex_costs) in zip(_tasks, _results):
+            if self._entity_rules.args.verbose:   print("Testing ",_task[0])
+            for _failure in _failures: print(_failure, file=sys.stderr)
+            _records.extend(_regex_records)
+            _costs.extend(_regex_costs)
+            _phrase_fail_count+=len(_failures)
+            _test_fail_count+=_failed_rules
+        if _pool is not None:
+            _pool.close()
+            _pool.join()
+
+        #save the test results.  Every row has the index 0 and the pattern numbers are floats, as in the reports written before.
         if self._entity_rules.args.verbose:   print("Saving test report to:",report_filename)
+        df=pd.DataFrame.from_records(_records, columns=REPORT_COLUMNS, index=[0]*len(_records))
+        df["pattern_ix"]=df["pattern_ix"].astype(float)
         df.to_csv(report_filename)
 
+        if cost_filename is not None: self.save_costs(_costs, cost_filename)
+
         if (_test_fail_count>0): print("FAIL: Regular expression test failed with "+str(_test_fail_count)+" broken rule(s) and "+str(_phrase_fail_count)+" non-matching phrase(s).",file=sys.stderr)
         else: print("PASS: Regular expression tests completed successfully.",file=sys.stderr)
-        
-    def get_pass_fail(self,match_type,exact_match_count,partial_match_count,pattern_count):
-        if match_type is MatchType.ONE_OR_MORE_MATCH:
-            return (exact_match_count+partial_match_count)>0
-
-        if match_type is MatchType.ONE_OR_MORE_EXACT_MATCH:
-            return exact_match_count>0
-        
-        if match_type is MatchType.ONE_OR_MORE_PARTIAL_MATCH:
-            return partial_match_count>0
-        
-        if match_type is MatchType.ALL_EXACT_MATCH:
-            return pattern_count==exact_match_count        
-        
-        if match_type is MatchType.ALL_PARTIAL_MATCH:
-            return pattern_count==partial_match_count      
-
-        if match_type is MatchType.NO_MATCHES:
-            return (exact_match_count+partial_match_count)==0  
-        
-        if match_type is MatchType.NO_EXACT_MATCHES:
-            return exact_match_count==0        
-        
-        if match_type is MatchType.NO_PARTIAL_MATCHES:
-            return partial_match_count==0      
+
+    '''Rank the patterns by their cost, warn about those that may backtrack catastrophically and save the ranking in cost_filename.'''
+    def save_costs(self, costs, cost_filename):
+        costs=sorted(costs, key=cost_key, reverse=True)
+        for _rank, _cost in enumerate(costs, start=1):
+            _cost["rank"]=_rank
+            if _cost["risk"]!="ok":
+                print(f"WARNING: regex-id '{_cost['regex_id']}' pattern {_cost['pattern_ix']} may backtrack catastrophically ({_cost['risk']}): {_cost['seconds']:.4f}s on {_cost['length']} characters of {_cost['pump']!r}"+(" before the search was stopped." if _cost["timed_out"] else "."), file=sys.stderr)
+        if self._entity_rules.args.verbose:   print("Saving regex cost report to:",cost_filename)
+        pd.DataFrame.from_records(costs, columns=COST_COLUMNS).to_csv(cost_filename, index=False)
+
+'''Run the test rules of a regex-id against its regular expressions.  The task is a tuple of the regex-id, its test rules, its regular expressions and whether to time
+the patterns against adversarial texts.  Returns the report rows, the failure messages, the number of failed test rules and the cost of each pattern (or an empty list).
+This is a module function so that it can be run in a multiprocessing pool.'''
+def test_regex_id(task):
+    _regex_id, _test_rule_set, _regex_set, _with_costs = task
+    _records=[]
+    _failures=[]
+    _test_fail_count=0
+
+    #Step through each test rule for this regex-id
+    for _test_rule in _test_rule_set:
+        _group=_test_rule.get("group",0)
+        _engine_type=ru.to_engine_type(_test_rule.get("engine","REGEX").upper())
+        _match_type=MatchType[_test_rule.get("match-type","ONE_OR_MORE_MATCH").upper()]
+        _flags=ru.flags_from_array(_test_rule.get("flags",["IGNORECASE"]),_engine_type)
+
+        #compile the patterns with the designated regular expression engine..
+        _pattern_set=compile_patterns(_regex_id, _regex_set, _flags, _engine_type)
+
+        #If the rule fails any sentences then the test for the whole rule fails.
+        _test_pass=True
+
+        #Step through each test phrase in this test rule.
+        for test_text in _test_rule["phrases"]:
+            _utt_records=[]
+            #loop through the regex patterns and try to match at least one of them.
+            _exact_match_count=0
+            _partial_match_count=0
+            _match_count=0
+            for _pattern_ix, pattern in enumerate(_pattern_set, start=1):
+                matches = list(pattern.finditer(test_text))
+
+                for e in matches:
+                    #name=entity-text found by pattern
+                    try:
+                        _matched_text = e.group(_group)
+                        _match_count +=1
+                        _start = e.start(_group)
+                        _end= e.end(_group)
+                        _matched_all=(_matched_text==test_text)
+                        if (_matched_all): _exact_match_count+=1
+                        else: _partial_match_count+=1
+                        _utt_records.append(report_record(_regex_id, _group, _match_count, "exact" if _matched_all else "partial", test_text, _pattern_ix, test_text[:_start], _matched_text, test_text[_end:]))
+                    except:
+                        _utt_records.append(report_record(_regex_id, _group, 0, "group-not-matched", test_text, _pattern_ix))
+                if len(matches)==0:
+                    _utt_records.append(report_record(_regex_id, _group, 0, "none", test_text, _pattern_ix))
+
+            #Now work out if this utterance passed or failed the test, and add the result to all results for this utterance.
+            _phrase_test_pass=get_pass_fail(_match_type,_exact_match_count,_partial_match_count,len(_pattern_set))
+            for _record in _utt_records:
+                _record["test_type"]=str(_match_type)
+                _record["pass"]=_phrase_test_pass
+            _records.extend(_utt_records)
+
+            if (not _phrase_test_pass):
+                _failures.append("FAIL: regex-id: "+_regex_id +" => '"+str(test_text)+"' "+str(_match_type)+" "+str(_flags))
+                _test_pass=False
+        if not _test_pass:
+            _test_fail_count += 1
+
+    _costs=[]
+    if _with_costs:
+        _costs=regex_costs(_regex_id, _regex_set, [str(p) for _test_rule in _test_rule_set for p in _test_rule["phrases"]])
+    return _records, _failures, _test_fail_count, _costs
+
+'''Compile a regex set with the designated regular expression engine.'''
+def compile_patterns(regex_id, regex_set, flags, engine_type):
+    try:
+        return [ru.compile(r, flags, engine_type) for r in regex_set]
+    except Exception as exc:
+        raise Exception("ERROR: Failed to compile regex set for ':"+regex_id+"' with error: "+str(exc))
+
+'''Return a row of the test report.  The test type and pass columns are added once the phrase has been tested against every pattern.'''
+def report_record(regex_id, group, ix, match, test_text, pattern_ix, left="", matched_text="", right=""):
+    return {
+        'regex_id':regex_id,
+        'group': group,
+        'ix' : ix,
+        'match': match,
+        'test_text': test_text,
+        'pattern_ix': pattern_ix,
+        'left' : left,
+        'matched_text' : matched_text,
+        'right' : right
+    }
+
+## Regex cost measurement ##
+
+'''Time each pattern of a regex set against adversarial texts and return a cost record for each.  The texts repeat a short string (e.g. "1 " or a word of a test
+phrase) up to each of COST_LENGTHS and end with a character that the patterns are unlikely to match, which makes nested or overlapping repeats try every way of
+splitting the text.  The patterns are compiled with the regex engine and IGNORECASE, as the regex redactors compile them by default, so that a search can be stopped
+after COST_TIMEOUT seconds.  The cost of a pattern is that of its most expensive string.'''
+def regex_costs(regex_id, regex_set, phrases):
+    _pumps=adversarial_pumps(phrases)
+    _pattern_set=compile_patterns(regex_id, regex_set, ru.flag_from_string("IGNORECASE", ru.EngineType.REGEX), ru.EngineType.REGEX)
+    _costs=[]
+    for _pattern_ix, pattern in enumerate(_pattern_set, start=1):
+        _worst=max((pump_cost(pattern, pump) for pump in _pumps), key=cost_key)
+        _worst.update({"regex_id": regex_id, "pattern_ix": _pattern_ix})
+        _costs.append(_worst)
+    return _costs
+
+'''Return the strings that are repeated to make the adversarial texts: the generic strings, then each test phrase and each of its words followed by a space.'''
+def adversarial_pumps(phrases):
+    _pumps=list(GENERIC_PUMPS)
+    for _phrase in phrases:
+        for _pump in [_phrase+" "]+[w+" " for w in _phrase.split()]:
+            if _pump.strip() and _pump not in _pumps: _pumps.append(_pump)
+    return _pumps[:MAX_PUMPS]
+
+'''Time a pattern against texts of a repeated string, doubling the length until a search is stopped by the timeout, and return the cost at the longest text.
+The growth is the base 2 logarithm of the ratio of the times at the last two lengths: about 1 when the time is linear in the length and 2 when it is quadratic, and
+only a lower bound when the search was stopped.'''
+def pump_cost(pattern, pump):
+    _seconds=None
+    _growth=None
+    for _length in COST_LENGTHS:
+        _text=pump*max(1, _length//len(pump))+COST_SUFFIX
+        _previous=_seconds
+        _seconds, _timed_out = time_search(pattern, _text)
+        #Very short times are mostly noise so the growth is only measured once the searches take a while.
+        if _previous is not None and _previous>=1e-4: _growth=math.log2(_seconds/_previous)
+        if _timed_out: break
+    if _timed_out: _risk="timeout"
+    elif _growth is not None and _growth>3: _risk="exponential"
+    elif _growth is not None and _growth>1.5 and _seconds>=1e-2: _risk="polynomial"
+    else: _risk="ok"
+    return {"risk": _risk, "seconds": _seconds, "length": len(_text), "growth": _growth, "timed_out": _timed_out, "pump": pump}
+
+'''Return the time taken to find every match of a pattern in a text and whether the search was stopped after COST_TIMEOUT seconds.  Fast searches are repeated
+and the shortest time is taken.'''
+def time_search(pattern, text):
+    _best=None
+    for _ in range(3):
+        _start=time.perf_counter()
+        try:
+            for _ in pattern.finditer(text, timeout=COST_TIMEOUT): pass
+        except TimeoutError:
+            return COST_TIMEOUT, True
+        _seconds=time.perf_counter()-_start
+        _best=_seconds if _best is None else min(_best, _seconds)
+        if _seconds>1e-2: break
+    return _best, False
+
+'''Return the key that the patterns are ranked by: searches that were stopped first, then the shortest text that stopped them, then the time at the longest text.'''
+def cost_key(cost):
+    if cost["timed_out"]: return (1, -cost["length"])
+    return (0, cost["seconds"])
+
+'''Return whether a phrase passed a test of match_type given the number of exact and partial matches of the patterns.'''
+def get_pass_fail(match_type,exact_match_count,partial_match_count,pattern_count):
+    if match_type is MatchType.ONE_OR_MORE_MATCH:
+        return (exact_match_count+partial_match_count)>0
+
+    if match_type is MatchType.ONE_OR_MORE_EXACT_MATCH:
+        return exact_match_count>0
+    
+    if match_type is MatchType.ONE_OR_MORE_PARTIAL_MATCH:
+        return partial_match_count>0
+    
+    if match_type is MatchType.ALL_EXACT_MATCH:
+        return pattern_count==exact_match_count        
+    
+    if match_type is MatchType.ALL_PARTIAL_MATCH:
+        return pattern_count==partial_match_count      
+
+    if match_type is MatchType.NO_MATCHES:
+        return (exact_match_count+partial_match_count)==0  
+    
+    if match_type is MatchType.NO_EXACT_MATCHES:
+        return exact_match_count==0        
+    
+    if match_type is MatchType.NO_PARTIAL_MATCHES:
+        return partial_match_count==0      
 
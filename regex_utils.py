@@ -74,8 +74,12 @@ def list_to_regex(regex_set):
     #print (f'list_to_regex: {_regex}')
     return _regex
 
-'''Compile a list of phrases or regular expressions ready for redaction.  Add pre_regex and post_regex to top and tail each set member.  If combine_set=True, complie the list into a single pipe separated regex, otherwise returns a list or regexs.'''
-def compile_set(regex_set,pre_regex='',post_regex='',single_regex=True,flags=0,etype=EngineType.REGEX):
+'''Compile a list of phrases or regular expressions ready for redaction.  Add pre_regex and post_regex to top and tail each set member.  If combine_set=True, complie the list into a single pipe separated regex, otherwise returns a list or regexs.  If inline=True then subroutine calls to DEFINE groups are expanded in place (see inline_subroutines()), except in members that define a group named in keep.'''
+def compile_set(regex_set,pre_regex='',post_regex='',single_regex=True,flags=0,etype=EngineType.REGEX,inline=False,keep=[]):
+    #Inlining only applies to the regex engine as the re engine does not support subroutine calls.
+    if inline and etype==EngineType.REGEX:
+        regex_set=[inline_subroutines(r,flags,keep) for r in regex_set]
+
     #single_regex=True is a lot more efficient. Only set it to false if there is a problem with the size of the combined regular expression.
     _pattern_set=None
     if single_regex:
@@ -87,4 +91,115 @@ def compile_set(regex_set,pre_regex='',post_regex='',single_regex=True,flags=0,e
 
     #print(f'regex: {str(_pattern_set)}')
     
-    return _pattern_set
\ No newline at end of file
+    return _pattern_set
+
+## Subroutine inlining ##
+
+#Patterns used to find the named groups, subroutine calls and constructs that prevent a pattern from being inlined safely.
+_NAMED_GROUP=regex.compile(r'\(\?P?<(\w+)>')
+_SUBROUTINE_CALL=regex.compile(r'\(\?(?:&|P>)(\w+)\)')
+_NOT_INLINABLE=regex.compile(r'\\[1-9]|\\g<|\\k<|\(\?P=|\(\?R\)|\(\?[+-]?\d+\)|\(\?\((?!DEFINE\))')
+
+'''Return a dictionary mapping the index of each opening bracket of a group in s to the index of its closing bracket. Escapes, character classes and (if verbose) comments are skipped.'''
+def group_spans(s, verbose=False):
+    stack=[]
+    spans={}
+    i=0
+    n=len(s)
+    while i<n:
+        c=s[i]
+        if c=='\\':
+            i+=2
+            continue
+        if c=='[':
+            #Skip to the end of the character class.  A ']' straight after '[' or '[^' is a literal.
+            i+=1
+            if i<n and s[i]=='^': i+=1
+            if i<n and s[i]==']': i+=1
+            while i<n and s[i]!=']':
+                i+=2 if s[i]=='\\' else 1
+        elif verbose and c=='#':
+            j=s.find('\n',i)
+            i=n if j<0 else j
+            continue
+        elif c=='(':
+            stack.append(i)
+        elif c==')':
+            if not stack: raise ValueError(f"Unbalanced ')' at position {i}")
+            spans[stack.pop()]=i
+        i+=1
+    if stack: raise ValueError(f"Unbalanced '(' at position {stack[-1]}")
+    return spans
+
+'''Return true if the pattern will be compiled in verbose mode, either because of the flags or a leading inline flag group such as (?xi).'''
+def is_verbose(s, flags=0):
+    return bool(flags & regex.VERBOSE) or bool(regex.match(r'\s*\(\?[a-zA-Z]*x[a-zA-Z]*\)', s))
+
+'''Replace every group in s with a non-capturing group so that it can be copied without changing the numbering or names of the groups in the pattern.'''
+def make_non_capturing(s, verbose=False):
+    out=[]
+    last=0
+    for o in sorted(group_spans(s, verbose)):
+        m=_NAMED_GROUP.match(s, o)
+        if m:
+            out.append(s[last:o])
+            out.append('(?:')
+            last=m.end()
+        elif not s.startswith('(?', o):
+            out.append(s[last:o])
+            out.append('(?:')
+            last=o+1
+    out.append(s[last:])
+    return ''.join(out)
+
+'''Expand the subroutine calls (?&name) to groups defined in a (?(DEFINE)...) block in place, so that the regex engine does not have to make a call at every attempt.
+The DEFINE block is left as it is so the numbering and names of the groups in the pattern do not change, and the copies of the definitions are made non-capturing.
+Subroutine calls in the regex module are not atomic so the expanded pattern matches exactly the same text.  The pattern is returned unchanged if it has no DEFINE block,
+or if it uses recursion, backreferences, conditionals, numbered calls or calls to groups outside a DEFINE block, or if it defines any of the group names in keep (e.g. a group whose captures are needed).'''
+def inline_subroutines(s, flags=0, keep=[]):
+    if '(?(DEFINE)' not in s or _NOT_INLINABLE.search(s): return s
+    verbose=is_verbose(s, flags)
+    spans=group_spans(s, verbose)
+    blocks=[(o,c) for o,c in spans.items() if s.startswith('(?(DEFINE)', o)]
+
+    #Collect the bodies of the named groups in the DEFINE blocks.
+    definitions={}
+    for o,c in spans.items():
+        m=_NAMED_GROUP.match(s, o)
+        if m and any(bo<o<bc for bo,bc in blocks):
+            if m.group(1) in definitions or m.group(1) in keep: return s
+            definitions[m.group(1)]=s[m.end():c]
+
+    expanded={}
+    def expand(body, calling):
+        out=[]
+        last=0
+        for o,c in sorted(group_spans(body, verbose).items()):
+            if o<last: continue
+            m=_SUBROUTINE_CALL.fullmatch(body, o, c+1)
+            if m:
+                out.append(body[last:o])
+                out.append('(?:'+definition(m.group(1), calling)+('\n)' if verbose else ')'))
+                last=c+1
+        out.append(body[last:])
+        return ''.join(out)
+
+    def definition(name, calling):
+        if name not in definitions or name in calling: raise ValueError(f"Cannot inline the call to group '{name}'")
+        if name not in expanded:
+            expanded[name]=expand(make_non_capturing(definitions[name], verbose), calling+[name])
+        return expanded[name]
+
+    #Expand the calls outside the DEFINE blocks, leaving the blocks themselves untouched.
+    try:
+        out=[]
+        last=0
+        for bo,bc in sorted(blocks):
+            if bo<last: continue
+            out.append(expand(s[last:bo], []))
+            out.append(s[bo:bc+1])
+            last=bc+1
+        out.append(expand(s[last:], []))
+    except ValueError:
+        return s
+    return ''.join(out)
@@ -0,0 +1,253 @@
+import os
+import sys
+import stat
+import json
+import time
+import queue
+import signal
+import threading
+import collections
+import socketserver
+import concurrent.futures
+import http.server
+
+'''Module implementing the redaction server (--serve) which keeps the rules and models warm and redacts batches of texts sent to it over HTTP.'''
+
+#The number of recent requests whose latencies are kept for the percentiles reported by /stats.
+LATENCY_WINDOW=10000
+
+#The latency percentiles reported by /stats.
+PERCENTILES=[50, 90, 99]
+
+## LatencyStats class ##
+
+# Keeps the latencies of the most recent requests and reports their percentiles.
+class LatencyStats():
+    def __init__(self, size=LATENCY_WINDOW):
+        self._latencies=collections.deque(maxlen=size)
+        self._lock=threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    '''Return a dictionary of the latency percentiles and maximum in milliseconds, using the nearest rank.'''
+    def report(self):
+        with self._lock:
+            _latencies=sorted(self._latencies)
+        if not _latencies: return {}
+        _report={f"p{p}_ms": 1000*_latencies[max(0, -(-p*len(_latencies)//100)-1)] for p in PERCENTILES}
+        _report["max_ms"]=1000*_latencies[-1]
+        _report["window"]=len(_latencies)
+        return _report
+
+## Batcher class ##
+
+# Runs the requests through a redactomatic processor in a single thread, so that the entity maps are only used by one thread at a time.
+# Requests that arrive within batch_wait seconds of each other are redacted together, up to batch_size texts, so that the
+# redactors (e.g. the spaCy NER stage) see one large batch instead of many small ones.
+# The entities of a conversation are remembered so that they are replaced consistently across requests, until the conversation
+# has not been seen for ttl seconds.
+class Batcher():
+    def __init__(self, redactomatic, batch_size, batch_wait, ttl=None):
+        self._redactomatic=redactomatic
+        self._batch_size=batch_size
+        self._batch_wait=batch_wait
+        self._ttl=ttl
+        self._queue=queue.Queue()
+        self._last_seen=collections.OrderedDict()
+        self._latency=LatencyStats()
+        self._counts={"requests": 0, "texts": 0, "batches": 0, "errors": 0, "expired": 0}
+        self._lock=threading.Lock()
+        self._thread=threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    '''Queue texts and their conversation ids to be redacted and return a future for the redacted texts.'''
+    def submit(self, texts, ids):
+        future=concurrent.futures.Future()
+        self._queue.put((texts, ids, future, time.perf_counter()))
+        return future
+
+    '''Take the queued requests in batches and redact them until the batcher is closed.'''
+    def run(self):
+        stopping=False
+        while not stopping:
+            item=self._queue.get()
+            if item is None: return
+            batch=[item]
+            size=len(item[0])
+            deadline=time.perf_counter()+self._batch_wait
+            while size<self._batch_size:
+                try:
+                    item=self._queue.get(timeout=max(0.0, deadline-time.perf_counter()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping=True
+                    break
+                batch.append(item)
+                size+=len(item[0])
+            self.process(batch)
+
+    '''Redact the texts of a batch of requests together and give each request its own texts back.'''
+    def process(self, batch):
+        texts=[text for request in batch for text in request[0]]
+        ids=[d_id for request in batch for d_id in request[1]]
+        try:
+            texts=self._redactomatic.redact_texts(texts, ids)
+            texts=self._redactomatic.finish_texts(texts, ids)
+        except Exception as e:
+            with self._lock: self._counts["errors"]+=len(batch)
+            for request in batch: request[2].set_exception(e)
+            return
+        finally:
+            #Every label in a text is set again when it is redacted so the entity values are not needed once the batch is done.
+            self._redactomatic.entity_values.clear()
+            self._redactomatic.pipeline.quarantine.flush()
+            self.expire(ids)
+
+        start=0
+        for request in batch:
+            request[2].set_result(texts[start:start+len(request[0])])
+            start+=len(request[0])
+            self._latency.add(time.perf_counter()-request[3])
+        with self._lock:
+            self._counts["requests"]+=len(batch)
+            self._counts["texts"]+=len(texts)
+            self._counts["batches"]+=1
+        if self._redactomatic.profile is not None: self._redactomatic.profile.end_chunk(self._counts["batches"]-1, len(texts))
+
+    '''Mark the conversations as seen and forget the entities of conversations that have not been seen for ttl seconds.'''
+    def expire(self, ids):
+        now=time.monotonic()
+        for d_id in ids:
+            self._last_seen[d_id]=now
+            self._last_seen.move_to_end(d_id)
+        if self._ttl is None: return
+
+        expired=0
+        while self._last_seen and next(iter(self._last_seen.values()))<now-self._ttl:
+            self._last_seen.popitem(last=False)
+            expired+=1
+        if expired:
+            self._redactomatic.close_conversations(self._last_seen)
+            with self._lock: self._counts["expired"]+=expired
+
+    '''Return a dictionary of statistics about the requests served so far.'''
+    def stats(self):
+        with self._lock:
+            _stats=dict(self._counts)
+        _stats["texts_per_batch"]=_stats["texts"]/_stats["batches"] if _stats["batches"] else 0.0
+        _stats["queued"]=self._queue.qsize()
+        _stats["conversations"]=len(self._last_seen)
+        _stats["latency"]=self._latency.report()
+        _stats["quarantined"]=self._redactomatic.pipeline.quarantine.count
+        return _stats
+
+    '''Redact the requests that are already queued then stop.'''
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+## HTTP request handler ##
+
+# Handles the requests to the server:
+#   POST /redact  with a JSON list of {"conversation_id": ..., "text": ...} objects.  Returns the same list with the texts redacted.
+#   GET  /stats   returns a JSON object of statistics about the requests served, the request latencies and the entity maps.
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version="HTTP/1.1"
+
+    def do_POST(self):
+        if self.path!="/redact":
+            self.send_json(404, {"error": f"Unknown path {self.path}. Use POST /redact or GET /stats."})
+            return
+        try:
+            rows=json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            texts, ids = parse_rows(rows)
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        try:
+            texts=self.server.batcher.submit(texts, ids).result()
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+            return
+        self.send_json(200, [{"conversation_id": d_id, "text": text} for d_id, text in zip(ids, texts)])
+
+    def do_GET(self):
+        if self.path!="/stats":
+            self.send_json(404, {"error": f"Unknown path {self.path}. Use POST /redact or GET /stats."})
+            return
+        _stats=self.server.batcher.stats()
+        _stats["uptime_seconds"]=time.monotonic()-self.server.started
+        _stats["entity_maps"]=self.server.redactomatic.entity_map_stats()
+        if self.server.redactomatic.pipeline.memo is not None: _stats["memo_cache"]=self.server.redactomatic.pipeline.memo.stats()
+        self.send_json(200, _stats)
+
+    def send_json(self, status, body):
+        _body=json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(_body)))
+        self.end_headers()
+        self.wfile.write(_body)
+
+    #The client address of a Unix socket is not a (host, port) pair so the requests are logged without it.
+    def log_message(self, format, *args):
+        if self.server.verbose: print(format % args, file=sys.stderr)
+
+'''Return the lists of texts and conversation ids in the rows of a request.  Raises ValueError if the rows are not a list of {"conversation_id", "text"} objects.'''
+def parse_rows(rows):
+    if not isinstance(rows, list): raise ValueError("The request must be a JSON list of {\"conversation_id\": ..., \"text\": ...} objects.")
+    texts=[]
+    ids=[]
+    for i, row in enumerate(rows):
+        if not isinstance(row, dict) or not isinstance(row.get("text"), str):
+            raise ValueError(f"Row {i} of the request must be an object with a string \"text\".")
+        d_id=row.get("conversation_id")
+        if not isinstance(d_id, (str, int)) or isinstance(d_id, bool):
+            raise ValueError(f"Row {i} of the request must have a string or integer \"conversation_id\".")
+        texts.append(row["text"])
+        ids.append(d_id)
+    return texts, ids
+
+class TCPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads=True
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads=True
+
+'''Create the server for an address.  An address of the form host:port is served over HTTP on TCP, anything else is the path of a Unix domain socket.'''
+def create_server(address):
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and "/" not in address:
+        return TCPServer((host or "127.0.0.1", int(port)), RequestHandler)
+    if not hasattr(socketserver, "UnixStreamServer"):
+        raise Exception(f"ERROR: Unix domain sockets are not supported on this platform. Use --serve host:port instead of {address}.")
+    #Remove the socket of a server that was not shut down cleanly, but never a file that is not a socket, e.g. a mistyped output file.
+    if os.path.lexists(address):
+        if not stat.S_ISSOCK(os.lstat(address).st_mode):
+            raise Exception(f"ERROR: Cannot serve on {address} as it is an existing file that is not a socket. Use host:port to serve over TCP.")
+        os.remove(address)
+    return UnixServer(address, RequestHandler)
+
+'''Serve redaction requests with a configured redactomatic processor until the server is interrupted or terminated.'''
+def serve(args, redactomatic):
+    server=create_server(args.serve)
+    server.redactomatic=redactomatic
+    server.batcher=Batcher(redactomatic, args.batchsize, args.batchwait/1000, args.conversationttl)
+    server.verbose=args.verbose
+    server.started=time.monotonic()
+
+    #Stop serving on SIGTERM as well as on Ctrl-C.  shutdown() waits for serve_forever() to return so it is called from another thread.
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    if (args.verbose): print(f"Serving on {args.serve}. POST /redact to redact texts, GET /stats for statistics.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.close()
+        if isinstance(server, UnixServer) and os.path.exists(args.serve) and stat.S_ISSOCK(os.lstat(args.serve).st_mode): os.remove(args.serve)
+    if (args.verbose): print("Server stopped.")
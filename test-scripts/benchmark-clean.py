@@ -0,0 +1,64 @@
+import sys
+import os
+import time
+import argparse
+import regex
+import pandas as pd
+
+#Run from anywhere: the redactomatic modules are in the parent directory.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+import processor_base as pb
+
+# The cleanup implementation before it was precompiled and fused, kept here as the baseline.
+def clean_before(texts):
+    spaces = regex.compile('\s+')
+    dotdot = regex.compile(r'\.\.\.')
+    unknown = regex.compile(r'\<UNK\>')
+    add_space = regex.compile(r'(\]\[)')
+    add_space2 = regex.compile(r'((\w+)\[)')
+    add_space3 = regex.compile(r'(\](\w+))')
+    new_texts = []
+    for text in texts:
+        new_text = dotdot.sub('', text, concurrent=True)
+        new_text = spaces.sub(' ', new_text, concurrent=True)
+        new_text = unknown.sub('', new_text, concurrent=True)
+        new_text = add_space.sub('] [', new_text, concurrent=True)
+        new_text = add_space2.sub(r'\2 [', new_text, concurrent=True)
+        new_text = add_space3.sub(r'] \2', new_text, concurrent=True)
+        new_text = new_text.strip()
+        new_texts.append(new_text)
+    return new_texts
+
+def config_args():
+    parser = argparse.ArgumentParser(description='Measure the rows per second of the text cleanup stage before and after it was fused.')
+    parser.add_argument('inputfile', help='A CSV file of redacted texts, e.g. the output of redactomatic.')
+    parser.add_argument('--column', type=int, default=4, help='The CSV column number containing the text. (default=4)')
+    parser.add_argument('--header', action='store_true', default=False, help='The input file has a header line.')
+    parser.add_argument('--repeat', type=int, default=5, help='The number of times to clean the texts; the best time is reported. (default=5)')
+    parser.add_argument('--threads', type=int, nargs='*', default=[1,2,4], help='The thread counts to measure. (default=1 2 4)')
+    return parser.parse_args()
+
+def rows_per_second(name, function, texts, repeat):
+    best=None
+    for i in range(repeat):
+        start=time.perf_counter()
+        result=function(texts)
+        elapsed=time.perf_counter()-start
+        if best is None or elapsed<best: best=elapsed
+    print(f"{name:<24} {len(texts)/best:>12.0f} rows/s", file=sys.stderr)
+    return result
+
+if __name__ == "__main__":
+    args = config_args()
+    df = pd.read_csv(args.inputfile, header=(0 if args.header else None), dtype=str, keep_default_na=False)
+    texts = df.iloc[:, args.column-1].tolist()
+
+    expected = rows_per_second("before", clean_before, texts, args.repeat)
+    for threads in args.threads:
+        cleaner = pb.CleanProcessor("clean", None)
+        cleaner.configure({"threads": threads})
+        result = rows_per_second(f"after ({threads} threads)", cleaner.clean_texts, texts, args.repeat)
+        cleaner.close()
+        if result!=expected:
+            print(f"FAIL: the cleaned texts differ with {threads} threads", file=sys.stderr)
+            sys.exit(1)
@@ -0,0 +1,51 @@
+import sys
+import os
+import time
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+#The redactomatic checkout that this script belongs to.
+HOME=os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+
+# The runs that are timed.  Each is a list of arguments passed to redactomatic.py; {input} and {output} are replaced by the sample data and a temporary output file.
+# None of them build a spaCy redactor so they measure the time taken to start up rather than to load a model.
+SCENARIOS={
+    "version": ["--version"],
+    "redact-level-0": ["--inputfile", "{input}", "--outputfile", "{output}", "--column", "4", "--idcolumn", "1", "--modality", "text", "--level", "0"],
+    "anonymize-level-0": ["--inputfile", "{input}", "--outputfile", "{output}", "--column", "4", "--idcolumn", "1", "--modality", "voice", "--level", "0", "--anonymize"],
+}
+
+def config_args():
+    parser = argparse.ArgumentParser(description='Measure the time taken by redactomatic to start up and process a small file when no rule needs a spaCy model.  Any other options are passed on to redactomatic.')
+    parser.add_argument('--repeat', type=int, default=5, help='the number of times to run each scenario. Default=5')
+    parser.add_argument('--redactomatic', nargs='+', default=[HOME], help='the redactomatic checkouts to time, e.g. an older version to compare against. Default=this checkout.')
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS), help='the scenarios to run. Default=all of them.')
+    parser.add_argument('--inputfile', default=os.path.join(HOME, "sample-data", "sample_data.csv"), help='the CSV file to process. Default=sample-data/sample_data.csv')
+    return parser.parse_known_args()
+
+'''Run redactomatic in the checkout once with the arguments and return the elapsed time in seconds.'''
+def time_run(checkout, arguments):
+    start=time.perf_counter()
+    result=subprocess.run([sys.executable, os.path.join(checkout, "redactomatic.py")]+arguments, cwd=checkout, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    elapsed=time.perf_counter()-start
+    if result.returncode!=0:
+        raise Exception("redactomatic failed in %s with arguments %s:\n%s" % (checkout, " ".join(arguments), result.stderr))
+    return elapsed
+
+def main():
+    args, extra = config_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output=os.path.join(tmpdir, "output.csv")
+        print("%-40s %-20s %10s %10s" % ("redactomatic", "scenario", "min (s)", "mean (s)"))
+        for checkout in args.redactomatic:
+            checkout=os.path.realpath(checkout)
+            for name in args.scenarios:
+                arguments=[a.format(input=os.path.realpath(args.inputfile), output=output) for a in SCENARIOS[name]]
+                if name!="version": arguments+=extra
+                times=[time_run(checkout, arguments) for _ in range(args.repeat)]
+                print("%-40s %-20s %10.3f %10.3f" % (checkout[-40:], name, min(times), statistics.mean(times)))
+
+if __name__ == '__main__':
+    main()
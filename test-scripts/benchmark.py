@@ -0,0 +1,262 @@
+import sys
+import os
+import time
+import json
+import random
+import argparse
+import platform
+import subprocess
+import collections
+import pandas as pd
+
+#Run from anywhere: the redactomatic modules are in the parent directory.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+import redactomatic as rd
+import anonymize as anon
+import entity_map as em
+import entity_rules as er
+import entity_values as ev
+import chunk_io as cio
+import processor_base as pb
+
+#resource is not available on Windows so the peak memory is not reported there.
+try:
+    import resource
+except ImportError:
+    resource=None
+
+# Phrases said by the agent and the client between the entities.
+FILLER={
+    "Agent": ["Hello and thank you for contacting General Corporation.", "How can I help you today?", "Let me look that up for you.", "Can you confirm some details for me please?",
+              "Thank you for your patience.", "One moment while I check your account.", "Is there anything else I can help you with?", "I have updated your account.",
+              "I understand, let me see what I can do.", "Thank you for calling, have a great day."],
+    "Client": ["Hi, I have a question about my bill.", "Yes that's right.", "I was charged twice this month.", "Okay, thank you.", "No, that's everything.",
+               "I need to change my payment details.", "Sure, no problem.", "I called last week about the same thing.", "That would be great.", "Can you say that again?"]
+}
+
+# Sentences that contain an entity.  The tags are replaced by values generated by the anonymizer for the entity.
+TEMPLATES={
+    "PERSON": ["My name is [PERSON].", "Can I speak to [PERSON] please?"],
+    "PHONE": ["You can call me back on [PHONE].", "My number is [PHONE]."],
+    "ADDRESS": ["I live at [ADDRESS].", "Please send it to [ADDRESS]."],
+    "CCARD": ["The card number is [CCARD].", "Please use my card [CCARD]."],
+    "SSN": ["My social security number is [SSN]."],
+    "ZIP": ["The zip code is [ZIP]."],
+    "EMAIL": ["My email is [EMAIL].", "Please email me at [EMAIL]."],
+    "MONEY": ["I was charged [MONEY].", "The bill came to [MONEY]."],
+    "PIN": ["My pin is [PIN]."],
+    "DATE": ["The payment was made on [DATE]."],
+    "TIME": ["I called at [TIME]."],
+    "CARDINAL": ["I have [CARDINAL] accounts with you."],
+    "ORDINAL": ["This is the [ORDINAL] time I have called."],
+    "PERCENT": ["The rate went up by [PERCENT]."],
+    "GPE": ["I am calling from [GPE]."],
+    "LOC": ["I was travelling near [LOC]."],
+    "ORG": ["I used to be with [ORG]."],
+    "NORP": ["My partner is [NORP]."],
+    "PRODUCT": ["I bought a [PRODUCT]."],
+    "EVENT": ["I was away for [EVENT]."],
+    "LANGUAGE": ["Do you have anyone who speaks [LANGUAGE]?"]
+}
+
+def config_args():
+    parser = argparse.ArgumentParser(description='Measure the throughput of redactomatic on synthetic transcripts. Any other options are passed on to redactomatic, e.g. --rulefile.')
+    parser.add_argument('--rows', type=int, default=10000, help='The number of rows of synthetic transcript to generate for each modality. (default=10000)')
+    parser.add_argument('--turns', type=int, default=12, help='The number of rows in each conversation. (default=12)')
+    parser.add_argument('--density', type=float, default=0.5, help='The average number of entities in each row. (default=0.5)')
+    parser.add_argument('--levels', nargs='+', default=['1','2','3'], help='The redaction levels to run. (default=1 2 3)')
+    parser.add_argument('--modalities', nargs='+', default=['text','voice'], choices=['text','voice'], help='The modalities to run. (default=text voice)')
+    parser.add_argument('--anonymize', default='both', choices=['no','yes','both'], help='Run without --anonymize, with it or both. (default=both)')
+    parser.add_argument('--chunksize', type=int, default=10000, help='The chunk size passed to redactomatic. (default=10000)')
+    parser.add_argument('--repeat', type=int, default=1, help='The number of times to run each scenario; the fastest run is reported. (default=1)')
+    parser.add_argument('--seed', type=int, default=1, help='The seed used to generate the transcripts and to anonymize them. (default=1)')
+    parser.add_argument('--datadir', default='benchmark-data', help='The directory to write the synthetic transcripts and the redacted output to. (default=benchmark-data)')
+    parser.add_argument('--outputfile', default='benchmark.json', help='The file to write the results to as JSON. (default=benchmark.json)')
+    parser.add_argument('--compare', default=None, help='A results file from an earlier run to compare the rows per second with.')
+    parser.add_argument('--run', default=None, help=argparse.SUPPRESS)
+    return parser.parse_known_args()
+
+'''Return the redactomatic arguments for a modality, e.g. to load the rules for the generator.'''
+def redactomatic_args(modality, extra, options=[]):
+    return rd.config_args(["--no-verbose", "--header", "--modality", modality] + options + extra)
+
+'''Return the anonymizers that generate a value for each entity with a template, in anonymization order.  Entities without one are left out.'''
+def build_generators(entity_rules):
+    generators=[]
+    entity_map=em.EntityMap()
+    entity_values=ev.EntityValues()
+    for rule in entity_rules.anonymization_order:
+        if rule not in TEMPLATES: continue
+        try:
+            model=entity_rules.get_model(rule, "anonymizer", entity_map, entity_values)
+        except (er.NotSupportedException, er.EntityRuleConfigException):
+            continue
+        #Entities that are anonymized to nothing would leave holes in the sentences.
+        if isinstance(model, anon.AnonNullString): continue
+        generators.append((rule, model))
+    return generators
+
+'''Write a synthetic transcript of rows rows for a modality to filepath.  Each row has density entities on average.'''
+def generate(filepath, modality, rows, turns, density, seed, extra):
+    args=redactomatic_args(modality, extra, ["--no-redact", "--seed", str(seed)])
+    entity_rules=rd.load_entity_rules(args)
+    generators=build_generators(entity_rules)
+    if not generators: raise Exception("No anonymizers were found to generate entities with.")
+    rules=[rule for rule, model in generators]
+    rng=random.Random(seed)
+
+    ids=[]
+    speakers=[]
+    dates=[]
+    texts=[]
+    label=0
+    for row in range(rows):
+        conversation=row//turns
+        speaker="Agent" if row%2==0 else "Client"
+        sentences=[rng.choice(FILLER[speaker])]
+        count=int(density)+(1 if rng.random()<density-int(density) else 0)
+        for i in range(count):
+            rule=rng.choice(rules)
+            sentences.insert(rng.randrange(len(sentences)+1), rng.choice(TEMPLATES[rule]).replace("["+rule+"]", "["+rule+"-"+str(label)+"]"))
+            label+=1
+        ids.append(str(1000000+conversation))
+        speakers.append(speaker)
+        dates.append(f"{1+conversation%12:02d}/{1+conversation%28:02d}/2024 {row%24:02d}:00")
+        texts.append(" ".join(sentences))
+
+    #Replace the tags with generated values in the same way as anonymization does, then tidy up the spacing.
+    for rule, model in generators:
+        texts=model.anonymize(texts, ids)
+    if modality=="voice": texts=[text.lower().replace(",","").replace(".","").replace("?","") for text in texts]
+    cleaner=pb.CleanProcessor("clean", entity_rules)
+    cleaner.configure({})
+    texts=cleaner.clean_texts(texts)
+
+    pd.DataFrame({"conversation_id": ids, "speaker": speakers, "date_time": dates, "text": texts}).to_csv(filepath, index=False)
+
+'''Run one scenario and return its timings.  Called in a new process for each scenario so that the peak memory use is its own.'''
+def run_scenario(scenario, extra):
+    options=["--level", scenario["level"], "--inputfile", scenario["inputfile"], "--outputfile", scenario["outputfile"],
+             "--chunksize", str(scenario["chunksize"]), "--seed", str(scenario["seed"])]
+    if scenario["anonymize"]: options.append("--anonymize")
+    args=redactomatic_args(scenario["modality"], extra, options)
+
+    _start=time.perf_counter()
+    entity_rules=rd.load_entity_rules(args)
+    redactomatic=rd.RedactomaticProcessor("redactomatic", entity_rules)
+    redactomatic.configure(None)
+    build_time=time.perf_counter()-_start
+
+    #Time each stage of the main loop of redactomatic.
+    stages=collections.OrderedDict((stage, 0.0) for stage in ["read", "redact", "anonymize", "clean", "write"])
+    writer=cio.ChunkWriter(args.outputfile, args.outputformat, args.header)
+    df_iter=cio.read_chunks(args.inputfile[0], args.inputformat, args.chunksize, args.header)
+    rows=0
+    _run_start=time.perf_counter()
+    while True:
+        _start=time.perf_counter()
+        df=next(df_iter, None)
+        if df is None: break
+        texts, ids = redactomatic.get_texts(df)
+        _now=time.perf_counter(); stages["read"]+=_now-_start; _start=_now
+        texts=redactomatic.redact_texts(texts, ids)
+        _now=time.perf_counter(); stages["redact"]+=_now-_start; _start=_now
+        texts=redactomatic.pipeline.anonymize(texts, ids)
+        _now=time.perf_counter(); stages["anonymize"]+=_now-_start; _start=_now
+        texts=redactomatic.cleaner.clean_texts(texts)
+        _now=time.perf_counter(); stages["clean"]+=_now-_start; _start=_now
+        df.iloc[:, args.column-1]=texts
+        writer.write(df, append=(rows>0))
+        _now=time.perf_counter(); stages["write"]+=_now-_start
+        rows+=len(df)
+    stages["read"]+=time.perf_counter()-_start
+    writer.close()
+    redactomatic.close()
+    run_time=time.perf_counter()-_run_start
+
+    input_bytes=os.path.getsize(args.inputfile[0])
+    return {
+        "modality": scenario["modality"],
+        "level": scenario["level"],
+        "anonymize": scenario["anonymize"],
+        "rows": rows,
+        "input_bytes": input_bytes,
+        "build_seconds": build_time,
+        "seconds": run_time,
+        "rows_per_second": rows/run_time if run_time>0 else None,
+        "mb_per_second": input_bytes/1e6/run_time if run_time>0 else None,
+        "stage_seconds": stages,
+        "peak_rss_kb": peak_rss_kb()
+    }
+
+'''Return the peak resident memory of this process and any processes it started in KB, or None if it cannot be measured.'''
+def peak_rss_kb():
+    if resource is None: return None
+    peak=max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    #ru_maxrss is in bytes on macOS and KB elsewhere.
+    return peak//1024 if sys.platform=="darwin" else peak
+
+'''Return the git commit of the redactomatic directory or None if it is not a git checkout.'''
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.realpath(rd.__file__)), capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+'''Print the change in rows per second for each scenario that is also in an earlier results file.'''
+def compare(results, filepath):
+    with open(filepath) as f:
+        before={(r["modality"], r["level"], r["anonymize"]): r for r in json.load(f)["results"]}
+    print(f"\nCompared with {filepath}:", file=sys.stderr)
+    for r in results:
+        b=before.get((r["modality"], r["level"], r["anonymize"]))
+        if b is None or not b["rows_per_second"]: continue
+        change=100.0*(r["rows_per_second"]/b["rows_per_second"]-1)
+        print(f"{r['modality']:<6} level {r['level']:<4} anonymize={str(r['anonymize']):<5} {b['rows_per_second']:>10.0f} -> {r['rows_per_second']:>10.0f} rows/s ({change:+.1f}%)", file=sys.stderr)
+
+if __name__ == "__main__":
+    args, extra = config_args()
+
+    #A single scenario run in a child process.  The result is written to standard output as JSON.
+    if args.run is not None:
+        print(json.dumps(run_scenario(json.loads(args.run), extra)))
+        sys.exit(0)
+
+    os.makedirs(args.datadir, exist_ok=True)
+    results=[]
+    anonymize={"no": [False], "yes": [True], "both": [False, True]}[args.anonymize]
+    for modality in args.modalities:
+        inputfile=os.path.join(args.datadir, f"synthetic_{modality}.csv")
+        print(f"Generating {args.rows} rows of {modality} transcripts in {inputfile}...", file=sys.stderr)
+        generate(inputfile, modality, args.rows, args.turns, args.density, args.seed, extra)
+
+        for level in args.levels:
+            for anonymized in anonymize:
+                scenario={"modality": modality, "level": level, "anonymize": anonymized, "inputfile": inputfile, "chunksize": args.chunksize, "seed": args.seed,
+                          "outputfile": os.path.join(args.datadir, f"redacted_{modality}_{level}{'_anon' if anonymized else ''}.csv")}
+                result=None
+                for i in range(args.repeat):
+                    child=subprocess.run([sys.executable, os.path.realpath(__file__), "--run", json.dumps(scenario)]+extra, capture_output=True, text=True)
+                    if child.returncode!=0:
+                        print(child.stderr, file=sys.stderr)
+                        raise Exception(f"The {modality} level {level} scenario failed.")
+                    run=json.loads(child.stdout.strip().splitlines()[-1])
+                    if result is None or run["seconds"]<result["seconds"]: result=run
+                results.append(result)
+                print(f"{modality:<6} level {level:<4} anonymize={str(anonymized):<5} {result['rows_per_second']:>10.0f} rows/s {result['mb_per_second']:>7.3f} MB/s  peak RSS {result['peak_rss_kb']} KB  "
+                      + " ".join(f"{stage}={seconds:.2f}s" for stage, seconds in result["stage_seconds"].items()), file=sys.stderr)
+
+    report={
+        "version": rd.__version__(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "settings": {"rows": args.rows, "turns": args.turns, "density": args.density, "chunksize": args.chunksize, "seed": args.seed, "repeat": args.repeat, "options": extra},
+        "results": results
+    }
+    with open(args.outputfile, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.outputfile}", file=sys.stderr)
+
+    if args.compare: compare(results, args.compare)
@@ -0,0 +1,92 @@
+import sys
+import os
+import argparse
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+#The names given to the columns of the sample CSV files, which have no header.  The text and id columns have the default --columnname and --idcolumnname.
+COLUMNS=['conversation_id', 'speaker', 'date_time', 'text']
+
+def read_table(filename):
+    if os.path.splitext(filename)[1]=='.parquet':
+        return pq.read_table(filename)
+    with pa.memory_map(filename) as source:
+        return pa.ipc.open_file(source).read_all()
+
+def write_table(table, filename):
+    if os.path.splitext(filename)[1]=='.parquet':
+        pq.write_table(table, filename, row_group_size=7)
+    else:
+        with pa.ipc.new_file(filename, table.schema) as writer:
+            writer.write_table(table, max_chunksize=7)
+
+def read_csv_texts(filename):
+    return pd.read_csv(filename, header=None, dtype=str, keep_default_na=False).iloc[:, 3].tolist()
+
+def make_file(csvfile, outputfile):
+    '''Convert a sample CSV file to a Parquet or Arrow file with an integer turn column and an extra row with a missing text at the end.'''
+    df=pd.read_csv(csvfile, header=None, names=COLUMNS, dtype=str, keep_default_na=False)
+    table=pa.Table.from_pydict({
+        'conversation_id': pa.array(df['conversation_id'].tolist()+[df['conversation_id'].iloc[-1]], pa.string()),
+        'speaker': pa.array(df['speaker'].tolist()+['Client'], pa.string()),
+        'date_time': pa.array(df['date_time'].tolist()+[df['date_time'].iloc[-1]], pa.string()),
+        'text': pa.array(df['text'].tolist()+[None], pa.string()),
+        'turn': pa.array(range(len(df)+1), pa.int64())
+    })
+    write_table(table, outputfile)
+
+def compare_tables(inputfile, resultfiles, expectedfiles, message):
+    '''Check that the text column of the result files is the text column of the expected CSV files, with an empty text for each missing input text,
+    and that the other columns are the same as in the input file.  There must be one result file for each expected file, with the same rows.'''
+    source=read_table(inputfile)
+    results=[read_table(resultfile) for resultfile in resultfiles]
+    errors=[]
+    if len(results)!=len(expectedfiles): errors.append(f"{len(results)} result files for {len(expectedfiles)} expected files")
+    missing=source.column('text').is_null().to_pylist()
+    row=0
+    for resultfile, result, expectedfile in zip(resultfiles, results, expectedfiles):
+        expected=iter(read_csv_texts(expectedfile))
+        for text in result.column('text').to_pylist():
+            want='' if row<len(missing) and missing[row] else next(expected, None)
+            if text!=want: errors.append(f"{resultfile} row {row}: {text!r} is not {want!r}")
+            row+=1
+        if next(expected, None) is not None: errors.append(f"{resultfile} has fewer rows than {expectedfile}")
+    result=pa.concat_tables(results) if results else None
+    if result is None or result.schema!=source.schema:
+        errors.append(f"the columns are not the same as in {inputfile}")
+    else:
+        for name in source.column_names:
+            if name!='text' and not result.column(name).equals(source.column(name)): errors.append(f"column {name} is not the same as in {inputfile}")
+    if errors:
+        print(f"FAIL: {message} [{'; '.join(errors[:3])}]", file=sys.stderr)
+        return False
+    print(f"PASS: {message}", file=sys.stderr)
+    return True
+
+def config_args():
+    parser = argparse.ArgumentParser(description='Make Parquet and Arrow test files from the sample data and check the output of redactomatic for them.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    make = subparsers.add_parser('make', help='Convert a sample CSV file to a Parquet or Arrow file, chosen by the extension of the output file')
+    make.add_argument('csvfile', help='The sample CSV file')
+    make.add_argument('outputfile', help='The Parquet (.parquet) or Arrow (.arrow) file to write')
+    compare = subparsers.add_parser('compare', help='Compare the output for a file made by make with the expected CSV output')
+    compare.add_argument('inputfile', help='The file made by make that was redacted')
+    compare.add_argument('message', help='The test being performed')
+    compare.add_argument('--results', nargs='+', required=True, help='The Parquet or Arrow output files in order')
+    compare.add_argument('--expected', nargs='+', required=True, help='The expected CSV output files in the same order')
+
+    _args=parser.parse_args()
+    return _args
+
+if __name__ == "__main__":
+    # get command line params.
+    args = config_args()
+
+    try:
+        if args.command=='make':
+            make_file(args.csvfile, args.outputfile)
+        else:
+            compare_tables(args.inputfile, args.results, args.expected, args.message)
+    except Exception as e:
+        print(f"ERROR. Terminating columnar-files with error:  {e}",file=sys.stderr)
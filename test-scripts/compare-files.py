@@ -1,9 +1,24 @@
 import filecmp
 import sys
+import os
+import gzip
+import bz2
+import lzma
 import argparse
 
+#Result files with these extensions are decompressed before they are compared with the expected file.
+DECOMPRESSORS={'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+def read_file(filename):
+    _open=DECOMPRESSORS.get(os.path.splitext(filename)[1], open)
+    with _open(filename, 'rb') as f:
+        return f.read()
+
 def compare_files(resultfile, expectedfile, message):
-    result=filecmp.cmp(resultfile, expectedfile)
+    if os.path.splitext(resultfile)[1] in DECOMPRESSORS:
+        result=read_file(resultfile)==read_file(expectedfile)
+    else:
+        result=filecmp.cmp(resultfile, expectedfile)
     if result:
         print(f"PASS: {message}", file=sys.stderr)
         return True
@@ -0,0 +1,33 @@
+import shutil
+import sys
+import os
+import gzip
+import bz2
+import lzma
+import argparse
+
+#The output files are compressed according to their extension.
+COMPRESSORS={'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+def compress_file(inputfile, outputfile):
+    _open=COMPRESSORS[os.path.splitext(outputfile)[1]]
+    with open(inputfile, 'rb') as fin, _open(outputfile, 'wb') as fout:
+        shutil.copyfileobj(fin, fout)
+
+def config_args():
+    parser = argparse.ArgumentParser(description='Compress a file into one or more files, e.g. to test compressed input files.')
+    parser.add_argument('inputfile',  help='The file to compress')
+    parser.add_argument('outputfiles', nargs='+', help='The compressed files to write, compressed according to their extension (.gz, .bz2 or .xz)')
+
+    _args=parser.parse_args()
+    return _args
+
+if __name__ == "__main__":
+    # get command line params.
+    args = config_args()
+
+    try:
+        for outputfile in args.outputfiles:
+            compress_file(args.inputfile, outputfile)
+    except Exception as e:
+        print(f"ERROR. Terminating compress-file with error:  {e}",file=sys.stderr)
@@ -9,6 +9,7 @@ $BINDIR = '..'
 $INPUTDIR = '..\sample-data'
 $TESTEXPECTED = '..\test-expected'
 $CUSTOMRULES = Join-Path $INPUTDIR 'custom-anon-rules.yml'
+$TRIERULES = Join-Path $INPUTDIR 'sample-trie-rules.yml'
 
 # Input file names
 $sample_voice = 'sample_data_voice.csv'
@@ -32,6 +33,34 @@ $text_redacted_l4 = 'text_output_l4.csv'
 $text_log_l4 = 'text_log_l4.csv'
 $text_anonymized_only = 'text_output_anonymized_only.csv'
 $voice_anonymized_only = 'voice_output_anonymized_only.csv'
+$text_redacted_trie = 'text_output_trie.csv'
+$voice_resumed_l2 = 'voice_output_resumed_l2.csv.gz'
+$voice_resumed_log_l2 = 'voice_log_resumed_l2.csv'
+$checkpoint_dir = 'checkpoint'
+$text_workers_l2 = 'text_output_workers_l2.csv'
+$text_workers_log_l2 = 'text_log_workers_l2.csv'
+$voice_workers1_l2 = 'voice_output_workers1_l2.csv'
+$voice_workers1_log_l2 = 'voice_log_workers1_l2.csv'
+$voice_workers3_l2 = 'voice_output_workers3_l2.csv'
+$voice_workers3_log_l2 = 'voice_log_workers3_l2.csv'
+$voice_prefetch_l2 = 'voice_output_prefetch_l2.csv'
+$voice_prefetch_log_l2 = 'voice_log_prefetch_l2.csv'
+$text_memocache_l2 = 'text_output_memocache_l2.csv'
+$text_memocache_log_l2 = 'text_log_memocache_l2.csv'
+$text_streamlog_l2 = 'text_output_streamlog_l2.csv'
+$text_streamlog_log_l2 = 'text_log_streamlog_l2.csv'
+$text_entitymapcap_l2 = 'text_output_entitymapcap_l2.csv'
+$text_cleanthreads_l2 = 'text_output_cleanthreads_l2.csv'
+$outputdir = 'outputdir'
+$text_outputdir_log_l2 = 'text_log_outputdir_l2.csv'
+$parquet_text = 'sample_data.parquet'
+$text_redacted_parquet_l2 = 'text_output_l2.parquet'
+$arrow_instem = 'arrow_input'
+$arrow_outstem = 'arrow_output'
+$arrow_chunkoutstem = 'arrow_chunkout'
+$compressed_text = 'sample_data.csv'
+$text_compressed_l2 = 'text_output_compressed_l2.csv'
+$text_compressed_log_l2 = 'text_log_compressed_l2.csv'
 $instem = 'input'
 $outstem = 'output'
 $chunkoutstem = 'chunkout'
@@ -87,6 +116,37 @@ python $BINDIR\redactomatic.py $VERBOSE_OPT --column 4 --idcolumn 1 --modality v
 # Test date based redaction and gathered chunks
 python $BINDIR\redactomatic.py $VERBOSE_OPT --column 4 --idcolumn 1 --modality text --rulefile $CUSTOMRULES --instem $INPUTDIR\$instem -sd '2024-01-01' -ed '2024-01-31' --outstem $outstem --chunkoutstem $chunkoutstem --chunksize 10 --chunkgather 1 --log $date_chunked_log --level 1 --startdate 2024-01-01 --enddate 2024-01-31 --chunkgather 1
 
+# Test a phrase list matched by the trie engine
+python $BINDIR\redactomatic.py $VERBOSE_OPT --column 4 --idcolumn 1 --modality text --rulefile $CUSTOMRULES $TRIERULES --inputfile $INPUTDIR\$sample_text --outputfile $text_redacted_trie --level trie
+
+# Test stopping a run with --chunklimit and resuming it from its checkpoint, with compressed output
+Remove-Item -Path $checkpoint_dir -Recurse -ErrorAction SilentlyContinue
+python $BINDIR\redactomatic.py $VERBOSE_OPT --column 4 --idcolumn 1 --modality voice --rulefile $CUSTOMRULES --chunksize 20 --inputfile $INPUTDIR\$sample_voice --outputfile $voice_resumed_l2 --log $voice_resumed_log_l2 --level 2 --checkpoint $checkpoint_dir --chunklimit 1
+python $BINDIR\redactomatic.py $VERBOSE_OPT --column 4 --idcolumn 1 --modality voice --rulefile $CUSTOMRULES --chunksize 20 --inputfile $INPUTDIR\$sample_voice --outputfile $voice_resumed_l2 --log $voice_resumed_log_l2 --level 2 --checkpoint $checkpoint_dir --resume
+
+# Test the options that change how a run is done but not its output.  The chunked voice output with --workers is compared between 1 and 3 workers.
+python $BINDIR\redactomatic.py $VERBOSE_OPT --column 4 --idcolumn 1 --modality text --rulefile $CUSTOMRULES --inputfile $INPUTDIR\$sample_text --outputfile $text_workers_l2 --log $text_workers_log_l2 --level 2 --workers 3
+python $BINDIR\redactomatic.py $VERBOSE_OPT --column 4 --idcolumn 1 --modality voice --rulefile $CUSTOMRULES --chunksize 20 --inputfile $INPUTDIR\$sample_voice --outputfile $voice_workers1_l2 --log $voice_workers1_log_l2 --level 2 --workers 1
+python $BINDIR\redactomatic.py $VERBOSE_OPT --column 4 --idcolumn 1 --modality voice --rulefile $CUSTOMRULES --chunksize 20 --inputfile $INPUTDIR\$sample_voice --outputfile $voice_workers3_l2 --log $voice_workers3_log_l2 --level 2 --workers 3
+python $BINDIR\redactomatic.py $VERBOSE_OPT --column 4 --idcolumn 1 --modality voice --rulefile $CUSTOMRULES --chunksize 20 --inputfile $INPUTDIR\$sample_voice --outputfile $voice_prefetch_l2 --log $voice_prefetch_log_l2 --level 2 --prefetch 2
+python $BINDIR\redactomatic.py $VERBOSE_OPT --column 4 --idcolumn 1 --modality text --rulefile $CUSTOMRULES --inputfile $INPUTDIR\$sample_text --outputfile $text_memocache_l2 --log $text_memocache_log_l2 --level 2 --memocache 1000
+python $BINDIR\redactomatic.py $VERBOSE_OPT --column 4 --idcolumn 1 --modality text --rulefile $CUSTOMRULES --inputfile $INPUTDIR\$sample_text --outputfile $text_streamlog_l2 --log $text_streamlog_log_l2 --level 2 --streamlog
+python $BINDIR\redactomatic.py $VERBOSE_OPT --column 4 --idcolumn 1 --modality text --rulefile $CUSTOMRULES --inputfile $INPUTDIR\$sample_text --outputfile $text_entitymapcap_l2 --level 2 --entitymapcap 1
+python $BINDIR\redactomatic.py $VERBOSE_OPT --column 4 --idcolumn 1 --modality text --rulefile $CUSTOMRULES --inputfile $INPUTDIR\$sample_text --outputfile $text_cleanthreads_l2 --level 2 --cleanthreads 2
+python $BINDIR\redactomatic.py $VERBOSE_OPT --column 4 --idcolumn 1 --modality text --rulefile $CUSTOMRULES --inputfile $INPUTDIR\$sample_text --outputdir $outputdir --log $text_outputdir_log_l2 --level 2
+
+# Redact Parquet and Arrow files made from the sample data, with an extra integer column and a missing text.
+python columnar-files.py make $INPUTDIR\$sample_text $parquet_text
+python $BINDIR\redactomatic.py $VERBOSE_OPT --modality text --rulefile $CUSTOMRULES --inputformat parquet --inputfile $parquet_text --outputfile $text_redacted_parquet_l2 --level 2
+python columnar-files.py make $INPUTDIR\${instem}_2024-01-01_2024-01-31.csv ${arrow_instem}_2024-01-01_2024-01-31.arrow
+python $BINDIR\redactomatic.py $VERBOSE_OPT --modality text --rulefile $CUSTOMRULES --inputformat arrow --instem $arrow_instem -sd '2024-01-01' -ed '2024-01-31' --outstem $arrow_outstem --chunkoutstem $arrow_chunkoutstem --chunksize 10 --chunkgather 1 --level 1
+
+# Redact compressed copies of the sample data, writing compressed output and log files.  Each run uses a different compression for each file.
+python compress-file.py $INPUTDIR\$sample_text "$compressed_text.gz" "$compressed_text.bz2" "$compressed_text.xz"
+python $BINDIR\redactomatic.py $VERBOSE_OPT --column 4 --idcolumn 1 --modality text --rulefile $CUSTOMRULES --inputfile "$compressed_text.gz" --outputfile "$text_compressed_l2.bz2" --log "$text_compressed_log_l2.xz" --level 2
+python $BINDIR\redactomatic.py $VERBOSE_OPT --column 4 --idcolumn 1 --modality text --rulefile $CUSTOMRULES --inputfile "$compressed_text.bz2" --outputfile "$text_compressed_l2.xz" --log "$text_compressed_log_l2.gz" --level 2 --streamlog
+python $BINDIR\redactomatic.py $VERBOSE_OPT --column 4 --idcolumn 1 --modality text --rulefile $CUSTOMRULES --inputfile "$compressed_text.xz" --outputfile "$text_compressed_l2.gz" --log "$text_compressed_log_l2.bz2" --level 2
+
 # Now compare the results
 python compare-files.py $regex_test $TESTEXPECTED\$regex_test 'Is the regex test output file correct?'
 python compare-files.py $voice_log_l2 $TESTEXPECTED\$voice_log_l2 'Is the L2 voice redaction log correct?'
@@ -110,6 +170,31 @@ python compare-files.py chunkout_2024-01-01_2024-01-31_1.csv $TESTEXPECTED\chunk
 python compare-files.py chunkout_2024-01-01_2024-01-31_2.csv $TESTEXPECTED\chunkout_2024-01-01_2024-01-31_2.csv 'Is chunk 3 correct?'
 python compare-files.py chunkout_2024-01-01_2024-01-31_3.csv $TESTEXPECTED\chunkout_2024-01-01_2024-01-31_3.csv 'Is chunk 4 correct?'
 python compare-files.py chunkout_2024-01-01_2024-01-31_4.csv $TESTEXPECTED\chunkout_2024-01-01_2024-01-31_4.csv 'Is chunk 5 correct?'
+python compare-files.py $text_redacted_trie $TESTEXPECTED\$text_redacted_trie 'Is the trie phrase engine output file correct?'
+python compare-files.py $voice_resumed_l2 $TESTEXPECTED\$voice_redacted_l2 'Is the resumed L2 redacted voice output file correct?'
+python compare-files.py $voice_resumed_log_l2 $TESTEXPECTED\$voice_log_l2 'Is the resumed L2 voice redaction log correct?'
+python compare-files.py $text_workers_l2 $TESTEXPECTED\$text_redacted_l2 'Is the L2 redacted text output file with --workers correct?'
+python compare-files.py $text_workers_log_l2 $TESTEXPECTED\$text_log_l2 'Is the L2 text redaction log with --workers correct?'
+python compare-files.py $voice_workers1_l2 $voice_workers3_l2 'Is the L2 redacted voice output file the same with 1 and 3 --workers?'
+python compare-files.py $voice_workers1_log_l2 $voice_workers3_log_l2 'Is the L2 voice redaction log the same with 1 and 3 --workers?'
+python compare-files.py $voice_prefetch_l2 $TESTEXPECTED\$voice_redacted_l2 'Is the L2 redacted voice output file with --prefetch correct?'
+python compare-files.py $voice_prefetch_log_l2 $TESTEXPECTED\$voice_log_l2 'Is the L2 voice redaction log with --prefetch correct?'
+python compare-files.py $text_memocache_l2 $TESTEXPECTED\$text_redacted_l2 'Is the L2 redacted text output file with --memocache correct?'
+python compare-files.py $text_memocache_log_l2 $TESTEXPECTED\$text_log_l2 'Is the L2 text redaction log with --memocache correct?'
+python compare-files.py $text_streamlog_l2 $TESTEXPECTED\$text_redacted_l2 'Is the L2 redacted text output file with --streamlog correct?'
+python compare-files.py $text_streamlog_log_l2 $TESTEXPECTED\$text_log_l2 'Is the L2 text redaction log with --streamlog correct?'
+python compare-files.py $text_entitymapcap_l2 $TESTEXPECTED\$text_redacted_l2 'Is the L2 redacted text output file with --entitymapcap correct?'
+python compare-files.py $text_cleanthreads_l2 $TESTEXPECTED\$text_redacted_l2 'Is the L2 redacted text output file with --cleanthreads correct?'
+python compare-files.py $outputdir\$sample_text $TESTEXPECTED\$text_redacted_l2 'Is the L2 redacted text output file in --outputdir correct?'
+python compare-files.py $text_outputdir_log_l2 $TESTEXPECTED\$text_log_l2 'Is the L2 text redaction log with --outputdir correct?'
+python columnar-files.py compare $parquet_text 'Is the L2 redacted Parquet output file correct?' --results $text_redacted_parquet_l2 --expected $TESTEXPECTED\$text_redacted_l2
+python columnar-files.py compare ${arrow_instem}_2024-01-01_2024-01-31.arrow 'Are the Arrow chunks correct?' --results (0..4 | ForEach-Object { "${arrow_chunkoutstem}_2024-01-01_2024-01-31_$_.arrow" }) --expected (0..4 | ForEach-Object { "$TESTEXPECTED\chunkout_2024-01-01_2024-01-31_$_.csv" })
+python compare-files.py "$text_compressed_l2.bz2" $TESTEXPECTED\$text_redacted_l2 'Is the L2 redacted text output file from .gz to .bz2 correct?'
+python compare-files.py "$text_compressed_log_l2.xz" $TESTEXPECTED\$text_log_l2 'Is the L2 text redaction log in .xz correct?'
+python compare-files.py "$text_compressed_l2.xz" $TESTEXPECTED\$text_redacted_l2 'Is the L2 redacted text output file from .bz2 to .xz correct?'
+python compare-files.py "$text_compressed_log_l2.gz" $TESTEXPECTED\$text_log_l2 'Is the L2 text redaction log in .gz with --streamlog correct?'
+python compare-files.py "$text_compressed_l2.gz" $TESTEXPECTED\$text_redacted_l2 'Is the L2 redacted text output file from .xz to .gz correct?'
+python compare-files.py "$text_compressed_log_l2.bz2" $TESTEXPECTED\$text_log_l2 'Is the L2 text redaction log in .bz2 correct?'
 
 # Now delete the test output files
 if (-not $keep_result_files) {
@@ -130,6 +215,34 @@ if (-not $keep_result_files) {
     Remove-Item -Path $text_log_l4 -ErrorAction SilentlyContinue
     Remove-Item -Path $text_anonymized_only -ErrorAction SilentlyContinue
     Remove-Item -Path $voice_anonymized_only -ErrorAction SilentlyContinue
+    Remove-Item -Path $text_redacted_trie -ErrorAction SilentlyContinue
+    Remove-Item -Path $voice_resumed_l2 -ErrorAction SilentlyContinue
+    Remove-Item -Path $voice_resumed_log_l2 -ErrorAction SilentlyContinue
+    Remove-Item -Path $checkpoint_dir -Recurse -ErrorAction SilentlyContinue
+    Remove-Item -Path $text_workers_l2 -ErrorAction SilentlyContinue
+    Remove-Item -Path $voice_workers1_l2 -ErrorAction SilentlyContinue
+    Remove-Item -Path $voice_workers3_l2 -ErrorAction SilentlyContinue
+    Remove-Item -Path $voice_prefetch_l2 -ErrorAction SilentlyContinue
+    Remove-Item -Path $text_memocache_l2 -ErrorAction SilentlyContinue
+    Remove-Item -Path $text_streamlog_l2 -ErrorAction SilentlyContinue
+    Remove-Item -Path $text_entitymapcap_l2 -ErrorAction SilentlyContinue
+    Remove-Item -Path $text_cleanthreads_l2 -ErrorAction SilentlyContinue
+    Remove-Item -Path $text_workers_log_l2 -ErrorAction SilentlyContinue
+    Remove-Item -Path $voice_workers1_log_l2 -ErrorAction SilentlyContinue
+    Remove-Item -Path $voice_workers3_log_l2 -ErrorAction SilentlyContinue
+    Remove-Item -Path $voice_prefetch_log_l2 -ErrorAction SilentlyContinue
+    Remove-Item -Path $text_memocache_log_l2 -ErrorAction SilentlyContinue
+    Remove-Item -Path $text_streamlog_log_l2 -ErrorAction SilentlyContinue
+    Remove-Item -Path $text_outputdir_log_l2 -ErrorAction SilentlyContinue
+    Remove-Item -Path $outputdir -Recurse -ErrorAction SilentlyContinue
+    Remove-Item -Path $parquet_text -ErrorAction SilentlyContinue
+    Remove-Item -Path $text_redacted_parquet_l2 -ErrorAction SilentlyContinue
+    Remove-Item -Path "$arrow_instem*" -ErrorAction SilentlyContinue
+    Remove-Item -Path "$arrow_outstem*" -ErrorAction SilentlyContinue
+    Remove-Item -Path "$arrow_chunkoutstem*" -ErrorAction SilentlyContinue
+    Remove-Item -Path "$compressed_text.*" -ErrorAction SilentlyContinue
+    Remove-Item -Path "$text_compressed_l2.*" -ErrorAction SilentlyContinue
+    Remove-Item -Path "$text_compressed_log_l2.*" -ErrorAction SilentlyContinue
     Remove-Item -Path $date_chunked_log -ErrorAction SilentlyContinue
     Remove-Item -Path "$outstem*" -ErrorAction SilentlyContinue
     Remove-Item -Path "$chunkoutstem*" -ErrorAction SilentlyContinue